@@ -108,6 +108,19 @@ def _parse_args():
         default=None,
         help="Whether to offload the model to CPU after each model forward, reducing GPU memory usage."
     )
+    parser.add_argument(
+        "--memory_policy",
+        type=str,
+        default="offload",
+        choices=["offload", "resident_gpu"],
+        help="With --offload_model, 'offload' moves predictions and latents to CPU after every forward; 'resident_gpu' keeps the sampling loop on GPU and only offloads the models after sampling."
+    )
+    parser.add_argument(
+        "--batched_cfg",
+        action="store_true",
+        default=False,
+        help="Whether to run the conditional and unconditional passes of each sampling step as one batched forward. Faster, but uses more GPU memory."
+    )
     parser.add_argument(
         "--ulysses_size",
         type=int,
@@ -128,6 +141,11 @@ def _parse_args():
         action="store_true",
         default=False,
         help="Whether to place T5 model on CPU.")
+    parser.add_argument(
+        "--t5_cache_dir",
+        type=str,
+        default=None,
+        help="A directory persisting T5 prompt embeddings, so repeated prompts skip the text encoder across runs.")
     parser.add_argument(
         "--dit_fsdp",
         action="store_true",
@@ -238,6 +256,36 @@ def _init_logging(rank):
         logging.basicConfig(level=logging.ERROR)
 
 
+def load_dancer_inputs(image, cond_pos_folder, cond_neg_folder, frame_num):
+    """
+    Load the reference image and the positive / negative pose condition frames.
+
+    Returns (img, img_x, img_c, condition_pos, condition_neg) as expected by WanI2VDancer.generate.
+    """
+    img = Image.open(image).convert("RGB")
+
+    logging.info(f"Input cond_pos_folder: {cond_pos_folder}")
+    logging.info(f"Input cond_neg_folder: {cond_neg_folder}")
+
+    condition_pos_paths = [os.path.join(cond_pos_folder, "", f"{i:04d}.jpg") for i in range(frame_num)]
+    condition_pos = list(
+        [Image.open(f).convert("RGB").resize(img.size, Image.Resampling.BICUBIC) for f in condition_pos_paths])
+    image_cond_pos = condition_pos_paths[0]
+
+    condition_neg_paths = [os.path.join(cond_neg_folder, "", f"{i:04d}.jpg") for i in range(frame_num)]
+    condition_neg = list(
+        [Image.open(f).convert("RGB").resize(img.size, Image.Resampling.BICUBIC) for f in condition_neg_paths])
+    # image_cond_neg = condition_neg_paths[0]
+
+    logging.info(f"Input img_x: {image}")
+    logging.info(f"Input img_c: {image_cond_pos}")
+
+    img_x = Image.open(image).convert("RGB")
+    img_c = Image.open(image_cond_pos).convert("RGB")
+    img_c = img_c.resize(img.size, Image.Resampling.BICUBIC)
+    return img, img_x, img_c, condition_pos, condition_neg
+
+
 def generate(args):
     rank = int(os.getenv("RANK", 0))
     world_size = int(os.getenv("WORLD_SIZE", 1))
@@ -363,27 +411,8 @@ def generate(args):
         logging.info(f"Input prompt: {args.prompt}")
         logging.info(f"Input image: {args.image}")
 
-        img = Image.open(args.image).convert("RGB")
-
-        logging.info(f"Input cond_pos_folder: {args.cond_pos_folder}")
-        logging.info(f"Input cond_neg_folder: {args.cond_neg_folder}")
-
-        condition_pos_paths = [os.path.join(args.cond_pos_folder, "", f"{i:04d}.jpg") for i in range(args.frame_num)]
-        condition_pos = list(
-            [Image.open(f).convert("RGB").resize(img.size, Image.Resampling.BICUBIC) for f in condition_pos_paths])
-        image_cond_pos = condition_pos_paths[0]
-
-        condition_neg_paths = [os.path.join(args.cond_neg_folder, "", f"{i:04d}.jpg") for i in range(args.frame_num)]
-        condition_neg = list(
-            [Image.open(f).convert("RGB").resize(img.size, Image.Resampling.BICUBIC) for f in condition_neg_paths])
-        # image_cond_neg = condition_neg_paths[0]
-
-        logging.info(f"Input img_x: {args.image}")
-        logging.info(f"Input img_c: {image_cond_pos}")
-
-        img_x = Image.open(args.image).convert("RGB")
-        img_c = Image.open(image_cond_pos).convert("RGB")
-        img_c = img_c.resize(img.size, Image.Resampling.BICUBIC)
+        img, img_x, img_c, condition_pos, condition_neg = load_dancer_inputs(
+            args.image, args.cond_pos_folder, args.cond_neg_folder, args.frame_num)
 
         if args.use_prompt_extend:
             logging.info("Extending prompt ...")
@@ -418,6 +447,7 @@ def generate(args):
             dit_fsdp=args.dit_fsdp,
             use_usp=(args.ulysses_size > 1 or args.ring_size > 1),
             t5_cpu=args.t5_cpu,
+            t5_cache_dir=args.t5_cache_dir,
             st_cond_cfg=args.st_cond_cfg, end_cond_cfg=args.end_cond_cfg,
         )
 
@@ -437,7 +467,9 @@ def generate(args):
             guide_scale=args.sample_guide_scale,
             condition_guide_scale=args.condition_guide_scale,
             seed=args.base_seed,
-            offload_model=args.offload_model)
+            offload_model=args.offload_model,
+            memory_policy=args.memory_policy,
+            batched_cfg=args.batched_cfg)
     else:
         raise ValueError(f"Unkown task type: {args.task}")
 
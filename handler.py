@@ -6,20 +6,112 @@ import base64
 import json
 import uuid
 import logging
-import urllib.request as urllib_request
-import urllib.parse as urllib_parse
-import urllib.error as urllib_error
 import binascii # Base64 에러 처리를 위해 import
-import subprocess
 import time
 import shutil
+import subprocess
+import tempfile
+import hashlib
+import copy
+import threading
+import signal
+import queue
+import re
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from requests.adapters import HTTPAdapter
 # 로깅 설정
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 失败任务的错误码；只有 OOM 可以换更低的分辨率/帧数自动重试
+ERROR_CODES = ("OOM", "MISSING_MODEL", "BAD_INPUT", "VERSION_MISMATCH", "UNKNOWN")
+RETRYABLE_ERRORS = {"OOM"}
+
+class JobError(Exception):
+    """带错误码的任务失败，结果中返回 error_code / retryable 供调用方的队列决定是否重试"""
+
+    def __init__(self, code, message, node_id=None):
+        super().__init__(message)
+        self.code = code
+        self.node_id = node_id
+
+    @property
+    def retryable(self):
+        return self.code in RETRYABLE_ERRORS
+
+    def as_result(self):
+        result = {"error": str(self), "error_code": self.code, "retryable": self.retryable}
+        if self.node_id:
+            result["node_id"] = self.node_id
+        return result
+
+# 按异常类型名直接判断的错误
+_EXCEPTION_TYPE_CODES = {
+    "OutOfMemoryError": "OOM",
+    "UnidentifiedImageError": "BAD_INPUT",
+}
+# 异常信息的特征（正则，按顺序匹配，第一个命中的生效）；第一项不为 None 时只匹配这些异常类型
+_ERROR_PATTERNS = (
+    (None, r"out of memory", "OOM"),
+    (None, r"allocation on device", "OOM"),
+    # 节点实现与调用方参数不一致（插件/ComfyUI 版本不匹配）；'NoneType' object has no attribute 之类多为输入问题，不算
+    (("TypeError",), r"got multiple values for keyword argument", "VERSION_MISMATCH"),
+    (("TypeError",), r"unexpected keyword argument", "VERSION_MISMATCH"),
+    (("TypeError",), r"missing \d+ required positional argument", "VERSION_MISMATCH"),
+    (("AttributeError",), r"^module '[^']+' has no attribute", "VERSION_MISMATCH"),
+    (("ImportError", "ModuleNotFoundError"), r"cannot import name", "VERSION_MISMATCH"),
+    # 只按“找不到”的措辞判断缺模型；校验错误需是模型类输入（ckpt_name、model、lora_name 等），
+    # sampler/scheduler 等普通选项不在列表中属于输入错误
+    (None, r"value not in list: \w*(ckpt|model|lora|vae|clip|unet|checkpoint|gguf)\w*:", "MISSING_MODEL"),
+    (None, r"(model|model file|checkpoint) not found", "MISSING_MODEL"),
+    (None, r"no such file or directory: '/comfyui/models/", "MISSING_MODEL"),
+    (None, r"value not in list", "BAD_INPUT"),
+    (None, r"cannot identify image file", "BAD_INPUT"),
+    (None, r"invalid data found", "BAD_INPUT"),
+    (None, r"sizes of tensors must match", "BAD_INPUT"),
+    (None, r"no such file or directory", "BAD_INPUT"),
+)
+_ERROR_PATTERNS = tuple((types, re.compile(pattern, re.M), code) for types, pattern, code in _ERROR_PATTERNS)
+# 只检查异常信息的开头部分，每条消息的分类代价是常数
+_ERROR_SCAN_CHARS = 2000
+
+def classify_error(exception_type, exception_message, node_id=None):
+    """把异常类型名和异常信息映射为 JobError（固定的几个错误码之一）"""
+    exception_type = (exception_type or "").rsplit(".", 1)[-1]
+    message = str(exception_message or "")
+    code = _EXCEPTION_TYPE_CODES.get(exception_type)
+    if code is None:
+        text = message[:_ERROR_SCAN_CHARS].lower()
+        code = next((
+            code for types, pattern, code in _ERROR_PATTERNS
+            if (types is None or exception_type in types) and pattern.search(text)
+        ), "UNKNOWN")
+    if node_id:
+        message = f"节点 {node_id} 执行失败 ({exception_type or 'Error'}): {message}"
+    return JobError(code, message.strip(), node_id)
+
+def classify_execution_error(data):
+    """ComfyUI 的 execution_error 消息（WebSocket 或 history 中的）转换为 JobError"""
+    return classify_error(
+        data.get("exception_type") or data.get("type"),
+        data.get("exception_message") or data.get("error") or "Unknown execution error",
+        data.get("node_id"),
+    )
+
+def error_result(error):
+    """任意异常转换为带 error_code 的结果字典"""
+    if not isinstance(error, JobError):
+        error = classify_error(type(error).__name__, str(error))
+    return error.as_result()
+
 
 server_address = os.getenv('SERVER_ADDRESS', '127.0.0.1')
 client_id = str(uuid.uuid4())
+STEADYDANCER_WORKFLOW = "/workflows/wanvideo_SteadyDancer_example_03.json"
 def to_nearest_multiple_of_16(value):
     """주어진 값을 가장 가까운 16의 배수로 보정, 최소 16 보장"""
     try:
@@ -30,6 +122,172 @@ def to_nearest_multiple_of_16(value):
     if adjusted < 16:
         adjusted = 16
     return adjusted
+class DiskLRUCache:
+    """
+    磁盘上的 LRU 文件缓存（按总字节数限制大小）
+
+    每个条目是 <root>/<sha256(key)>.bin 加一个同名 .json 元数据文件，
+    最近使用时间记录在 .bin 的 mtime 上，因此重启后仍能恢复 LRU 顺序。
+    max_bytes <= 0 时缓存关闭；ttl（秒）不为 None 时，超过存活时间的条目视为未命中。
+    """
+
+    def __init__(self, root, max_bytes, ttl=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # {digest: size}
+        self._total_bytes = 0
+        if self.enabled:
+            os.makedirs(self.root, exist_ok=True)
+            for name in os.listdir(self.root):
+                if name.endswith(".bin"):
+                    try:
+                        size = os.path.getsize(os.path.join(self.root, name))
+                    except OSError:
+                        continue
+                    self._entries[name[:-4]] = size
+                    self._total_bytes += size
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _paths(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        base = os.path.join(self.root, digest)
+        return digest, base + ".bin", base + ".json"
+
+    def get(self, key):
+        """命中时返回 (文件路径, 元数据) 并刷新使用时间，否则返回 None"""
+        if not self.enabled:
+            return None
+        digest, data_path, meta_path = self._paths(key)
+        with self._lock:
+            if digest not in self._entries:
+                return None
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                if self.ttl is not None and time.time() - meta.get("created", 0) > self.ttl:
+                    self._remove(digest)
+                    return None
+                os.utime(data_path)
+            except (OSError, ValueError):
+                self._remove(digest)
+                return None
+        return data_path, meta
+
+    def update_meta(self, key, **fields):
+        """合并更新已有条目的元数据（条目不存在时忽略）"""
+        if not self.enabled:
+            return
+        digest, _, meta_path = self._paths(key)
+        with self._lock:
+            if digest not in self._entries:
+                return
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                meta.update(fields)
+                tmp_meta_path = f"{meta_path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_meta_path, 'w', encoding='utf-8') as f:
+                    json.dump(meta, f)
+                os.replace(tmp_meta_path, meta_path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"更新缓存元数据失败: {e}")
+
+    def put(self, key, src_path, meta=None):
+        """把 src_path 的内容存入缓存（优先硬链接，源文件保留），返回缓存文件路径"""
+        if not self.enabled:
+            return None
+        size = os.path.getsize(src_path)
+        if size > self.max_bytes:
+            return None
+        digest, data_path, meta_path = self._paths(key)
+        tmp_suffix = f".{uuid.uuid4().hex}.tmp"
+        tmp_path = data_path + tmp_suffix
+        tmp_meta_path = meta_path + tmp_suffix
+        link_or_copy(src_path, tmp_path)
+        with open(tmp_meta_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(meta or {}, key=key, size=size, created=time.time()), f)
+        with self._lock:
+            self._remove(digest)
+            os.replace(tmp_path, data_path)
+            os.replace(tmp_meta_path, meta_path)
+            self._entries[digest] = size
+            self._total_bytes += size
+            self._evict()
+        return data_path
+
+    def discard(self, key):
+        digest, _, _ = self._paths(key)
+        with self._lock:
+            self._remove(digest)
+
+    def _remove(self, digest):
+        size = self._entries.pop(digest, None)
+        if size is not None:
+            self._total_bytes -= size
+        base = os.path.join(self.root, digest)
+        for path in (base + ".bin", base + ".json"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def shrink(self, target_bytes):
+        """按 LRU 顺序淘汰条目，直到总大小不超过 target_bytes"""
+        with self._lock:
+            self._evict(target_bytes)
+
+    def _evict(self, limit=None):
+        limit = self.max_bytes if limit is None else limit
+        if self._total_bytes <= limit:
+            return
+        def last_used(digest):
+            try:
+                return os.path.getmtime(os.path.join(self.root, digest + ".bin"))
+            except OSError:
+                return 0
+        for digest in sorted(self._entries, key=last_used):
+            if self._total_bytes <= limit:
+                break
+            logger.info(f"🧹 缓存淘汰: {digest[:12]}... ({self._entries[digest]} bytes)")
+            self._remove(digest)
+
+
+def link_or_copy(src_path, dest_path):
+    """硬链接 src_path 到 dest_path（跨文件系统时退化为复制）"""
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+    try:
+        os.link(src_path, dest_path)
+    except OSError:
+        shutil.copyfile(src_path, dest_path)
+    return dest_path
+
+
+# 输入文件缓存：同一个驱动视频/参考图被大量任务复用时直接从本地磁盘读取
+input_cache = DiskLRUCache(
+    os.getenv("INPUT_CACHE_DIR", "/tmp/steadydancer_cache/inputs"),
+    int(os.getenv("INPUT_CACHE_MAX_BYTES", str(10 * 1024 ** 3))),
+)
+
+def get_url_validators(headers):
+    """从 HEAD 响应头中取出 ETag / Last-Modified，都没有时返回 None"""
+    if headers is None:
+        return None
+    validators = {
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+    }
+    return validators if any(validators.values()) else None
+
 def process_input(input_data, temp_dir, output_filename, input_type):
     """입력 데이터를 처리하여 파일 경로를 반환하는 함수"""
     if input_type == "path":
@@ -41,60 +299,487 @@ def process_input(input_data, temp_dir, output_filename, input_type):
         logger.info(f"🌐 URL 입력 처리: {input_data}")
         os.makedirs(temp_dir, exist_ok=True)
         file_path = os.path.abspath(os.path.join(temp_dir, output_filename))
-        return download_file_from_url(input_data, file_path)
+        headers = head_url(input_data)
+        if not input_cache.enabled:
+            return download_file_from_url(input_data, file_path, headers)
+        # 缓存键为 URL，命中后还要用 ETag/Last-Modified 确认远端内容没有变化
+        validators = get_url_validators(headers)
+        cached = input_cache.get(f"url:{input_data}")
+        if cached and validators and all(cached[1].get(k) == v for k, v in validators.items()):
+            logger.info(f"⚡ 输入缓存命中 (URL): {input_data}")
+            return link_or_copy(cached[0], file_path)
+        download_file_from_url(input_data, file_path, headers)
+        if validators:
+            input_cache.put(f"url:{input_data}", file_path, validators)
+        return file_path
     elif input_type == "base64":
         # Base64인 경우 디코딩하여 저장
         logger.info(f"🔢 Base64 입력 처리")
-        return save_base64_to_file(input_data, temp_dir, output_filename)
+        if not input_cache.enabled:
+            return save_base64_to_file(input_data, temp_dir, output_filename)
+        # 缓存键为 base64 文本的 SHA-256，命中时省去解码和写盘
+        cache_key = "sha256:" + sha256_text(input_data)
+        cached = input_cache.get(cache_key)
+        if cached:
+            logger.info(f"⚡ 输入缓存命中 (base64): {cache_key[:19]}...")
+            os.makedirs(temp_dir, exist_ok=True)
+            return link_or_copy(cached[0], os.path.abspath(os.path.join(temp_dir, output_filename)))
+        file_path = save_base64_to_file(input_data, temp_dir, output_filename)
+        input_cache.put(cache_key, file_path)
+        return file_path
     else:
         raise Exception(f"지원하지 않는 입력 타입: {input_type}")
 
         
-def download_file_from_url(url, output_path):
-    """URL에서 파일을 다운로드하는 함수"""
+# 下载参数：超时（连接, 读取，秒）、重试次数、分片并发下载的分片大小和线程数
+DOWNLOAD_CONNECT_TIMEOUT = float(os.getenv("DOWNLOAD_CONNECT_TIMEOUT", "10"))
+DOWNLOAD_READ_TIMEOUT = float(os.getenv("DOWNLOAD_READ_TIMEOUT", "60"))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "3"))
+DOWNLOAD_CHUNK_BYTES = int(os.getenv("DOWNLOAD_CHUNK_BYTES", str(8 * 1024 * 1024)))
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+
+# 下载共用的 keep-alive 连接池（与 ComfyUI 的连接分开）
+download_session = requests.Session()
+download_session.mount("http://", HTTPAdapter(pool_maxsize=DOWNLOAD_WORKERS * 4))
+download_session.mount("https://", HTTPAdapter(pool_maxsize=DOWNLOAD_WORKERS * 4))
+
+def head_url(url):
+    """HEAD 请求，返回响应头；失败时返回 None（部分预签名 URL 不允许 HEAD）"""
     try:
-        # wget을 사용하여 파일 다운로드
-        result = subprocess.run([
-            'wget', '-O', output_path, '--no-verbose', url
-        ], capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            logger.info(f"✅ URL에서 파일을 성공적으로 다운로드했습니다: {url} -> {output_path}")
+        response = download_session.head(url, allow_redirects=True, timeout=(DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT))
+        if response.status_code >= 400:
+            return None
+        return response.headers
+    except Exception as e:
+        logger.debug(f"HEAD 请求失败 {url}: {e}")
+        return None
+
+def _download_range(url, part_path, start, end):
+    headers = {"Range": f"bytes={start}-{end}"}
+    timeout = (DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)
+    with download_session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code != 206:
+            raise Exception(f"Range 请求未被支持 (HTTP {response.status_code})")
+        with open(part_path, 'r+b') as f:
+            f.seek(start)
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+            if f.tell() != end + 1:
+                raise Exception(f"分片 {start}-{end} 数据不完整")
+
+def _download_once(url, part_path, headers):
+    size = int(headers.get("Content-Length") or 0) if headers else 0
+    ranged = headers is not None and headers.get("Accept-Ranges") == "bytes" and size >= 2 * DOWNLOAD_CHUNK_BYTES
+    if ranged:
+        # 大文件：预分配后按 Range 分片并发下载
+        with open(part_path, 'wb') as f:
+            f.truncate(size)
+        ranges = [(start, min(start + DOWNLOAD_CHUNK_BYTES, size) - 1) for start in range(0, size, DOWNLOAD_CHUNK_BYTES)]
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            for future in [executor.submit(_download_range, url, part_path, start, end) for start, end in ranges]:
+                future.result()
+        return
+    with download_session.get(url, stream=True, timeout=(DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)) as response:
+        response.raise_for_status()
+        with open(part_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+
+def download_file_from_url(url, output_path, headers=None):
+    """URL에서 파일을 다운로드하는 함수 (连接复用、大文件分片并发、超时和指数退避重试)"""
+    if headers is None:
+        headers = head_url(url)
+    part_path = f"{output_path}.part"
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            started = time.time()
+            _download_once(url, part_path, headers)
+            os.replace(part_path, output_path)
+            logger.info(f"✅ URL에서 파일을 성공적으로 다운로드했습니다: {url} -> {output_path} ({time.time() - started:.1f}s)")
             return output_path
-        else:
-            logger.error(f"❌ wget 다운로드 실패: {result.stderr}")
-            raise Exception(f"URL 다운로드 실패: {result.stderr}")
-    except subprocess.TimeoutExpired:
-        logger.error("❌ 다운로드 시간 초과")
-        raise Exception("다운로드 시간 초과")
+        except Exception as e:
+            if attempt == DOWNLOAD_RETRIES:
+                logger.error(f"❌ 다운로드 중 오류 발생: {e}")
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                raise Exception(f"URL 다운로드 실패: {e}")
+            delay = 2 ** attempt
+            logger.warning(f"⚠️ 下载失败 (第 {attempt + 1} 次)，{delay}s 后重试: {e}")
+            time.sleep(delay)
+            # 分片下载失败（如服务端不支持 Range）时改用普通下载重试
+            headers = None
+
+
+def stage_inputs(job_input, temp_dir, specs):
+    """
+    并发准备任务的所有输入文件
+
+    specs: [(name, output_filename), ...]，按 <name>_path / <name>_url / <name>_base64
+    的优先级取输入。返回 {name: 本地路径或 None}。
+    """
+    staged = {name: None for name, _ in specs}
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max(len(specs), 1)) as executor:
+        for name, output_filename in specs:
+            for input_type in ("path", "url", "base64"):
+                value = job_input.get(f"{name}_{input_type}")
+                if value:
+                    futures[name] = executor.submit(process_input, value, temp_dir, output_filename, input_type)
+                    break
+        for name, future in futures.items():
+            staged[name] = future.result()
+    return staged
+
+# base64 输入解码后的大小上限，以及分块解码时每块的字符数（4 的倍数）
+MAX_BASE64_INPUT_BYTES = int(os.getenv("MAX_BASE64_INPUT_BYTES", str(512 * 1024 * 1024)))
+BASE64_DECODE_CHUNK_CHARS = 4 * 1024 * 1024
+
+def _iter_text_chunks(text, chunk_chars=BASE64_DECODE_CHUNK_CHARS):
+    for start in range(0, len(text), chunk_chars):
+        yield text[start:start + chunk_chars]
+
+def sha256_text(text):
+    """分块计算字符串的 SHA-256（避免一次性 encode 出整份副本）"""
+    digest = hashlib.sha256()
+    for chunk in _iter_text_chunks(text):
+        digest.update(chunk.encode('utf-8'))
+    return digest.hexdigest()
+
+# 单次生成的计算量上限，以潜空间 token 数计（宽/16 × 高/16 × ((帧数-1)/4+1)）
+# 默认值对应 1280×720×81 帧，可按 GPU 显存调整
+MAX_LATENT_TOKENS = int(os.getenv("MAX_LATENT_TOKENS", str(80 * 45 * 21)))
+# 每千个潜空间 token、每个采样步的大致耗时（秒），仅用于日志中的耗时估算
+SECONDS_PER_KILO_TOKEN_STEP = float(os.getenv("SECONDS_PER_KILO_TOKEN_STEP", "0.3"))
+
+def probe_image(image_path):
+    """只读取图像文件头，返回 {width, height, format}；文件不可读时抛出异常"""
+    from PIL import Image
+    try:
+        with Image.open(image_path) as img:
+            width, height = img.size
+            image_format = img.format
+            img.verify()
     except Exception as e:
-        logger.error(f"❌ 다운로드 중 오류 발생: {e}")
-        raise Exception(f"다운로드 중 오류 발생: {e}")
+        raise JobError("BAD_INPUT", f"输入图像无法读取 ({image_path}): {e}")
+    if not width or not height:
+        raise JobError("BAD_INPUT", f"输入图像尺寸无效 ({image_path}): {width}x{height}")
+    return {"width": width, "height": height, "format": image_format}
+
+def probe_video(video_path):
+    """读取视频容器信息（尺寸、帧数、fps、编码），只解码第一帧确认编码可用"""
+    import cv2
+    capture = cv2.VideoCapture(video_path)
+    try:
+        if not capture.isOpened():
+            raise JobError("BAD_INPUT", f"输入视频无法打开 ({video_path})，请确认文件完整且为 mp4/webm 等常见格式")
+        fourcc = int(capture.get(cv2.CAP_PROP_FOURCC))
+        info = {
+            "width": int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            "height": int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            "frame_count": int(capture.get(cv2.CAP_PROP_FRAME_COUNT)),
+            "fps": round(capture.get(cv2.CAP_PROP_FPS), 2),
+            "codec": "".join(chr((fourcc >> (8 * i)) & 0xFF) for i in range(4)).strip("\x00 "),
+        }
+        ok, _ = capture.read()
+        if not ok:
+            raise JobError("BAD_INPUT", f"输入视频无法解码 ({video_path}, codec={info['codec'] or 'unknown'})")
+    finally:
+        capture.release()
+    return info
+
+def estimate_latent_tokens(width, height, length):
+    """Wan 模型的潜空间 token 数：VAE 空间 8 倍 × patch 2 倍下采样，时间 4 倍下采样"""
+    return (width // 16) * (height // 16) * ((max(length, 1) - 1) // 4 + 1)
+
+def validate_job_inputs(job_input, image_path, video_path=None, video_info=None):
+    """
+    在提交到 ComfyUI 之前快速校验输入，坏任务在毫秒级失败而不是等几分钟
+
+    - 读取图像/视频文件头，检查能否打开、尺寸、帧数、编码
+    - 按 width × height × length 估算计算量，超过 MAX_LATENT_TOKENS 时拒绝，
+      或在 auto_downscale=True 时按原宽高比缩小分辨率
+    video_info 为已探测过的视频信息（批量任务共用同一个驱动视频时只探测一次）。
+    返回（可能更新了 width/height 的）job_input 副本。
+    """
+    started = time.time()
+    image_info = probe_image(image_path)
+    logger.info(f"🔎 输入图像: {image_info['width']}x{image_info['height']} ({image_info['format']})")
+
+    length = job_input.get("length", 81)
+    if video_path:
+        video_info = video_info or probe_video(video_path)
+        logger.info(f"🔎 输入视频: {video_info['width']}x{video_info['height']}, {video_info['frame_count']} 帧, {video_info['fps']} fps, codec={video_info['codec']}")
+        if video_info["frame_count"] and video_info["frame_count"] < length:
+            logger.warning(f"⚠️ 输入视频只有 {video_info['frame_count']} 帧，少于 length={length}")
 
+    width = to_nearest_multiple_of_16(job_input.get("width", 480))
+    height = to_nearest_multiple_of_16(job_input.get("height", 832))
+    tokens = estimate_latent_tokens(width, height, length)
+    if tokens > MAX_LATENT_TOKENS:
+        if not job_input.get("auto_downscale", False):
+            raise JobError(
+                "BAD_INPUT",
+                f"任务计算量过大: {width}x{height}x{length} 帧约 {tokens} 个潜空间 token，"
+                f"上限 {MAX_LATENT_TOKENS}。请降低分辨率/帧数，或设置 auto_downscale=true"
+            )
+        scale = (MAX_LATENT_TOKENS / tokens) ** 0.5
+        new_width = max(16, int(width * scale) // 16 * 16)
+        new_height = max(16, int(height * scale) // 16 * 16)
+        logger.warning(f"⚠️ 计算量超过上限，自动降低分辨率: {width}x{height} -> {new_width}x{new_height}")
+        job_input = dict(job_input, width=new_width, height=new_height)
+        tokens = estimate_latent_tokens(new_width, new_height, length)
+
+    logger.info(f"🔎 输入校验通过 ({(time.time() - started) * 1000:.0f} ms)，约 {tokens} 个潜空间 token，预计每步采样 ~{tokens / 1000 * SECONDS_PER_KILO_TOKEN_STEP:.1f}s")
+    return job_input
 
 def save_base64_to_file(base64_data, temp_dir, output_filename):
-    """Base64 데이터를 파일로 저장하는 함수"""
+    """Base64 데이터를 파일로 저장하는 함수 (分块解码并直接写盘，内存占用与输入大小无关)"""
+    # 兼容 data URI 前缀（data:video/mp4;base64,...）
+    if base64_data.startswith("data:"):
+        base64_data = base64_data[base64_data.find(",") + 1:]
+    estimated_size = len(base64_data) * 3 // 4
+    if estimated_size > MAX_BASE64_INPUT_BYTES:
+        raise JobError(
+            "BAD_INPUT",
+            f"Base64 输入过大: 约 {estimated_size / 1024 / 1024:.1f} MB，上限 "
+            f"{MAX_BASE64_INPUT_BYTES / 1024 / 1024:.1f} MB，请改用 URL 输入"
+        )
+
+    # 디렉토리가 존재하지 않으면 생성
+    os.makedirs(temp_dir, exist_ok=True)
+    file_path = os.path.abspath(os.path.join(temp_dir, output_filename))
     try:
-        # Base64 문자열 디코딩
-        decoded_data = base64.b64decode(base64_data)
-        
-        # 디렉토리가 존재하지 않으면 생성
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # 파일로 저장
-        file_path = os.path.abspath(os.path.join(temp_dir, output_filename))
         with open(file_path, 'wb') as f:
-            f.write(decoded_data)
-        
-        logger.info(f"✅ Base64 입력을 '{file_path}' 파일로 저장했습니다.")
-        return file_path
+            pending = ""
+            padded = False
+            for chunk in _iter_text_chunks(base64_data):
+                # 去掉换行等空白后按 4 字符对齐解码，余下的留到下一块
+                pending += "".join(chunk.split())
+                aligned = len(pending) - len(pending) % 4
+                if aligned:
+                    piece = pending[:aligned]
+                    # 填充符 "=" 只能出现在数据末尾
+                    if padded or "=" in piece.rstrip("="):
+                        raise ValueError("Base64 数据中间出现填充符 '='")
+                    padded = piece.endswith("=")
+                    f.write(base64.b64decode(piece, validate=True))
+                    pending = pending[aligned:]
+            if pending:
+                raise ValueError(f"Base64 长度不是 4 的倍数（剩余 {len(pending)} 个字符）")
     except (binascii.Error, ValueError) as e:
+        os.remove(file_path)
         logger.error(f"❌ Base64 디코딩 실패: {e}")
-        raise Exception(f"Base64 디코딩 실패: {e}")
+        raise JobError("BAD_INPUT", f"Base64 디코딩 실패: {e}")
+
+    logger.info(f"✅ Base64 입력을 '{file_path}' 파일로 저장했습니다.")
+    return file_path
     
-def queue_prompt(prompt, is_mega_model=False):
-    url = f"http://{server_address}:8188/prompt"
-    logger.info(f"Queueing prompt to: {url}")
+class ComfyUIConnection:
+    """
+    ComfyUI 后端的长连接管理器（进程内单例）
+
+    - HTTP 请求共用一个 keep-alive 连接池，不再每次新建 urllib 连接
+    - 维护一个长期存在的 WebSocket，后台心跳检测，断开后在下次使用时自动重连
+    - 就绪探测只在第一次连接（或重连失败）时执行，热 worker 上的后续任务直接复用连接
+    - 后台分发线程独占 WebSocket 读取，按 prompt_id 把消息投递给各自的队列，
+      多个并发任务可共用同一个连接
+    """
+
+    def __init__(self, host, port=8188):
+        self.http_base = f"http://{host}:{port}"
+        self.ws_url = f"ws://{host}:{port}/ws?clientId={client_id}"
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=int(os.getenv("COMFY_HTTP_POOL_SIZE", "8")))
+        self.session.mount("http://", adapter)
+        self.heartbeat_interval = float(os.getenv("COMFY_WS_HEARTBEAT", "30"))
+        self._ws = None
+        self._ws_lock = threading.Lock()
+        self._ready = False
+        self._heartbeat_thread = None
+        self._subscribers = {}  # {prompt_id: queue.Queue}
+        # 订阅之前到达的消息暂存在这里（按 prompt_id，数量有上限）
+        self._backlog = OrderedDict()
+        self._subscribers_lock = threading.Lock()
+        self._dispatcher_thread = None
+
+    def get(self, path, timeout=30, **kwargs):
+        response = self.session.get(f"{self.http_base}{path}", timeout=timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def post(self, path, timeout=30, **kwargs):
+        return self.session.post(f"{self.http_base}{path}", timeout=timeout, **kwargs)
+
+    def get_json(self, path, timeout=30):
+        return self.get(path, timeout=timeout).json()
+
+    def wait_until_ready(self, max_attempts=180):
+        """等待 ComfyUI HTTP 服务可用（已确认就绪时直接返回）"""
+        if self._ready:
+            return
+        logger.info(f"Checking HTTP connection to: {self.http_base}/")
+        for attempt in range(max_attempts):
+            try:
+                self.get("/", timeout=5)
+                logger.info(f"HTTP 연결 성공 (시도 {attempt+1})")
+                self._ready = True
+                return
+            except Exception as e:
+                logger.warning(f"HTTP 연결 실패 (시도 {attempt+1}/{max_attempts}): {e}")
+                time.sleep(1)
+        raise Exception("ComfyUI 서버에 연결할 수 없습니다. 서버가 실행 중인지 확인하세요.")
+
+    def get_websocket(self):
+        """返回已连接的 WebSocket，必要时（首次使用或断开后）重新连接"""
+        with self._ws_lock:
+            if self._ws is not None and self._ws.connected:
+                return self._ws
+            self._ws = None
+            self.wait_until_ready()
+            logger.info(f"Connecting to WebSocket: {self.ws_url}")
+            max_attempts = int(180/5)  # 3분
+            for attempt in range(max_attempts):
+                try:
+                    # 心跳线程的 ping 与分发线程 recv 中自动回复的 pong 会同时写 socket，需要加锁
+                    ws = websocket.WebSocket(enable_multithread=True)
+                    ws.connect(self.ws_url)
+                    logger.info(f"웹소켓 연결 성공 (시도 {attempt+1})")
+                    self._ws = ws
+                    break
+                except Exception as e:
+                    logger.warning(f"웹소켓 연결 실패 (시도 {attempt+1}/{max_attempts}): {e}")
+                    if attempt == max_attempts - 1:
+                        # 下次重新做就绪探测（ComfyUI 可能已重启）
+                        self._ready = False
+                        raise Exception("웹소켓 연결 시간 초과 (3분)")
+                    time.sleep(5)
+            self._start_heartbeat()
+            return self._ws
+
+    def invalidate_websocket(self):
+        """关闭当前 WebSocket，下次 get_websocket() 时重新连接"""
+        with self._ws_lock:
+            if self._ws is not None:
+                try:
+                    self._ws.close()
+                except Exception:
+                    pass
+            self._ws = None
+
+    def start(self):
+        """启动后台分发线程（会建立 WebSocket 连接）"""
+        self._start_dispatcher()
+
+    def websocket_connected(self):
+        ws = self._ws
+        return ws is not None and ws.connected
+
+    def subscribe(self, prompt_id):
+        """注册 prompt_id 的消息队列（会补投订阅前已到达的消息）"""
+        messages = queue.Queue()
+        with self._subscribers_lock:
+            self._subscribers[prompt_id] = messages
+            for message in self._backlog.pop(prompt_id, ()):
+                messages.put(message)
+        self._start_dispatcher()
+        return messages
+
+    def unsubscribe(self, prompt_id):
+        with self._subscribers_lock:
+            self._subscribers.pop(prompt_id, None)
+            self._backlog.pop(prompt_id, None)
+
+    def wait_message(self, prompt_id, messages, poll_interval=30, cancel=None):
+        """
+        取出 prompt 的下一条消息
+
+        长时间没有消息或 WebSocket 中断时查询 /history，任务已结束则返回 None，
+        避免因丢失 "executing: None" 消息而永久阻塞。
+        给出 cancel 时每秒检查一次，任务被取消或超时会抛出 JobCancelled。
+        """
+        last_poll = time.time()
+        while True:
+            if cancel is not None:
+                cancel.check()
+            try:
+                message = messages.get(timeout=1 if cancel is not None else poll_interval)
+                if message.get('type') != '_connection_lost':
+                    return message
+            except queue.Empty:
+                if time.time() - last_poll < poll_interval:
+                    continue
+            last_poll = time.time()
+            try:
+                if prompt_id in self.get_json(f"/history/{prompt_id}"):
+                    logger.info(f"通过 /history 确认 prompt {prompt_id} 已结束")
+                    return None
+            except Exception as e:
+                logger.warning(f"查询 /history/{prompt_id} 失败: {e}")
+
+    def _start_dispatcher(self):
+        with self._subscribers_lock:
+            if self._dispatcher_thread and self._dispatcher_thread.is_alive():
+                return
+            self._dispatcher_thread = threading.Thread(target=self._dispatch_loop, name="comfyui-ws-dispatcher", daemon=True)
+            self._dispatcher_thread.start()
+
+    def _dispatch_loop(self):
+        while True:
+            try:
+                out = self.get_websocket().recv()
+            except Exception as e:
+                logger.warning(f"WebSocket 读取失败，准备重连: {e}")
+                self.invalidate_websocket()
+                # 通知所有等待中的任务改为通过 /history 确认状态
+                with self._subscribers_lock:
+                    for messages in self._subscribers.values():
+                        messages.put({'type': '_connection_lost', 'data': {}})
+                time.sleep(1)
+                continue
+            if not isinstance(out, str):
+                continue  # 预览图等二进制消息
+            try:
+                message = json.loads(out)
+            except ValueError:
+                continue
+            data = message.get('data')
+            prompt_id = data.get('prompt_id') if isinstance(data, dict) else None
+            if prompt_id is None:
+                continue  # status 等全局消息
+            with self._subscribers_lock:
+                messages = self._subscribers.get(prompt_id)
+                if messages is None:
+                    backlog = self._backlog.setdefault(prompt_id, deque(maxlen=256))
+                    backlog.append(message)
+                    while len(self._backlog) > 32:
+                        self._backlog.popitem(last=False)
+                    continue
+            messages.put(message)
+
+    def _start_heartbeat(self):
+        if self.heartbeat_interval <= 0 or (self._heartbeat_thread and self._heartbeat_thread.is_alive()):
+            return
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name="comfyui-ws-heartbeat", daemon=True)
+        self._heartbeat_thread.start()
+
+    def _heartbeat_loop(self):
+        # 定期发送 ping，连接失效时丢弃，下一个任务会自动重连
+        while True:
+            time.sleep(self.heartbeat_interval)
+            ws = self._ws
+            if ws is None:
+                continue
+            try:
+                ws.ping()
+            except Exception as e:
+                logger.warning(f"WebSocket 心跳失败，将在下次使用时重连: {e}")
+                self.invalidate_websocket()
+
+
+comfy = ComfyUIConnection(server_address)
+
+def queue_prompt(prompt, is_mega_model=False, prompt_id=None):
+    logger.info(f"Queueing prompt to: {comfy.http_base}/prompt")
     if is_mega_model:
         # RapidAIO Mega (V2.5).json 验证
         if "597" in prompt and "widgets_values" in prompt["597"]:
@@ -116,48 +801,361 @@ def queue_prompt(prompt, is_mega_model=False):
             logger.info(f"  节点244的image = {image_path_check}")
     
     p = {"prompt": prompt, "client_id": client_id}
-    data = json.dumps(p).encode('utf-8')
-    req = urllib_request.Request(url, data=data)
-    req.add_header('Content-Type', 'application/json')
-    try:
-        response = urllib_request.urlopen(req)
-        return json.loads(response.read())
-    except urllib_error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        logger.error(f"HTTP Error {e.code}: {e.reason}")
+    if prompt_id:
+        p["prompt_id"] = prompt_id
+    response = comfy.post("/prompt", json=p)
+    if response.status_code >= 400:
+        error_body = response.text
+        logger.error(f"HTTP Error {response.status_code}: {response.reason}")
         logger.error(f"Error response: {error_body}")
         try:
             error_json = json.loads(error_body)
             logger.error(f"Error details: {json.dumps(error_json, indent=2)}")
         except:
             pass
-        raise Exception(f"ComfyUI API 错误 ({e.code}): {error_body}")
+        error = classify_error("", error_body)
+        raise JobError(error.code, f"ComfyUI API 错误 ({response.status_code}): {error_body}")
+    return response.json()
 
-def get_image(filename, subfolder, folder_type):
-    url = f"http://{server_address}:8188/view"
-    logger.info(f"Getting image from: {url}")
+def download_output_file(filename, subfolder, folder_type, dest_dir):
+    """通过 /view 把输出文件流式下载到 dest_dir（不在内存中保留整个文件）"""
+    logger.info(f"Downloading output from: {comfy.http_base}/view")
     data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-    url_values = urllib_parse.urlencode(data)
-    with urllib_request.urlopen(f"{url}?{url_values}") as response:
-        return response.read()
+    os.makedirs(dest_dir, exist_ok=True)
+    file_path = os.path.abspath(os.path.join(dest_dir, os.path.basename(filename)))
+    with comfy.get("/view", params=data, timeout=300, stream=True) as response:
+        with open(file_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+    return file_path
 
 def get_history(prompt_id):
-    url = f"http://{server_address}:8188/history/{prompt_id}"
-    logger.info(f"Getting history from: {url}")
-    with urllib_request.urlopen(url) as response:
-        return json.loads(response.read())
+    logger.info(f"Getting history from: {comfy.http_base}/history/{prompt_id}")
+    return comfy.get_json(f"/history/{prompt_id}")
+
+# 进度上报的最小间隔（秒），0 表示每条消息都上报
+PROGRESS_UPDATE_INTERVAL = float(os.getenv("PROGRESS_UPDATE_INTERVAL", "2"))
+
+# 任务的默认最长执行时间（秒），0 表示不限制；job input 中的 timeout 优先
+JOB_TIMEOUT = float(os.getenv("JOB_TIMEOUT", "0"))
 
-def get_videos(ws, prompt, is_mega_model=False):
-    prompt_id = queue_prompt(prompt, is_mega_model)['prompt_id']
+class JobCancelled(Exception):
+    """任务被取消或超过截止时间"""
+
+def resolve_job_timeout(job_input):
+    """job input 中的 timeout（秒，可以是数字字符串），未指定时使用 JOB_TIMEOUT；返回 None 表示不限制"""
+    timeout = job_input.get("timeout")
+    if timeout is None:
+        return JOB_TIMEOUT or None
+    try:
+        if isinstance(timeout, bool):
+            raise ValueError(timeout)
+        timeout = float(timeout)
+    except (TypeError, ValueError):
+        raise JobError("BAD_INPUT", f"timeout 必须是秒数: {timeout!r}")
+    if not timeout > 0:
+        raise JobError("BAD_INPUT", f"timeout 必须大于 0: {timeout}")
+    return timeout
+
+class CancelToken:
+    """
+    单个任务的取消信号：RunPod 取消（异步入口）时调用 cancel()，或超过截止时间
+
+    等待 ComfyUI 的循环会定期 check()；add_cleanup() 登记的任务目录和输出文件
+    在任务结束（完成、失败或取消）时由 cleanup() 删除。
+    """
+
+    def __init__(self, timeout=None):
+        self._event = threading.Event()
+        self.reason = None
+        self.set_timeout(timeout)
+        self._cleanup_paths = []
+
+    def set_timeout(self, timeout):
+        """从现在起 timeout 秒后视为超时，None/0 表示不限制"""
+        self.deadline = time.time() + timeout if timeout else None
+
+    def cancel(self, reason="cancelled"):
+        self.reason = reason
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        if self.deadline is not None and time.time() > self.deadline and not self.cancelled:
+            self.cancel("timeout")
+        if self.cancelled:
+            raise JobCancelled(f"任务已{'超时' if self.reason == 'timeout' else '取消'}")
+
+    def add_cleanup(self, path):
+        self._cleanup_paths.append(path)
+
+    def cleanup(self):
+        for path in self._cleanup_paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self._cleanup_paths.clear()
+
+
+class WorkerMetrics:
+    """worker 级别的运行指标（任务计数、错误计数、最近一次任务的耗时拆分），供 /metrics 输出"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.jobs_total = {}  # {status: 次数}
+        self.errors_total = {}  # {错误类型: 次数}
+        self.last_job = {}  # {阶段: 秒}
+        self.last_nodes = []  # [(node_id, 秒), ...]
+        self.in_flight = 0
+
+    def job_started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def record_job(self, timer, status, error_type=None):
+        with self._lock:
+            self.in_flight -= 1
+            self.jobs_total[status] = self.jobs_total.get(status, 0) + 1
+            if error_type:
+                self.errors_total[error_type] = self.errors_total.get(error_type, 0) + 1
+            self.last_job = dict(timer.phases, total=round(timer.elapsed(), 3))
+            self.last_nodes = timer.slowest_nodes()
+
+
+# 每个任务的耗时追加写入该 JSONL 文件（为空时不写）
+JOB_TRACE_FILE = os.getenv("JOB_TRACE_FILE", "")
+_trace_lock = threading.Lock()
+
+class JobTimer:
+    """
+    单个任务的分阶段计时
+
+    lap(name) 记录从上一个计时点到现在的耗时，各阶段首尾相接，加起来等于总耗时；
+    nodes 记录 ComfyUI 各节点的执行耗时（来自 WebSocket 的 executing 消息）。
+    """
+
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        self.started = time.time()
+        self._mark = self.started
+        self.phases = {}
+        self.nodes = {}
+
+    def lap(self, name, until=None):
+        now = time.time() if until is None else until
+        self.phases[name] = round(self.phases.get(name, 0) + max(now - self._mark, 0), 3)
+        self._mark = now
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def slowest_nodes(self, limit=5):
+        return sorted(self.nodes.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def as_dict(self):
+        return {"total": round(self.elapsed(), 3), "phases": dict(self.phases), "nodes": dict(self.nodes)}
+
+    def write_trace(self, status):
+        if not JOB_TRACE_FILE:
+            return
+        record = dict(self.as_dict(), job_id=self.job_id, status=status, timestamp=self.started)
+        try:
+            with _trace_lock, open(JOB_TRACE_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            logger.warning(f"写入任务耗时记录失败: {e}")
+
+
+worker_metrics = WorkerMetrics()
+
+class ProgressTracker:
+    """
+    把 ComfyUI 的 executing/progress/execution_cached 消息整理成结构化进度，
+    通过 runpod.serverless.progress_update 推送给调用方（带节流）
+
+    上报内容: node, step, total, nodes_done, nodes_total, elapsed, eta（秒）
+    eta 按当前节点（一般是采样器）的步速估算，无法估算时为 None
+    """
+
+    def __init__(self, job, prompt_id, nodes_total):
+        self.job = job
+        self.prompt_id = prompt_id
+        self.nodes_total = nodes_total
+        self.started = time.time()
+        self.node = None
+        self.step = None
+        self.total = None
+        self.step_started = None
+        self.nodes_done = set()
+        self.node_started = None
+        self.node_durations = {}  # {node_id: 秒}
+        self.execution_started = None  # ComfyUI 开始执行（排队结束）的时间
+        self._last_sent = 0.0
+
+    def handle(self, message):
+        msg_type = message.get('type')
+        data = message.get('data') or {}
+        if self.execution_started is None and (
+            msg_type in ('execution_start', 'execution_cached', 'progress')
+            or (msg_type == 'executing' and data.get('node') is not None)
+        ):
+            # execution_start 可能丢失（WS 重连）；以第一条执行相关消息为准，executing: None 是结束信号不算
+            self.execution_started = time.time()
+        if msg_type == 'execution_cached':
+            self.nodes_done.update(str(n) for n in data.get('nodes') or ())
+        elif msg_type == 'executing':
+            now = time.time()
+            if self.node is not None:
+                self.nodes_done.add(self.node)
+                self.node_durations[self.node] = round(now - self.node_started, 2)
+            node = data.get('node')
+            self.node = str(node) if node is not None else None
+            self.node_started = now
+            self.step = self.total = self.step_started = None
+            if self.node is not None:
+                self.send()
+        elif msg_type == 'progress':
+            self.step = data.get('value')
+            self.total = data.get('max')
+            if self.step_started is None:
+                self.step_started = time.time()
+            self.send(force=self.step == self.total)
+
+    def snapshot(self):
+        now = time.time()
+        eta = None
+        if self.step and self.total and self.step_started is not None and self.step > 1:
+            # 第一步包含模型加载等开销，从第一步之后开始计算步速
+            per_step = (now - self.step_started) / (self.step - 1)
+            eta = round(per_step * (self.total - self.step), 1)
+        return {
+            "prompt_id": self.prompt_id,
+            "node": self.node,
+            "step": self.step,
+            "total": self.total,
+            "nodes_done": len(self.nodes_done),
+            "nodes_total": self.nodes_total,
+            "elapsed": round(now - self.started, 1),
+            "eta": eta,
+        }
+
+    def slowest_nodes(self, limit=5):
+        return sorted(self.node_durations.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def send(self, force=False):
+        if not self.job or self.job.get("warmup"):
+            return
+        now = time.time()
+        if not force and now - self._last_sent < PROGRESS_UPDATE_INTERVAL:
+            return
+        self._last_sent = now
+        try:
+            runpod.serverless.progress_update(self.job, self.snapshot())
+        except Exception as e:
+            logger.debug(f"进度上报失败: {e}")
+
+def with_unique_output_prefix(prompt, tag):
+    """
+    给所有带 filename_prefix 的输出节点加上本次提交的标记（返回副本，不修改原 prompt）
+
+    任务结束后输出文件会被删除（CLEANUP_COMFY_OUTPUTS），而 ComfyUI 仍缓存着节点输出；
+    相同 prompt 再次提交时输出节点会直接命中缓存，返回指向已删除文件的 history。
+    前缀每次不同，输出节点总会重新执行（上游节点仍然复用缓存）。结果指纹在此之前计算，不受影响。
+    """
+    prompt = dict(prompt)
+    for node_id, node in list(prompt.items()):
+        prefix = node.get("inputs", {}).get("filename_prefix") if isinstance(node, dict) else None
+        if isinstance(prefix, str):
+            prompt[node_id] = dict(node, inputs=dict(node["inputs"], filename_prefix=f"{prefix}_{tag}"))
+        elif isinstance(prefix, list) and prefix:
+            # 前缀来自字符串节点的连线（如 MEGA workflow 的节点 595），改上游节点的值
+            source_id = str(prefix[0])
+            source = prompt.get(source_id)
+            value = source.get("inputs", {}).get("value") if isinstance(source, dict) else None
+            if isinstance(value, str) and not value.endswith(f"_{tag}"):
+                prompt[source_id] = dict(source, inputs=dict(source["inputs"], value=f"{value}_{tag}"))
+    return prompt
+
+def submit_prompt(prompt, is_mega_model=False):
+    """提交 prompt 到 ComfyUI 队列，返回 (prompt_id, 消息队列)"""
+    # 先用客户端生成的 prompt_id 订阅，再提交，保证不会漏掉早到的消息
+    prompt_id = str(uuid.uuid4())
+    prompt = with_unique_output_prefix(prompt, prompt_id[:8])
+    messages = comfy.subscribe(prompt_id)
+    try:
+        queued_id = queue_prompt(prompt, is_mega_model, prompt_id)['prompt_id']
+    except Exception:
+        comfy.unsubscribe(prompt_id)
+        raise
+    if queued_id != prompt_id:
+        # 旧版 ComfyUI 不接受客户端指定的 prompt_id，早到的消息在 backlog 中
+        comfy.unsubscribe(prompt_id)
+        prompt_id = queued_id
+        messages = comfy.subscribe(prompt_id)
+    return prompt_id, messages
+
+def cancel_prompts(prompt_ids):
+    """
+    取消 ComfyUI 中的 prompt：正在执行的调用 /interrupt，排队中的从队列删除
+
+    只有确认正在执行的是自己的 prompt 时才 interrupt，避免打断同一 worker 上其它任务。
+    """
+    prompt_ids = [prompt_id for prompt_id in prompt_ids if prompt_id]
+    if not prompt_ids:
+        return
+    running = set()
+    try:
+        queue_info = comfy.get_json("/queue", timeout=10)
+        running = {item[1] for item in queue_info.get("queue_running", []) if len(item) > 1}
+    except Exception as e:
+        logger.warning(f"获取 ComfyUI 队列失败: {e}")
+    for prompt_id in prompt_ids:
+        if prompt_id in running:
+            try:
+                comfy.post("/interrupt", json={"prompt_id": prompt_id}, timeout=10)
+                logger.info(f"⛔ 已中断正在执行的 prompt: {prompt_id}")
+            except Exception as e:
+                logger.warning(f"中断 prompt {prompt_id} 失败: {e}")
+    pending = [prompt_id for prompt_id in prompt_ids if prompt_id not in running]
+    if pending:
+        try:
+            comfy.post("/queue", json={"delete": pending}, timeout=10)
+            logger.info(f"🗑️ 已从 ComfyUI 队列删除: {pending}")
+        except Exception as e:
+            logger.warning(f"删除排队中的 prompt 失败: {e}")
+    for prompt_id in prompt_ids:
+        comfy.unsubscribe(prompt_id)
+
+def get_videos(prompt, is_mega_model=False, job=None, download_dir=None, timer=None, submitted=None, cancel=None):
+    """
+    提交 prompt 并等待执行完成
+
+    返回 ({node_id: [视频文件路径, ...]}, history)。没有 fullpath 的输出会通过 /view
+    下载到 download_dir（默认系统临时目录）。给出 timer 时记录 queue_submit、
+    queue_wait、execution、output_collect 各阶段和节点耗时。
+    submitted 为 submit_prompt() 的返回值时不再重复提交，只等待结果。
+    cancel（CancelToken）被触发时中断 ComfyUI 中的执行并抛出 JobCancelled。
+    """
+    timer = timer or JobTimer()
+    prompt_id, messages = submitted or submit_prompt(prompt, is_mega_model)
+    timer.lap("queue_submit")
     output_videos = {}
-    error_info = None
-    execution_history = None  # 保存执行历史用于调试
-    node_errors = {}  # 保存每个节点的错误信息 {node_id: error_data}
-    
-    while True:
-        out = ws.recv()
-        if isinstance(out, str):
-            message = json.loads(out)
+    job_error = None
+
+    progress = ProgressTracker(job, prompt_id, len(prompt))
+    try:
+        while True:
+            message = comfy.wait_message(prompt_id, messages, cancel=cancel)
+            if message is None:
+                break
+            progress.handle(message)
             if message['type'] == 'executing':
                 data = message['data']
                 node_id = data.get('node')
@@ -168,180 +1166,35 @@ def get_videos(ws, prompt, is_mega_model=False):
                     logger.info("✅ 所有节点执行完成")
                     break
             elif message['type'] == 'execution_error':
-                # 捕获执行错误
-                error_data = message.get('data', {})
-                error_info = error_data.get('error', 'Unknown execution error')
-                error_type = error_data.get('type', '')
-                node_id = error_data.get('node_id', '')
-                exception_message = error_data.get('exception_message', '')
-                
-                # 保存节点错误信息
-                if node_id:
-                    node_errors[node_id] = {
-                        'error': error_info,
-                        'type': error_type,
-                        'exception_message': exception_message,
-                        'full_data': error_data
-                    }
-                
-                # 输出完整的错误信息（用于调试）
-                logger.error("=" * 60)
-                logger.error(f"❌ 执行错误 - 节点: {node_id}")
-                logger.error(f"   错误类型: {error_type}")
-                logger.error(f"   错误信息: {error_info}")
-                if exception_message:
-                    logger.error(f"   异常详情: {exception_message}")
-                
-                # 对于节点 79 的特殊诊断
-                if node_id == "79":
-                    logger.error("   🔍 节点 79 (ImageConcatMulti) 错误诊断:")
-                    logger.error("      节点 79 用于合并起始帧和姿态图像")
-                    logger.error("      可能原因:")
-                    logger.error("      1. 节点 68 (起始帧) 或节点 77 (姿态图像) 未正确执行")
-                    logger.error("      2. 图像尺寸不匹配（即使设置了 match_image_size=True）")
-                    logger.error("      3. 输入图像格式不正确")
-                    logger.error("      4. match_image_size 参数未正确设置")
-                
-                # 检查是否是 OOM 错误
-                if 'OutOfMemoryError' in str(error_info) or 'OOM' in str(error_info) or ('OutOfMemoryError' in str(exception_message) if exception_message else False):
-                    logger.error("   错误类型: GPU 内存不足 (OOM)")
-                    logger.error("   建议解决方案:")
-                    logger.error("     1. 减小图像分辨率 (width/height)")
-                    logger.error("     2. 减少帧数 (length)")
-                    logger.error("     3. 缩短提示词长度")
-                # 检查是否是参数冲突错误
-                elif 'got multiple values for keyword argument' in str(exception_message) or 'got multiple values for keyword argument' in str(error_info):
-                    keyword_arg = 'is_uncond' if 'is_uncond' in str(exception_message) else 'unknown'
-                    logger.error(f"   错误类型: 参数冲突 ('{keyword_arg}' 被重复传递)")
-                    logger.error("   建议解决方案:")
-                    logger.error(f"     1. Workflow 配置与当前模型版本不兼容")
-                    logger.error(f"     2. 检查 ComfyUI 和 WanVideoWrapper 是否为最新版本")
-                    logger.error(f"     3. 尝试重新生成或更新 workflow JSON 文件")
-                    logger.error(f"     4. 检查节点 {node_id} 的参数配置是否正确")
-                # 检查是否是类型错误
-                elif error_type == 'TypeError' or 'TypeError' in str(exception_message) or 'TypeError' in str(error_info):
-                    logger.error(f"   错误类型: 类型错误 (TypeError)")
-                    logger.error("   建议解决方案:")
-                    logger.error(f"     1. 检查节点 {node_id} 的输入类型是否匹配")
-                    logger.error(f"     2. 检查前置节点的输出格式是否正确")
-                    logger.error(f"     3. 验证 workflow 文件的完整性")
-                # 检查是否是属性错误（可能是输入缺失）
-                elif error_type == 'AttributeError' or 'AttributeError' in str(exception_message) or 'AttributeError' in str(error_info):
-                    logger.error(f"   错误类型: 属性错误 (AttributeError)")
-                    logger.error("   建议解决方案:")
-                    logger.error(f"     1. 检查节点 {node_id} 的输入是否完整")
-                    logger.error(f"     2. 检查前置节点是否正确执行并产生输出")
-                    logger.error(f"     3. 验证输入连接是否正确")
-                else:
-                    logger.error(f"   错误类型: 执行错误")
-                    logger.error(f"   建议: 检查节点 {node_id} 的输入连接和配置")
-                
-                # 输出完整错误数据（不再需要 DEBUG 模式）
-                logger.error(f"   完整错误数据: {json.dumps(error_data, indent=2, ensure_ascii=False)}")
-                logger.error("=" * 60)
-        else:
-            continue
+                # 每条错误消息只做一次常数时间的分类，之后 ComfyUI 会发送 executing: None 结束该 prompt
+                job_error = classify_execution_error(message.get('data', {}))
+                logger.error(f"❌ 执行错误 [{job_error.code}]: {job_error}")
+    except JobCancelled:
+        cancel_prompts([prompt_id])
+        raise
+    finally:
+        comfy.unsubscribe(prompt_id)
+    if progress.execution_started is not None:
+        timer.lap("queue_wait", until=progress.execution_started)
+    timer.lap("execution")
+    timer.nodes.update(progress.node_durations)
+    if progress.node_durations:
+        logger.info(f"⏱️ 耗时最长的节点: {progress.slowest_nodes()}")
 
     history = get_history(prompt_id)[prompt_id]
-    # 将节点错误信息添加到执行历史中
-    if node_errors:
-        history['_node_errors'] = node_errors
-    execution_history = history  # 保存用于调试
-    
-    # 立即输出执行历史的基本信息（用于调试）
-    logger.info("=" * 60)
-    logger.info("📋 执行历史基本信息:")
-    logger.info(f"   执行历史字段: {list(history.keys())}")
-    if 'outputs' in history:
-        output_nodes = list(history['outputs'].keys())
-        logger.info(f"   输出节点数量: {len(output_nodes)}")
-        logger.info(f"   输出节点列表: {sorted(output_nodes, key=lambda x: int(x) if x.isdigit() else 999)}")
-        
-        # 检查关键节点是否在执行历史中（包括节点链：119 -> 118 -> 28 -> 79 -> 115 -> 83）
-        key_nodes = ["119", "118", "28", "79", "115", "83", "117", "91", "71", "63", "72", "82"]
-        logger.info("   关键节点执行状态:")
-        node_errors = history.get('_node_errors', {})
-        for key_node in key_nodes:
-            if key_node in output_nodes:
-                node_output = history['outputs'][key_node]
-                output_keys = list(node_output.keys())
-                logger.info(f"     ✅ 节点 {key_node}: 已执行，输出字段 = {output_keys}")
-            else:
-                # 检查是否有该节点的错误信息
-                if key_node in node_errors:
-                    error_info = node_errors[key_node]
-                    error_type = error_info.get('type', 'Unknown')
-                    logger.error(f"     ❌ 节点 {key_node}: 执行失败 ({error_type})")
-                    # 对于关键节点（118），显示更详细的错误信息
-                    if key_node == "118":
-                        exception_msg = error_info.get('exception_message', '')
-                        if 'is_uncond' in str(exception_msg):
-                            logger.error(f"        ⚠️ 版本兼容性问题: 'is_uncond' 参数冲突")
-                            logger.error(f"        → 这是导致后续节点无法执行的根本原因")
-                else:
-                    logger.error(f"     ❌ 节点 {key_node}: 未执行或不在输出中")
-        
-        # 检查所有执行过的节点，找出哪些节点执行了但不在关键节点列表中
-        all_executed_nodes = set(output_nodes)
-        key_nodes_set = set(key_nodes)
-        other_executed_nodes = all_executed_nodes - key_nodes_set
-        if other_executed_nodes:
-            logger.info(f"   其他已执行的节点: {sorted(other_executed_nodes, key=lambda x: int(x) if x.isdigit() else 999)}")
-    else:
-        logger.warning("   ⚠️ 执行历史中没有 'outputs' 字段")
-    if 'error' in history:
-        logger.error(f"   ❌ 执行历史中有错误信息: {history['error']}")
-    logger.info("=" * 60)
-    
-    # 检查是否有错误信息
-    if 'error' in history:
-        error_info = history['error']
-        error_message = error_info
-        if isinstance(error_info, dict):
-            error_message = error_info.get('message', str(error_info))
-            exception_message = error_info.get('exception_message', '')
-        else:
-            exception_message = str(error_info)
-        
-        # 检查是否是 OOM 错误
-        error_str = str(error_message)
-        if 'OutOfMemoryError' in error_str or 'OOM' in error_str or 'allocation' in error_str.lower():
-            logger.error(f"❌ GPU 内存不足 (OOM) 错误")
-            logger.error(f"错误详情: {error_message}")
-            logger.error("建议解决方案:")
-            logger.error("  1. 减小图像分辨率 (width/height) - 当前值可能过大")
-            logger.error("  2. 减少视频帧数 (length) - 当前值可能过大")
-            logger.error("  3. 缩短提示词长度 - 过长的提示词会消耗更多内存")
-            logger.error("  4. 降低 batch_size (如果可配置)")
-            raise Exception(f"GPU 内存不足 (OOM): {error_message}. 请尝试减小分辨率、帧数或提示词长度。")
-        # 检查是否是参数冲突错误
-        elif 'got multiple values for keyword argument' in exception_message:
-            keyword_arg = 'is_uncond' if 'is_uncond' in exception_message else 'unknown'
-            logger.error(f"❌ 参数冲突错误: '{keyword_arg}' 被重复传递")
-            logger.error(f"错误详情: {exception_message[:200]}...")
-            logger.error("建议解决方案:")
-            logger.error("  1. Workflow 配置文件可能与当前 ComfyUI/模型版本不兼容")
-            logger.error("  2. 尝试更新 ComfyUI 和 ComfyUI-WanVideoWrapper 到最新版本")
-            logger.error("  3. 使用最新的 workflow JSON 配置文件")
-            logger.error("  4. 检查输入参数是否包含不支持的字段")
-            raise Exception(f"Workflow 配置不兼容: '{keyword_arg}' 参数冲突. 请更新 workflow 文件或 ComfyUI 版本。")
-        # 检查是否是类型错误
-        elif 'TypeError' in str(error_info):
-            logger.error(f"❌ 类型错误 (TypeError)")
-            logger.error(f"错误详情: {exception_message[:200] if exception_message else error_message}")
-            logger.error("建议解决方案:")
-            logger.error("  1. 检查输入数据的类型是否正确")
-            logger.error("  2. 验证 workflow 文件的完整性")
-            logger.error("  3. 确认所有模型文件已正确加载")
-            raise Exception(f"类型错误: {error_message}. 请检查输入参数类型。")
-        else:
-            logger.error(f"❌ 执行错误: {error_message}")
-            raise Exception(f"ComfyUI execution error: {error_message}")
-    
-    # 检查 outputs 是否存在
+    if cancel is not None and CLEANUP_COMFY_OUTPUTS:
+        for path in comfy_output_files(history):
+            cancel.add_cleanup(path)
+    execution_history = history
+    # WebSocket 消息丢失时从 history 的状态消息中取错误
+    if job_error is None and history.get('status', {}).get('status_str') == 'error':
+        for event, data in history['status'].get('messages', []):
+            if event == 'execution_error':
+                job_error = classify_execution_error(data)
+                logger.error(f"❌ 执行错误 [{job_error.code}]: {job_error}")
+    if job_error is not None:
+        raise job_error
     if 'outputs' not in history:
-        if error_info:
-            raise Exception(f"ComfyUI execution error: {error_info}")
         raise Exception("No outputs found in execution history")
     
     # 首先输出所有输出节点的基本信息
@@ -378,7 +1231,7 @@ def get_videos(ws, prompt, is_mega_model=False):
         
         if video_list:
             for video in video_list:
-                # fullpath를 이용하여 직접 파일을 읽고 base64로 인코딩
+                # 有 fullpath 时直接使用 ComfyUI 输出目录中的文件
                 if 'fullpath' in video:
                     video_path = video['fullpath']
                     # 检查文件是否存在（save_output=False 的节点不会保存文件）
@@ -388,9 +1241,7 @@ def get_videos(ws, prompt, is_mega_model=False):
                             logger.info(f"🚫 跳过节点 {node_id} 的临时文件: {video_path}")
                             continue
                         
-                        with open(video_path, 'rb') as f:
-                            video_data = base64.b64encode(f.read()).decode('utf-8')
-                        videos_output.append(video_data)
+                        videos_output.append(video_path)
                         logger.info(f"✅ 节点 {node_id} 生成视频: {video_path}")
                     else:
                         logger.warning(f"⚠️ 节点 {node_id} 视频文件不存在（可能 save_output=False）: {video_path}")
@@ -406,9 +1257,8 @@ def get_videos(ws, prompt, is_mega_model=False):
                         continue
                     
                     try:
-                        video_bytes = get_image(filename, subfolder, folder_type)
-                        video_data = base64.b64encode(video_bytes).decode('utf-8')
-                        videos_output.append(video_data)
+                        video_path = download_output_file(filename, subfolder, folder_type, download_dir or tempfile.gettempdir())
+                        videos_output.append(video_path)
                         logger.info(f"✅ 节点 {node_id} 生成视频: {filename}")
                     except Exception as e:
                         logger.warning(f"⚠️ 无法读取节点 {node_id} 的视频文件 {filename}: {e}")
@@ -417,82 +1267,767 @@ def get_videos(ws, prompt, is_mega_model=False):
         
         output_videos[node_id] = videos_output
     
+    timer.lap("output_collect")
     # 返回执行历史信息用于调试
     return output_videos, execution_history
 
-def get_available_models():
-    """获取 ComfyUI 中可用的模型列表"""
+# OOM 时依次尝试的降级措施（逗号分隔，按对画质影响从小到大排列），为空表示不重试
+OOM_FALLBACK_LADDER = [rung.strip() for rung in os.getenv(
+    "OOM_FALLBACK_LADDER", "block_swap,vae_tiling,context_window,lower_resolution"
+).split(",") if rung.strip()]
+# block_swap 降级时交换到 CPU 的 transformer block 数（14B 模型共 40 个）
+OOM_MAX_SWAP_BLOCKS = int(os.getenv("OOM_MAX_SWAP_BLOCKS", "40"))
+# lower_resolution 降级时宽高的缩放比例
+OOM_RESOLUTION_SCALE = float(os.getenv("OOM_RESOLUTION_SCALE", "0.75"))
+
+def _nodes_of_class(prompt, *class_types):
+    """prompt 中 class_type 属于 class_types 的所有节点（不同 workflow 的节点 ID 不同，按类型查找）"""
+    return [node for node in prompt.values() if isinstance(node, dict) and node.get("class_type") in class_types]
+
+def _set_inputs(node, **values):
+    """修改节点已有的 inputs（节点没有的输入不添加），返回是否有值发生变化"""
+    inputs = node.get("inputs", {})
+    changed = {name: value for name, value in values.items() if name in inputs and inputs[name] != value}
+    inputs.update(changed)
+    return bool(changed)
+
+def _fallback_block_swap(prompt):
+    # WanVideoBlockSwap: 把更多 block 和 embedding 放到 CPU
+    return any([
+        _set_inputs(node, blocks_to_swap=OOM_MAX_SWAP_BLOCKS, offload_img_emb=True, offload_txt_emb=True)
+        for node in _nodes_of_class(prompt, "WanVideoBlockSwap")
+    ])
+
+def _fallback_vae_tiling(prompt):
+    # WanVideoDecode/WanVideoEncode 的 enable_vae_tiling，WanVideoImageToVideoEncode 的 tiled_vae
+    changed = [_set_inputs(node, enable_vae_tiling=True) for node in _nodes_of_class(prompt, "WanVideoDecode", "WanVideoEncode")]
+    changed += [_set_inputs(node, tiled_vae=True) for node in _nodes_of_class(prompt, "WanVideoImageToVideoEncode")]
+    return any(changed)
+
+def _fallback_context_window(prompt):
+    # WanVideoContextOptions: 缩短每个上下文窗口的帧数（保持 4n+1）
+    changed = False
+    for node in _nodes_of_class(prompt, "WanVideoContextOptions"):
+        inputs = node.get("inputs", {})
+        context_frames = inputs.get("context_frames")
+        if not isinstance(context_frames, int) or context_frames <= 33:
+            continue
+        context_frames = max(33, (context_frames * 2 // 3 - 1) // 4 * 4 + 1)
+        overlap = inputs.get("context_overlap")
+        overlap = min(overlap, context_frames // 2) if isinstance(overlap, int) else overlap
+        changed = _set_inputs(node, context_frames=context_frames, context_overlap=overlap) or changed
+    return changed
+
+def _fallback_lower_resolution(prompt):
+    # 所有直接给出宽高数值的节点（图像缩放、姿态检测、I2V 编码）按同一比例缩小
+    changed = False
+    for node in prompt.values():
+        inputs = node.get("inputs", {})
+        width, height = inputs.get("width"), inputs.get("height")
+        if isinstance(width, int) and isinstance(height, int) and not isinstance(width, bool):
+            new_size = {
+                "width": max(16, int(width * OOM_RESOLUTION_SCALE) // 16 * 16),
+                "height": max(16, int(height * OOM_RESOLUTION_SCALE) // 16 * 16),
+            }
+            if new_size != {"width": width, "height": height}:
+                inputs.update(new_size)
+                changed = True
+    return changed
+
+OOM_FALLBACKS = {
+    "block_swap": _fallback_block_swap,
+    "vae_tiling": _fallback_vae_tiling,
+    "context_window": _fallback_context_window,
+    "lower_resolution": _fallback_lower_resolution,
+}
+
+def resolve_oom_ladder(job_input):
+    """job input 的 oom_fallback: false 关闭降级重试，也可以传列表或逗号分隔的字符串指定阶梯"""
+    oom_ladder = job_input.get("oom_fallback", True)
+    if oom_ladder is True:
+        oom_ladder = OOM_FALLBACK_LADDER
+    elif isinstance(oom_ladder, str):
+        oom_ladder = [rung.strip() for rung in oom_ladder.split(",") if rung.strip()]
+    return list(oom_ladder or [])
+
+def run_with_oom_fallback(prompt, run, ladder=None):
+    """
+    执行 run(prompt)，遇到 OOM 时按降级阶梯修改 prompt 后重新提交
+
+    每一级在前一级的基础上叠加；对当前 workflow 不起作用的一级直接跳过。
+    返回 (run 的返回值, 已应用的降级措施列表)。
+    """
+    ladder = OOM_FALLBACK_LADDER if ladder is None else ladder
+    unknown = [rung for rung in ladder if rung not in OOM_FALLBACKS]
+    if unknown:
+        raise JobError("BAD_INPUT", f"未知的 OOM 降级措施: {unknown}（可选: {', '.join(OOM_FALLBACKS)}）")
+    applied = []
+    pending = list(ladder)
+    while True:
+        try:
+            return run(prompt), applied
+        except JobError as e:
+            if e.code != "OOM":
+                raise
+            while pending and not OOM_FALLBACKS[pending[0]](prompt):
+                pending.pop(0)
+            if not pending:
+                raise
+            applied.append(pending.pop(0))
+            logger.warning(f"⚠️ GPU 内存不足，降级后重试: {' + '.join(applied)}")
+            try:
+                # 让 ComfyUI 释放缓存的显存后再提交
+                comfy.post("/free", json={"free_memory": True}, timeout=30)
+            except Exception as free_error:
+                logger.debug(f"释放 ComfyUI 显存失败: {free_error}")
+
+# 显式指定 output_mode=base64 时允许的最大文件大小（超过时请改用 url 模式）
+MAX_BASE64_OUTPUT_BYTES = int(os.getenv("MAX_BASE64_OUTPUT_BYTES", str(20 * 1024 * 1024)))
+
+def resolve_output_mode(job_input):
+    """
+    输出方式: "url" 上传到 S3 兼容存储并返回链接，"base64" 内联在响应中
+
+    未指定时，配置了 BUCKET_ENDPOINT_URL 则默认 url，否则保持原来的 base64 行为
+    """
+    output_mode = job_input.get("output_mode")
+    if output_mode is None:
+        output_mode = "url" if os.getenv("BUCKET_ENDPOINT_URL") else "base64"
+    if output_mode not in ("url", "base64"):
+        raise Exception(f"不支持的 output_mode: {output_mode}（可选: url, base64）")
+    return output_mode
+
+def base64_output_limit(job_input):
+    """
+    base64 输出的大小上限：只在调用方显式指定 output_mode=base64 时生效
+
+    未配置对象存储时默认的 base64 输出保持原来不限制大小的行为，
+    避免 GPU 已经跑完的任务因为视频过大而在交付时失败。
+    """
+    return MAX_BASE64_OUTPUT_BYTES if job_input.get("output_mode") == "base64" else None
+
+def deliver_video(video_path, job_id, output_mode, max_base64_bytes=None):
+    """按输出方式交付视频文件，返回 handler 的结果字典"""
+    file_size = os.path.getsize(video_path)
+    if output_mode == "url":
+        # upload_file_to_bucket 内部使用 boto3 分片上传，直接从磁盘流式读取
+        file_name = f"{job_id}{os.path.splitext(video_path)[1] or '.mp4'}"
+        video_url = rp_upload.upload_file_to_bucket(file_name=file_name, file_location=video_path, prefix=job_id)
+        logger.info(f"☁️ 视频已上传 ({file_size / 1024 / 1024:.1f} MB): {video_url}")
+        return {"video_url": video_url}
+    if max_base64_bytes is not None and file_size > max_base64_bytes:
+        raise Exception(
+            f"视频大小 {file_size / 1024 / 1024:.1f} MB 超过 base64 输出上限 "
+            f"{max_base64_bytes / 1024 / 1024:.1f} MB，请配置对象存储并使用 output_mode=url"
+        )
+    with open(video_path, 'rb') as f:
+        return {"video": base64.b64encode(f.read()).decode('utf-8')}
+
+# 结果缓存：相同输入（参考图/视频内容、提示词、seed、步数、分辨率、模型等）直接返回已生成的视频
+result_cache = DiskLRUCache(
+    os.getenv("RESULT_CACHE_DIR", "/tmp/steadydancer_cache/results"),
+    int(os.getenv("RESULT_CACHE_MAX_BYTES", str(20 * 1024 ** 3))),
+    ttl=float(os.getenv("RESULT_CACHE_TTL", str(24 * 3600))),
+)
+# 缓存的上传链接的复用期限（rp_upload 的预签名链接 7 天过期）
+RESULT_URL_TTL = float(os.getenv("RESULT_URL_TTL", str(6 * 24 * 3600)))
+
+def sha256_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def compute_result_fingerprint(prompt, input_files):
+    """
+    根据最终提交给 ComfyUI 的 prompt 计算任务指纹
+
+    prompt 中已经包含提示词、seed、步数、cfg、分辨率和模型名等所有参数；
+    其中的输入文件路径（每个任务目录不同）替换为文件内容的 SHA-256。
+    """
+    file_hashes = {path: f"sha256:{sha256_file(path)}" for path in input_files if path and os.path.isfile(path)}
+
+    def normalize(value):
+        if isinstance(value, dict):
+            return {k: normalize(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [normalize(v) for v in value]
+        if isinstance(value, str):
+            return file_hashes.get(value, value)
+        return value
+
+    payload = json.dumps(normalize(prompt), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def get_cached_result(fingerprint, job_id, output_mode, max_base64_bytes=None):
+    """结果缓存命中时按输出方式交付，未命中返回 None"""
+    cached = result_cache.get(fingerprint)
+    if not cached:
+        return None
+    video_path, meta = cached
+    logger.info(f"⚡ 结果缓存命中: {fingerprint[:16]}...")
+    if output_mode == "url" and meta.get("video_url") and time.time() - meta.get("uploaded", 0) < RESULT_URL_TTL:
+        return {"video_url": meta["video_url"]}
+    result = deliver_video(video_path, job_id, output_mode, max_base64_bytes)
+    if "video_url" in result:
+        result_cache.update_meta(fingerprint, video_url=result["video_url"], uploaded=time.time())
+    return result
+
+def deliver_and_cache_video(video_path, job_id, output_mode, fingerprint=None, max_base64_bytes=None):
+    """交付视频，并在给出指纹时写入结果缓存（上传后的链接一并记录）"""
+    result = deliver_video(video_path, job_id, output_mode, max_base64_bytes)
+    if fingerprint and result_cache.enabled:
+        meta = {"video_url": result["video_url"], "uploaded": time.time()} if "video_url" in result else {}
+        try:
+            result_cache.put(fingerprint, video_path, meta)
+        except OSError as e:
+            logger.warning(f"写入结果缓存失败: {e}")
+    return result
+
+# 任务临时目录的父目录（实际使用其下的 steadydancer_jobs 子目录）；为空时放在输入缓存所在的文件系统上，
+# 缓存关闭时 tmpfs (/dev/shm) 剩余空间足够则放在内存中，否则放在系统临时目录
+WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "")
+# 使用 tmpfs 时 /dev/shm 至少要有的可用空间（任务目录会占用内存）
+WORKSPACE_TMPFS_MIN_FREE_BYTES = int(os.getenv("WORKSPACE_TMPFS_MIN_FREE_BYTES", str(8 * 1024 ** 3)))
+# 缓存所在磁盘至少保留的可用空间，不足时按 LRU 淘汰缓存，0 表示不检查
+DISK_MIN_FREE_BYTES = int(os.getenv("DISK_MIN_FREE_BYTES", str(5 * 1024 ** 3)))
+# 任务结束后删除 ComfyUI 输出/临时目录中该任务生成的文件
+CLEANUP_COMFY_OUTPUTS = os.getenv("CLEANUP_COMFY_OUTPUTS", "true").lower() == "true"
+COMFY_OUTPUT_DIR = os.getenv("COMFY_OUTPUT_DIR", "/ComfyUI/output")
+COMFY_TEMP_DIR = os.getenv("COMFY_TEMP_DIR", "/ComfyUI/temp")
+
+class WorkspaceManager:
+    """
+    每个任务一个临时工作目录（输入、下载的输出、中间文件都放在这里）
+
+    任务结束后整个目录删除；磁盘可用空间不足时按 LRU 淘汰输入/结果缓存，
+    保证长时间运行的 worker 不会慢慢把容器磁盘写满。
+
+    缓存与任务目录之间用硬链接交换文件（link_or_copy），只有在同一文件系统上才不需要复制，
+    因此启用缓存时任务目录默认放在缓存旁边；通过 WORKSPACE_DIR 指定时也应与缓存目录同盘。
+    管理器只使用（和清理）各根目录下名为 steadydancer_jobs 的子目录。
+    """
+
+    DIR_NAME = "steadydancer_jobs"
+    TMPFS_ROOT = os.path.join("/dev/shm", DIR_NAME)
+    STALE_PREFIXES = ("task_", "batch_")
+
+    def __init__(self, root="", caches=()):
+        self.root = os.path.join(root, self.DIR_NAME) if root else ""
+        self.caches = list(caches)
+        self.disk_root = os.path.join(tempfile.gettempdir(), self.DIR_NAME)
+        enabled = [cache for cache in self.caches if cache.enabled]
+        self.cache_root = os.path.join(os.path.dirname(os.path.abspath(enabled[0].root)), self.DIR_NAME) if enabled else ""
+
+    def _pick_root(self):
+        if self.root:
+            return self.root
+        if self.cache_root:
+            return self.cache_root
+        try:
+            if shutil.disk_usage("/dev/shm").free >= WORKSPACE_TMPFS_MIN_FREE_BYTES:
+                return self.TMPFS_ROOT
+        except OSError:
+            pass
+        return self.disk_root
+
+    def purge_stale(self):
+        """清理上次进程异常退出时遗留的任务目录，只在 worker 启动时（接任务之前）调用"""
+        for base in {self.root, self.cache_root, self.TMPFS_ROOT, self.disk_root} - {""}:
+            try:
+                names = os.listdir(base)
+            except OSError:
+                continue
+            for name in names:
+                if name.startswith(self.STALE_PREFIXES):
+                    shutil.rmtree(os.path.join(base, name), ignore_errors=True)
+
+    def create(self, name):
+        """创建任务目录并返回其绝对路径"""
+        path = os.path.join(self._pick_root(), name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def enforce_budget(self):
+        """缓存所在磁盘的可用空间低于 DISK_MIN_FREE_BYTES 时淘汰最久未用的缓存条目"""
+        if DISK_MIN_FREE_BYTES <= 0:
+            return
+        for cache in self.caches:
+            if not cache.enabled or not cache.total_bytes:
+                continue
+            try:
+                free = shutil.disk_usage(cache.root).free
+            except OSError:
+                continue
+            if free < DISK_MIN_FREE_BYTES:
+                shortfall = DISK_MIN_FREE_BYTES - free
+                logger.info(f"🧹 磁盘可用空间不足 ({free / 1024 ** 3:.1f} GB)，淘汰缓存 {cache.root}")
+                cache.shrink(max(0, cache.total_bytes - shortfall))
+
+workspaces = WorkspaceManager(WORKSPACE_DIR, caches=(input_cache, result_cache))
+
+def comfy_output_files(history):
+    """执行历史中所有输出文件（视频、预览图等）在本机 ComfyUI 目录中的路径"""
+    paths = []
+    for node_output in history.get('outputs', {}).values():
+        for key in ('gifs', 'videos', 'images'):
+            for item in node_output.get(key) or []:
+                if not isinstance(item, dict):
+                    continue
+                if item.get('fullpath'):
+                    paths.append(item['fullpath'])
+                elif item.get('filename'):
+                    base_dir = COMFY_TEMP_DIR if item.get('type') == 'temp' else COMFY_OUTPUT_DIR
+                    paths.append(os.path.join(base_dir, item.get('subfolder', ''), item['filename']))
+    return paths
+
+# 多提示词分段生成：片段之间的衔接方式
+#   reference（默认）: 每段都使用原始参考图，所有片段一次性提交，GPU 无空闲，角色和姿态对齐不随片段漂移
+#   chain: 以上一段的最后一帧作为下一段的参考图（衔接处画面连续，但误差逐段累积，片段只能按顺序生成）
+SEGMENT_CONTINUITY_MODES = ("reference", "chain")
+
+def extract_last_frame(video_path, output_path):
+    """把视频的最后一帧保存为图像"""
+    import cv2
+    capture = cv2.VideoCapture(video_path)
     try:
-        url = f"http://{server_address}:8188/object_info"
-        with urllib_request.urlopen(url, timeout=5) as response:
-            object_info = json.loads(response.read())
-            models = []
-            
-            # 首先尝试 WanVideoModelLoader（用于标准 workflow）
-            if "WanVideoModelLoader" in object_info:
-                loader_info = object_info["WanVideoModelLoader"]
-                # 尝试不同的返回格式
-                if "model" in loader_info:
-                    wan_models = loader_info["model"]
-                elif "input" in loader_info and "required" in loader_info["input"]:
-                    if "model" in loader_info["input"]["required"]:
-                        wan_models = loader_info["input"]["required"]["model"]
-                    else:
-                        wan_models = []
-                else:
-                    wan_models = []
-                
-                # 处理嵌套列表的情况
-                if wan_models and isinstance(wan_models, list) and len(wan_models) > 0:
-                    if isinstance(wan_models[0], list):
-                        wan_models = wan_models[0]
-                    wan_models = [m for m in wan_models if isinstance(m, str)]
-                    models.extend(wan_models)
-            
-            # 同时检查 CheckpointLoaderSimple（用于 RapidAIO Mega (V2.5).json）
-            if "CheckpointLoaderSimple" in object_info:
-                loader_info = object_info["CheckpointLoaderSimple"]
-                checkpoint_models = []
-                
-                # 调试：打印 CheckpointLoaderSimple 的结构
-                logger.debug(f"CheckpointLoaderSimple loader_info keys: {list(loader_info.keys())}")
-                
-                # 尝试多种方式获取模型列表
-                if "input" in loader_info:
-                    if "required" in loader_info["input"]:
-                        if "ckpt_name" in loader_info["input"]["required"]:
-                            checkpoint_models = loader_info["input"]["required"]["ckpt_name"]
-                            logger.debug(f"CheckpointLoaderSimple ckpt_name from required: {checkpoint_models}")
-                    # 也检查 optional
-                    if "optional" in loader_info["input"]:
-                        if "ckpt_name" in loader_info["input"]["optional"]:
-                            optional_models = loader_info["input"]["optional"]["ckpt_name"]
-                            logger.debug(f"CheckpointLoaderSimple ckpt_name from optional: {optional_models}")
-                
-                # 直接检查是否有 ckpt_name 字段
-                if "ckpt_name" in loader_info:
-                    checkpoint_models = loader_info["ckpt_name"]
-                    logger.debug(f"CheckpointLoaderSimple ckpt_name direct: {checkpoint_models}")
-                
-                # 处理嵌套列表的情况
-                if checkpoint_models and isinstance(checkpoint_models, list) and len(checkpoint_models) > 0:
-                    if isinstance(checkpoint_models[0], list):
-                        checkpoint_models = checkpoint_models[0]
-                    checkpoint_models = [m for m in checkpoint_models if isinstance(m, str)]
-                    models.extend(checkpoint_models)
-                    logger.info(f"CheckpointLoaderSimple 找到 {len(checkpoint_models)} 个模型: {checkpoint_models}")
-                else:
-                    logger.warning(f"CheckpointLoaderSimple 模型列表为空，可能模型不在标准路径中")
-            
-            # 去重
-            models = list(set(models))
-            
-            if models:
-                logger.info(f"可用模型列表: {models}")
-            return models if models else []
+        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        frame = None
+        if frame_count > 0:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, frame_count - 1)
+            ok, frame = capture.read()
+            if not ok:
+                frame = None
+        if frame is None:
+            # 部分编码不支持精确跳转，退化为顺序读取
+            capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            while True:
+                ok, next_frame = capture.read()
+                if not ok:
+                    break
+                frame = next_frame
+    finally:
+        capture.release()
+    if frame is None:
+        raise Exception(f"无法从片段视频中读取最后一帧: {video_path}")
+    cv2.imwrite(output_path, frame)
+    return os.path.abspath(output_path)
+
+def concat_videos(video_paths, output_path):
+    """用 ffmpeg concat（不重新编码）把片段拼接成完整视频"""
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        import imageio_ffmpeg
+        ffmpeg = imageio_ffmpeg.get_ffmpeg_exe()
+    list_path = f"{output_path}.txt"
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for video_path in video_paths:
+            f.write(f"file '{os.path.abspath(video_path)}'\n")
+    try:
+        result = subprocess.run(
+            [ffmpeg, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", output_path],
+            capture_output=True, text=True, timeout=300,
+        )
+    finally:
+        os.remove(list_path)
+    if result.returncode != 0:
+        raise Exception(f"片段拼接失败: {result.stderr.strip()}")
+    return output_path
+
+def build_segment_prompt(base_prompt, index, positive_prompt, length, base_skip, reference_image=None):
+    """基于完整的 SteadyDancer prompt 生成第 index 段的 prompt"""
+    segment = copy.deepcopy(base_prompt)
+    node_92 = segment.get("92", {})
+    node_92.setdefault("inputs", {})["positive_prompt"] = positive_prompt
+    if isinstance(node_92.get("widgets_values"), list) and len(node_92["widgets_values"]) >= 3:
+        node_92["widgets_values"][2] = positive_prompt
+    # 驱动视频只加载本段对应的帧
+    node_75 = segment.get("75", {})
+    window = {"skip_first_frames": base_skip + index * length, "frame_load_cap": length}
+    node_75.setdefault("inputs", {}).update(window)
+    if isinstance(node_75.get("widgets_values"), dict):
+        node_75["widgets_values"].update(window)
+    node_83 = segment.get("83", {})
+    if "inputs" in node_83:
+        node_83["inputs"]["filename_prefix"] = f"{node_83['inputs'].get('filename_prefix', 'WanVideoWrapper_SteadyDancer')}_seg{index:03d}"
+    if reference_image:
+        node_76 = segment.get("76", {})
+        node_76.setdefault("inputs", {})["image"] = reference_image
+        if isinstance(node_76.get("widgets_values"), list) and node_76["widgets_values"]:
+            node_76["widgets_values"][0] = reference_image
+    return segment
+
+def deliver_segment(job, job_id, index, segments_total, video_path, output_mode, timings):
+    """交付单个片段，并通过 progress_update 通知调用方该片段已可用"""
+    entry = {"segment": index, "segments_total": segments_total, "timings": timings}
+    update = {}
+    if output_mode == "url":
+        entry.update(deliver_video(video_path, f"{job_id}_seg{index:03d}", output_mode))
+    elif os.path.getsize(video_path) <= MAX_BASE64_OUTPUT_BYTES:
+        # base64 模式下片段内容随进度通知下发；最终结果里只保留完整视频，不重复内联各片段
+        update = deliver_video(video_path, f"{job_id}_seg{index:03d}", output_mode)
+    else:
+        logger.warning(
+            f"片段 {index + 1}/{segments_total} 超过 base64 上限，进度通知中不附带视频；"
+            "需要流式获取片段时请使用 output_mode=url"
+        )
+    if job and not job.get("warmup"):
+        try:
+            runpod.serverless.progress_update(job, dict(entry, status="segment_ready", **update))
+        except Exception as e:
+            logger.debug(f"片段进度上报失败: {e}")
+    logger.info(f"🎞️ 片段 {index + 1}/{segments_total} 已交付")
+    return entry
+
+def run_segmented_job(prompt, prompt_lines, job, job_input, task_dir, job_id, output_mode, timer, cancel=None,
+                      video_path=None, fingerprint=None):
+    """
+    多提示词分段生成：每个提示词作为一个独立 prompt（length 帧，对应驱动视频的一段）
+
+    每段完成后立刻在后台线程交付（上传 + progress_update 通知），与下一段的生成重叠，
+    调用方在第一段完成时即可开始播放。全部完成后拼接为完整视频一并返回（给出 fingerprint 时写入结果缓存）。
+    某段 OOM 时按降级阶梯重试，之后的片段沿用已生效的降级措施。
+    """
+    continuity = job_input.get("segment_continuity", "reference")
+    if continuity not in SEGMENT_CONTINUITY_MODES:
+        raise Exception(f"不支持的 segment_continuity: {continuity}（可选: {', '.join(SEGMENT_CONTINUITY_MODES)}）")
+    length = job_input.get("length", 81)
+    base_skip = int(prompt.get("75", {}).get("inputs", {}).get("skip_first_frames") or 0)
+    segments_total = len(prompt_lines)
+    logger.info(f"🎞️ 分段生成: {segments_total} 段 × {length} 帧, 衔接方式={continuity}")
+    if video_path:
+        # 驱动视频不够所有片段使用时，提交前直接失败，而不是跑完前几段后在空窗口上报错
+        frames_needed = base_skip + segments_total * length
+        video_info = probe_video(video_path)
+        frame_count = video_info["frame_count"]
+        # VHS_LoadVideo 先按 force_rate 重采样、再按 select_every_nth 抽帧，跳帧和窗口都以处理后的帧计
+        node_75_inputs = prompt.get("75", {}).get("inputs", {})
+        force_rate = node_75_inputs.get("force_rate") or 0
+        if frame_count and isinstance(force_rate, (int, float)) and force_rate > 0 and video_info["fps"]:
+            frame_count = int(frame_count * force_rate / video_info["fps"])
+        select_every_nth = node_75_inputs.get("select_every_nth") or 1
+        if isinstance(select_every_nth, int) and select_every_nth > 1:
+            frame_count //= select_every_nth
+        if frame_count and frame_count < frames_needed:
+            raise JobError(
+                "BAD_INPUT",
+                f"驱动视频只有约 {frame_count} 帧，{segments_total} 段 × {length} 帧"
+                f"（跳过前 {base_skip} 帧）需要 {frames_needed} 帧，请减少提示词数量或 length"
+            )
+
+    submitted = {}
+    if continuity == "reference":
+        # 所有片段一次性入队，ComfyUI 连续执行，片段之间 GPU 不空闲
+        for index, line in enumerate(prompt_lines):
+            submitted[index] = submit_prompt(build_segment_prompt(prompt, index, line, length, base_skip), True)
+    timer.lap("queue_submit")
+
+    segment_paths = []
+    delivery = ThreadPoolExecutor(max_workers=1)
+    deliveries = []
+    reference_image = None
+    oom_ladder = resolve_oom_ladder(job_input)
+    oom_fallback = []
+    try:
+        for index, line in enumerate(prompt_lines):
+            segment_prompt = build_segment_prompt(prompt, index, line, length, base_skip, reference_image)
+            for rung in oom_fallback:
+                OOM_FALLBACKS[rung](segment_prompt)
+            pending = [submitted.pop(index, None)]
+            if pending[0] and oom_fallback:
+                # 预先提交的是未降级的版本，删掉后按降级后的 prompt 重新提交
+                cancel_prompts([pending[0][0]])
+                pending = [None]
+            segment_timer = JobTimer(f"{job_id}_seg{index:03d}")
+            (videos, _), applied = run_with_oom_fallback(
+                segment_prompt,
+                lambda attempt: get_videos(attempt, True, job, task_dir, segment_timer, pending.pop() if pending else None, cancel),
+                [rung for rung in oom_ladder if rung not in oom_fallback],
+            )
+            oom_fallback += applied
+            if not videos.get("83"):
+                raise Exception(f"片段 {index + 1}/{segments_total} 没有生成视频（节点 83 无输出）")
+            segment_path = videos["83"][0]
+            segment_paths.append(segment_path)
+            if continuity == "chain" and index < segments_total - 1:
+                reference_image = extract_last_frame(segment_path, os.path.join(task_dir, f"segment_{index:03d}_last.png"))
+            deliveries.append(delivery.submit(
+                deliver_segment, job, job_id, index, segments_total, segment_path, output_mode, segment_timer.as_dict()
+            ))
+        timer.lap("segments")
+        segments = [future.result() for future in deliveries]
+    except Exception:
+        # 后续片段已无意义，从队列中删除
+        cancel_prompts([prompt_id for prompt_id, _ in submitted.values()])
+        raise
+    finally:
+        delivery.shutdown(wait=True)
+    timer.lap("segment_delivery")
+
+    try:
+        full_path = concat_videos(segment_paths, os.path.abspath(os.path.join(task_dir, "segments_full.mp4")))
+        # 降级后的结果与请求的参数不一致，不写入结果缓存
+        result = deliver_and_cache_video(
+            full_path, job_id, output_mode, None if oom_fallback else fingerprint, base64_output_limit(job_input)
+        )
     except Exception as e:
-        logger.warning(f"获取可用模型列表失败: {e}")
+        logger.warning(f"⚠️ 完整视频拼接/交付失败，只返回各片段: {e}")
+        result = {}
+        if output_mode == "base64":
+            for entry, segment_path in zip(segments, segment_paths):
+                entry.update(deliver_video(
+                    segment_path, f"{job_id}_seg{entry['segment']:03d}", output_mode, base64_output_limit(job_input)
+                ))
+    timer.lap("output_delivery")
+    result["segments"] = segments
+    if oom_fallback:
+        result["oom_fallback"] = oom_fallback
+    return result
+
+# 批量任务最多允许的参考图数量，以及同时在 ComfyUI 中排队的条目数
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "16"))
+BATCH_PIPELINE_DEPTH = int(os.getenv("BATCH_PIPELINE_DEPTH", "2"))
+BATCH_IMAGE_KEYS = ("image_path", "image_url", "image_base64")
+
+def normalize_batch_item(item):
+    """
+    批量任务中的单个条目转换为 job input 字段
+
+    条目可以是字符串（URL、本地路径或 base64），也可以是带 image_url/image_base64/image_path
+    及逐条覆盖参数（seed、prompt 等）的字典。
+    """
+    if isinstance(item, dict):
+        if not any(item.get(key) for key in BATCH_IMAGE_KEYS):
+            raise Exception(f"批量条目缺少参考图（需要 {', '.join(BATCH_IMAGE_KEYS)} 之一）")
+        return dict(item)
+    if not isinstance(item, str) or not item:
+        raise Exception(f"无效的批量条目: {type(item).__name__}")
+    if item.startswith(("http://", "https://")):
+        return {"image_url": item}
+    if item.startswith("/") and os.path.exists(item):
+        return {"image_path": item}
+    return {"image_base64": item}
+
+def run_batch_job(job, job_input, timer, cancel):
+    """
+    批量任务：多张参考图共用同一个驱动视频和参数
+
+    驱动视频只下载和探测一次，各条目共用。SteadyDancer workflow 中姿态检测（节点 130）
+    以参考图为输入、编码（节点 63）以参考图为起始帧，因此每个条目仍完整执行 workflow，
+    批量只省去驱动视频的重复下载和校验。
+    """
+    items = job_input["images"]
+    if not items:
+        raise Exception("images 不能为空")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise Exception(f"批量条目过多: {len(items)}，上限 {BATCH_MAX_ITEMS}")
+    item_inputs = [normalize_batch_item(item) for item in items]
+    job_id = job.get("id") or f"batch_{uuid.uuid4()}"
+    logger.info(f"📦 批量任务: {len(items)} 张参考图共用一个驱动视频")
+
+    batch_dir = workspaces.create(f"batch_{uuid.uuid4()}")
+    cancel.add_cleanup(batch_dir)
+    shared_input = {
+        k: v for k, v in job_input.items()
+        if k != "images" and k not in BATCH_IMAGE_KEYS and k not in ("video_path", "video_url", "video_base64")
+    }
+    video_path = stage_inputs(job_input, batch_dir, [("video", "input_video.mp4")])["video"]
+    video_info = None
+    if video_path:
+        shared_input["video_path"] = video_path
+        video_info = probe_video(video_path)
+    timer.lap("input_staging")
+
+    def run_item(index):
+        cancel.check()
+        item_job = dict(job, input=dict(shared_input, **item_inputs[index]))
+        item_timer = JobTimer(f"{job_id}_item{index:03d}")
+        try:
+            entry = run_job(item_job, item_timer, cancel, job_id=f"{job_id}_item{index:03d}", video_info=video_info)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            logger.error(f"批量条目 {index + 1}/{len(items)} 失败: {e}")
+            entry = error_result(e)
+        entry = dict(entry, index=index, timings=item_timer.as_dict())
+        if not job.get("warmup"):
+            try:
+                runpod.serverless.progress_update(job, {
+                    "status": "item_ready", "index": index, "items_total": len(items),
+                    "error": entry.get("error"),
+                })
+            except Exception as e:
+                logger.debug(f"批量条目进度上报失败: {e}")
+        return entry
+
+    # 多个条目同时在 ComfyUI 中排队，上一条交付（上传）时 GPU 已经在执行下一条
+    with ThreadPoolExecutor(max_workers=max(1, BATCH_PIPELINE_DEPTH)) as pool:
+        results = list(pool.map(run_item, range(len(items))))
+    timer.lap("batch_items")
+
+    failed = sum(1 for entry in results if "error" in entry)
+    result = {"items": results, "succeeded": len(results) - failed, "failed": failed}
+    if failed == len(results):
+        codes = {entry.get("error_code", "UNKNOWN") for entry in results}
+        result.update(error=f"批量任务全部失败（{failed} 条）", error_code=codes.pop() if len(codes) == 1 else "UNKNOWN")
+    return result
+
+# 模型目录：registry 通过这些目录的 mtime 判断是否需要刷新
+MODEL_DIRS = [
+    "/ComfyUI/models/diffusion_models",
+    "/ComfyUI/models/checkpoints",
+    "/ComfyUI/models/vae",
+    "/ComfyUI/models/clip_vision",
+    "/ComfyUI/models/text_encoders",
+    "/ComfyUI/models/loras",
+    "/ComfyUI/models/detection",
+    "/ComfyUI/models/onnx",
+    "/workspace/models",
+]
+# 姿态检测 onnx 模型所在目录及其在 ComfyUI 中的路径前缀
+DETECTION_DIRS = [
+    ("/ComfyUI/models/detection", "detection"),
+    ("/ComfyUI/models/onnx", "onnx"),
+]
+MEGA_MODEL_NAME = "wan2.2-rapid-mega-aio-nsfw-v12.1.safetensors"
+
+def _is_mega_model_name(model_name):
+    model_name_lower = model_name.lower()
+    return "mega" in model_name_lower or "aio" in model_name_lower or "all-in-one" in model_name_lower or "allinone" in model_name_lower
+
+def _loader_options(object_info, class_type, input_name):
+    """从 /object_info 中取出某个加载节点输入的可选值列表（兼容不同返回格式）"""
+    loader_info = object_info.get(class_type)
+    if not loader_info:
         return []
+    options = loader_info.get(input_name)
+    if options is None:
+        node_inputs = loader_info.get("input", {})
+        options = node_inputs.get("required", {}).get(input_name) or node_inputs.get("optional", {}).get(input_name) or []
+    # 处理嵌套列表的情况
+    if options and isinstance(options, list) and isinstance(options[0], list):
+        options = options[0]
+    return [m for m in options if isinstance(m, str)] if isinstance(options, list) else []
+
+class ModelRegistry:
+    """
+    模型索引：worker 启动时查询一次 /object_info，之后每个任务的模型选择都是字典查找
+
+    - 缓存各加载节点（WanVideoModelLoader、CheckpointLoaderSimple 等）的可选模型列表
+    - 按角色（SteadyDancer DiT、VAE、CLIP vision、LoRA、MEGA checkpoint）归类
+    - 模型目录的 mtime 变化或收到 SIGHUP 时，下一个任务开始前重新构建
+    """
+
+    LOADER_INPUTS = [
+        ("WanVideoModelLoader", "model"),
+        ("CheckpointLoaderSimple", "ckpt_name"),
+        ("WanVideoVAELoader", "model_name"),
+        ("CLIPVisionLoader", "clip_name"),
+        ("WanVideoLoraSelect", "lora"),
+        ("OnnxDetectionModelLoader", "vitpose_model"),
+        ("OnnxDetectionModelLoader", "yolo_model"),
+    ]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._options = {}
+        self.roles = {}
+        self._signature = None
+        self._loaded = False
+        self._dirty = False
+
+    def _dir_signature(self):
+        signature = []
+        for model_dir in MODEL_DIRS:
+            try:
+                signature.append(os.stat(model_dir).st_mtime_ns)
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def mark_dirty(self, *_):
+        """显式要求刷新（可直接作为 SIGHUP 的信号处理函数）"""
+        logger.info("模型索引已标记为需要刷新")
+        self._dirty = True
+
+    def refresh_if_stale(self):
+        if self._loaded and not self._dirty and self._dir_signature() == self._signature:
+            return
+        self.refresh()
+
+    def refresh(self):
+        with self._lock:
+            started = time.time()
+            self._dirty = False
+            # 先把 MEGA/AIO 模型链接进 checkpoints 目录，再查询 /object_info，
+            # ComfyUI 在每次 /object_info 时重新列目录，不需要额外等待
+            if os.path.exists(f"/ComfyUI/models/diffusion_models/{MEGA_MODEL_NAME}"):
+                logger.info(f"检测到 MEGA/AIO 模型文件，确保其在 checkpoints 目录中")
+                ensure_model_in_checkpoints(MEGA_MODEL_NAME)
+            signature = self._dir_signature()
+            try:
+                object_info = comfy.get_json("/object_info", timeout=30)
+            except Exception as e:
+                logger.warning(f"获取 /object_info 失败，模型索引将在下个任务重试: {e}")
+                self._loaded = False
+                return
+            options = {key: _loader_options(object_info, *key) for key in self.LOADER_INPUTS}
+
+            # onnx 检测模型列表为空时从文件系统扫描补充
+            for input_name, keyword in (("vitpose_model", "vitpose"), ("yolo_model", "yolo")):
+                key = ("OnnxDetectionModelLoader", input_name)
+                if options[key]:
+                    continue
+                for detection_dir, prefix in DETECTION_DIRS:
+                    if not os.path.isdir(detection_dir):
+                        continue
+                    for file in sorted(os.listdir(detection_dir)):
+                        if file.endswith('.onnx') and keyword in file.lower():
+                            for relative_path in (f"{prefix}/{file}", file):
+                                if relative_path not in options[key]:
+                                    options[key].append(relative_path)
+
+            # 确保 mega 模型在 checkpoints 中（可能只出现在 WanVideoModelLoader 列表里）
+            for model_name in options[("WanVideoModelLoader", "model")] + options[("CheckpointLoaderSimple", "ckpt_name")]:
+                if _is_mega_model_name(model_name):
+                    ensure_model_in_checkpoints(model_name)
+                    break
+
+            self._options = options
+            all_models = self.available_models()
+            self.roles = {
+                "steadydancer_dit": [m for m in options[("WanVideoModelLoader", "model")] if "steadydancer" in m.lower()],
+                "mega_checkpoint": [m for m in all_models if _is_mega_model_name(m)],
+                "vae": options[("WanVideoVAELoader", "model_name")],
+                "clip_vision": options[("CLIPVisionLoader", "clip_name")],
+                "lora": options[("WanVideoLoraSelect", "lora")],
+                "vitpose": options[("OnnxDetectionModelLoader", "vitpose_model")],
+                "yolo": options[("OnnxDetectionModelLoader", "yolo_model")],
+            }
+            self._signature = signature
+            self._loaded = True
+            logger.info(f"📚 模型索引已刷新 ({time.time() - started:.2f}s): " + ", ".join(f"{role}={len(models)}" for role, models in self.roles.items()))
+            logger.info(f"可用模型列表: {all_models}")
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def options(self, class_type, input_name):
+        return list(self._options.get((class_type, input_name), []))
+
+    def available_models(self):
+        """WanVideoModelLoader 和 CheckpointLoaderSimple 可加载的模型（去重）"""
+        return list(dict.fromkeys(self.options("WanVideoModelLoader", "model") + self.options("CheckpointLoaderSimple", "ckpt_name")))
+
+    def find(self, role):
+        """返回某个角色的第一个模型，没有时返回 None"""
+        models = self.roles.get(role)
+        return models[0] if models else None
+
+
+model_registry = ModelRegistry()
 
 def update_model_in_prompt(prompt, node_id, available_models):
     """更新 prompt 中指定节点的模型名称，如果模型不存在则使用第一个可用模型"""
@@ -565,6 +2100,324 @@ def load_workflow(workflow_path):
         logger.error(f"加载工作流文件时发生错误: {workflow_path} - {str(e)}")
         raise
 
+# 已编译的 workflow 模板缓存: (workflow_path, use_steadydancer, logic_node_ids) -> 编译结果
+# 编译结果记录文件的 (mtime, size)，文件变化时自动重新编译
+_compiled_workflows = {}
+_compiled_workflows_lock = threading.Lock()
+
+# 转换时跳过的节点类型（注释节点、comfyui-logic 的值传递节点）
+_SKIPPED_NODE_TYPES = ("GetNode", "SetNode", "PrimitiveNode")
+
+def _get_node_var_name(node, title_prefix):
+    """获取 GetNode/SetNode 的变量名（优先 title，其次 widgets_values[0]）"""
+    name = node.get("title", "").replace(title_prefix, "")
+    if not name and node.get("widgets_values"):
+        name = node["widgets_values"][0] if isinstance(node["widgets_values"], list) else ""
+    return name
+
+def _first_linked_input(node):
+    """返回节点第一个有链接的输入的 link id，没有则返回 None"""
+    for input_item in node.get("inputs", []):
+        if isinstance(input_item, dict) and "link" in input_item and input_item["link"] is not None:
+            return input_item["link"]
+    return None
+
+def compile_workflow(workflow_data, use_steadydancer=False, logic_node_ids=()):
+    """
+    将 UI 格式（nodes/links 数组）的 workflow 转换为 ComfyUI API 格式的 prompt 模板
+
+    转换逻辑与原来在 handler() 中逐请求执行的版本一致，但所有按 id 的查找都改为字典索引，
+    不再对 nodes/links 做嵌套线性扫描。logic 节点（comfyui-logic）的值依赖具体任务，
+    编译时只记录引用位置，由 instantiate_workflow() 按任务填入。
+
+    返回 {"prompt": prompt, "logic_refs": [(node_id, input_name, logic_node_id), ...]}
+    """
+    nodes = workflow_data["nodes"]
+    links = workflow_data.get("links", [])
+    logic_node_ids = set(logic_node_ids)
+
+    # 索引：node id -> node，link id -> link（与原线性扫描一样，取第一个匹配项）
+    nodes_by_id = {}
+    for node in nodes:
+        nodes_by_id.setdefault(str(node["id"]), node)
+    links_by_id = {}
+    for link in links:
+        if len(link) >= 6:
+            links_by_id.setdefault(link[0], link)
+
+    # 第一遍：收集 SetNode 的名称和 PrimitiveNode 的值
+    setnode_names = {}  # SetNode ID -> 名称（仅记录有名称的）
+    setnode_by_name = {}  # 名称 -> 第一个同名 SetNode ID
+    primitivenode_values = {}  # PrimitiveNode ID -> value
+    for node in nodes:
+        node_id = str(node["id"])
+        node_type = node.get("type", "")
+        if node_type == "SetNode":
+            setnode_name = _get_node_var_name(node, "Set_")
+            if isinstance(setnode_name, str):
+                setnode_by_name.setdefault(setnode_name, node_id)
+            if setnode_name:
+                setnode_names[node_id] = setnode_name
+        elif node_type == "PrimitiveNode":
+            if node.get("widgets_values") and isinstance(node["widgets_values"], list) and len(node["widgets_values"]) > 0:
+                primitivenode_values[node_id] = node["widgets_values"][0]
+
+    # 第二遍：建立 GetNode 到 SetNode 的映射
+    getnode_to_setnode_map = {}
+    for node in nodes:
+        if node.get("type", "") != "GetNode":
+            continue
+        node_id = str(node["id"])
+        getnode_name = _get_node_var_name(node, "Get_")
+        if getnode_name:
+            if setnode_by_name.get(getnode_name) in setnode_names:
+                getnode_to_setnode_map[node_id] = setnode_by_name[getnode_name]
+            else:
+                logger.warning(f"GetNode {node_id} ({getnode_name}) 未找到对应的 SetNode，可能导致链接解析失败")
+
+    def setnode_source(setnode_id):
+        """SetNode 第一个输入链接的原始源 [node_id, output_index]，找不到返回 None"""
+        setnode = nodes_by_id.get(setnode_id)
+        if setnode is None or "inputs" not in setnode:
+            return None
+        link = links_by_id.get(_first_linked_input(setnode))
+        return [str(link[1]), link[2]] if link else None
+
+    # 建立 links_map，GetNode/SetNode 的链接直接解析到实际源节点
+    links_map = {}
+    for link in links:
+        if len(link) < 6:
+            continue
+        link_id = link[0]
+        source_node_id = str(link[1])
+        if source_node_id in primitivenode_values:
+            links_map[link_id] = ["__PRIMITIVE__", primitivenode_values[source_node_id]]
+        elif source_node_id in setnode_names:
+            source = setnode_source(source_node_id)
+            if source:
+                links_map[link_id] = source
+        elif source_node_id in getnode_to_setnode_map:
+            source = setnode_source(getnode_to_setnode_map[source_node_id])
+            if source:
+                links_map[link_id] = source
+        else:
+            links_map[link_id] = [source_node_id, link[2]]
+
+    # 按名称查找节点（GetNode 映射失败时的后备路径），与原实现一样不限节点类型，取第一个
+    nodes_by_var_name = {}
+    for node in nodes:
+        name = _get_node_var_name(node, "Set_")
+        if isinstance(name, str):
+            nodes_by_var_name.setdefault(name, node)
+
+    def resolve_via_setnode(setnode, try_all_inputs=False):
+        """经由 SetNode 解析到未被跳过的实际源节点（默认只看第一个有链接的输入）"""
+        if setnode is None or not isinstance(setnode.get("inputs"), list):
+            return None
+        for input_item in setnode["inputs"]:
+            if not (isinstance(input_item, dict) and "link" in input_item and input_item["link"] is not None):
+                continue
+            actual_source = links_map.get(input_item["link"])
+            if actual_source is not None and actual_source[0] not in skipped_node_ids:
+                return list(actual_source)
+            if not try_all_inputs:
+                break
+        return None
+
+    prompt = {}
+    logic_refs = []
+    skipped_node_ids = set()
+
+    # 第三遍：转换节点（注意：prompt / skipped_node_ids 按 nodes 顺序逐步建立，与原实现保持一致）
+    for node in nodes:
+        node_id = str(node["id"])
+        node_type = node.get("type", "")
+
+        if node_id in logic_node_ids:
+            skipped_node_ids.add(node_id)
+            continue
+        if node_type == "Note" or node_type == "MarkdownNote" or (isinstance(node_type, str) and (node_type.startswith("Note") or node_type.startswith("Markdown"))):
+            skipped_node_ids.add(node_id)
+            continue
+        if node_type in _SKIPPED_NODE_TYPES:
+            skipped_node_ids.add(node_id)
+            continue
+
+        converted_node = {}
+        for key, value in node.items():
+            if key == "id":
+                continue
+            if key != "inputs":
+                converted_node[key] = value
+                continue
+
+            converted_inputs = {}
+            widgets_values = node.get("widgets_values", [])
+            widgets_values_is_dict = isinstance(widgets_values, dict)
+            if not widgets_values_is_dict and not isinstance(widgets_values, list):
+                widgets_values = []
+
+            widget_index = 0
+            if isinstance(value, list):
+                for input_item in value:
+                    if not (isinstance(input_item, dict) and "name" in input_item):
+                        continue
+                    input_name = input_item["name"]
+                    has_widget = "widget" in input_item
+                    has_link = "link" in input_item and input_item["link"] is not None
+
+                    if not has_link:
+                        if "value" in input_item:
+                            converted_inputs[input_name] = input_item["value"]
+                        elif has_widget:
+                            widget_value = None
+                            if widgets_values_is_dict:
+                                widget_value = widgets_values.get(input_name)
+                            elif widget_index < len(widgets_values):
+                                widget_value = widgets_values[widget_index]
+                                widget_index += 1
+                            if widget_value is not None:
+                                converted_inputs[input_name] = widget_value
+                        continue
+
+                    # SteadyDancer workflow 的节点 77：width/height 不解析链接，稍后用调整后的尺寸覆盖
+                    if use_steadydancer and node_id == "77" and input_name in ["width", "height"]:
+                        converted_inputs[input_name] = "__STEADYDANCER_ADJUSTED__"
+                    else:
+                        link_id = input_item["link"]
+                        if link_id in links_map:
+                            source_node_id, source_output_index = links_map[link_id]
+                            if source_node_id == "__PRIMITIVE__":
+                                converted_inputs[input_name] = source_output_index
+                            elif source_node_id in skipped_node_ids:
+                                resolved = None
+                                if source_node_id in setnode_names:
+                                    resolved = resolve_via_setnode(nodes_by_id.get(source_node_id))
+                                    if resolved is None:
+                                        logger.warning(f"节点{node_id}.{input_name}: 无法解析 SetNode {source_node_id} 的链接，跳过")
+                                elif source_node_id in getnode_to_setnode_map:
+                                    resolved = resolve_via_setnode(nodes_by_id.get(getnode_to_setnode_map[source_node_id]))
+                                    if resolved is None:
+                                        logger.warning(f"节点{node_id}.{input_name}: 无法解析 GetNode {source_node_id} 的链接，尝试直接查找SetNode")
+                                        getnode_name = _get_node_var_name(nodes_by_id[source_node_id], "Get_")
+                                        if getnode_name:
+                                            resolved = resolve_via_setnode(nodes_by_var_name.get(getnode_name), try_all_inputs=True)
+                                else:
+                                    logger.warning(f"节点{node_id}.{input_name}: 源节点 {source_node_id} 被跳过且无法解析，跳过此输入")
+                                if resolved is not None:
+                                    converted_inputs[input_name] = resolved
+                            elif source_node_id in logic_node_ids:
+                                # 占位，instantiate_workflow() 时填入任务相关的值
+                                converted_inputs[input_name] = None
+                                logic_refs.append((node_id, input_name, source_node_id))
+                            elif source_node_id not in prompt and source_node_id not in skipped_node_ids:
+                                logger.warning(f"节点{node_id}.{input_name}: 源节点 {source_node_id} 不存在，跳过此输入")
+                            else:
+                                converted_inputs[input_name] = [source_node_id, source_output_index]
+                        else:
+                            logger.warning(f"节点{node_id}.{input_name}: 链接 {link_id} 在 links_map 中不存在")
+                            converted_inputs[input_name] = None
+                    # 有 link 的 widget 输入也占用 widgets_values 中的一个位置
+                    if not widgets_values_is_dict and has_widget and widget_index < len(widgets_values):
+                        widget_index += 1
+            converted_node["inputs"] = converted_inputs
+
+        # ComfyUI API 需要 class_type 字段
+        if "type" in converted_node:
+            converted_node["class_type"] = converted_node["type"]
+        elif "class_type" not in converted_node:
+            logger.warning(f"节点 {node_id} 缺少 type 和 class_type 字段")
+        prompt[node_id] = converted_node
+
+    # 后处理：关键节点的必需输入缺失时，从原始 workflow 的链接中修复
+    critical_nodes = {
+        "28": {"vae": "WANVAE", "samples": "LATENT"},  # WanVideoDecode
+        "77": {"image": "IMAGE", "width": "INT", "height": "INT"},  # ImageResizeKJv2
+        "79": {"image_1": "IMAGE"},  # ImageConcatMulti
+        "131": {"images": "IMAGE"},  # PreviewImage
+    }
+    for node_id, required_inputs in critical_nodes.items():
+        if node_id not in prompt:
+            continue
+        if "inputs" not in prompt[node_id]:
+            logger.warning(f"⚠️ 关键节点 {node_id} 缺少 inputs 对象")
+            prompt[node_id]["inputs"] = {}
+        orig_node = nodes_by_id[node_id]
+        orig_inputs = orig_node.get("inputs") if isinstance(orig_node.get("inputs"), list) else []
+        for input_name, input_type in required_inputs.items():
+            if prompt[node_id]["inputs"].get(input_name) is not None:
+                continue
+            logger.warning(f"⚠️ 关键节点 {node_id} 缺少必需输入 {input_name} ({input_type})，尝试修复")
+            input_item = next((item for item in orig_inputs if isinstance(item, dict) and item.get("name") == input_name), None)
+            if input_item is None or input_item.get("link") is None:
+                continue
+            link = links_by_id.get(input_item["link"])
+            if link is None:
+                continue
+            source_node_id = str(link[1])
+            source_output_index = link[2]
+            source_node = nodes_by_id.get(source_node_id, {})
+            if source_node.get("type") == "GetNode":
+                getnode_name = source_node.get("title", "").replace("Get_", "")
+                if not getnode_name and source_node.get("widgets_values"):
+                    getnode_name = source_node["widgets_values"][0] if isinstance(source_node["widgets_values"], list) else ""
+                setnode_id = setnode_by_name.get(getnode_name)
+                setnode = nodes_by_id.get(setnode_id) if setnode_id else None
+                if setnode is not None and isinstance(setnode.get("inputs"), list):
+                    setnode_input = next((item for item in setnode["inputs"] if isinstance(item, dict) and "link" in item), None)
+                    link2 = links_by_id.get(setnode_input["link"]) if setnode_input else None
+                    if link2 is not None and str(link2[1]) not in skipped_node_ids:
+                        prompt[node_id]["inputs"][input_name] = [str(link2[1]), link2[2]]
+                        logger.info(f"  ✅ 修复成功: 节点{node_id}.{input_name} = [{link2[1]}, {link2[2]}]")
+            elif source_node_id not in skipped_node_ids:
+                prompt[node_id]["inputs"][input_name] = [source_node_id, source_output_index]
+                logger.info(f"  ✅ 修复成功: 节点{node_id}.{input_name} = [{source_node_id}, {source_output_index}]")
+
+    return {"prompt": prompt, "logic_refs": logic_refs}
+
+def get_compiled_workflow(workflow_path, use_steadydancer=False, logic_node_ids=()):
+    """按 (文件路径, mtime) 获取已编译的 workflow 模板，首次使用或文件变化时编译"""
+    stat = os.stat(workflow_path)
+    file_version = (stat.st_mtime_ns, stat.st_size)
+    cache_key = (workflow_path, use_steadydancer, frozenset(logic_node_ids))
+    with _compiled_workflows_lock:
+        cached = _compiled_workflows.get(cache_key)
+        if cached is not None and cached["version"] == file_version:
+            return cached
+
+        start_time = time.time()
+        workflow_data = load_workflow(workflow_path)
+        if "nodes" in workflow_data:
+            compiled = compile_workflow(workflow_data, use_steadydancer, logic_node_ids)
+        else:
+            # 已经是 API 格式（节点 ID key），无需转换
+            compiled = {"prompt": workflow_data, "logic_refs": []}
+        compiled["version"] = file_version
+        _compiled_workflows[cache_key] = compiled
+        logger.info(f"已编译 workflow: {workflow_path} ({len(compiled['prompt'])} 个节点, 耗时 {(time.time() - start_time) * 1000:.1f} ms)")
+        return compiled
+
+def instantiate_workflow(compiled, logic_node_values=None):
+    """复制编译好的 prompt 模板供单个任务修改，并填入 logic 节点的值"""
+    prompt = copy.deepcopy(compiled["prompt"])
+    for node_id, input_name, logic_node_id in compiled["logic_refs"]:
+        if logic_node_values and logic_node_id in logic_node_values:
+            prompt[node_id]["inputs"][input_name] = logic_node_values[logic_node_id]
+    return prompt
+
+def precompile_workflows(workflow_dir="/workflows"):
+    """预编译 workflow 目录中的所有文件，避免第一个任务承担转换开销"""
+    if not os.path.isdir(workflow_dir):
+        return
+    for filename in sorted(os.listdir(workflow_dir)):
+        if not filename.endswith(".json"):
+            continue
+        workflow_path = os.path.join(workflow_dir, filename)
+        try:
+            get_compiled_workflow(workflow_path, use_steadydancer=(workflow_path == STEADYDANCER_WORKFLOW))
+        except Exception as e:
+            logger.warning(f"预编译 workflow 失败: {workflow_path} - {e}")
+
 def ensure_model_in_checkpoints(model_name):
     """确保模型文件在 checkpoints 目录中，如果不在则创建符号链接"""
     model_name = os.path.basename(model_name)  # 只取文件名
@@ -614,9 +2467,6 @@ def ensure_model_in_checkpoints(model_name):
             os.symlink(source_path, target_path)
             logger.info(f"已创建符号链接: {target_path} -> {source_path}")
             
-            # 等待一小段时间，让文件系统同步
-            time.sleep(0.5)
-            
             # 验证符号链接是否创建成功
             if os.path.exists(target_path) and os.path.islink(target_path):
                 logger.info(f"符号链接验证成功: {target_path}")
@@ -645,7 +2495,47 @@ def ensure_model_in_checkpoints(model_name):
         logger.warning(f"未找到模型文件: {model_name}，在以下路径中查找: {possible_paths}")
         return False
 
-def handler(job):
+def handler(job, cancel=None):
+    """RunPod 入口：执行任务，在结果中附上分阶段耗时（timings）并记录运行指标"""
+    timer = JobTimer(job.get("id"))
+    if cancel is None:
+        cancel = CancelToken()
+    if job.get("warmup"):
+        try:
+            result = run_job(job, timer, cancel)
+        finally:
+            cancel.cleanup()
+        result["timings"] = timer.as_dict()
+        return result
+    worker_metrics.job_started()
+    try:
+        # 非法的 timeout 与其他输入错误一样返回 BAD_INPUT
+        cancel.set_timeout(resolve_job_timeout(job.get("input", {})))
+        result = run_job(job, timer, cancel)
+    except JobCancelled as e:
+        logger.warning(f"⛔ {e}，已中断 ComfyUI 执行并清理临时文件")
+        worker_metrics.record_job(timer, "cancelled", cancel.reason)
+        timer.write_trace("cancelled")
+        return {"error": str(e), "cancelled": True, "timings": timer.as_dict()}
+    except Exception as e:
+        # 输入校验等 run_job 内层 try 之外的失败同样返回 error_code / retryable，而不是抛给 RunPod
+        logger.error(f"❌ 任务失败: {e}")
+        result = error_result(e)
+        worker_metrics.record_job(timer, "failed", result["error_code"])
+        timer.write_trace("exception")
+        return dict(result, timings=timer.as_dict())
+    finally:
+        # 结果已交付（上传或内联），任务目录和 ComfyUI 输出文件不再需要
+        cancel.cleanup()
+        workspaces.enforce_budget()
+    status = "failed" if "error" in result else "succeeded"
+    worker_metrics.record_job(timer, status, result.get("error_code", "UNKNOWN") if "error" in result else None)
+    timer.write_trace(status)
+    result["timings"] = timer.as_dict()
+    logger.info(f"⏱️ 任务耗时: {json.dumps(result['timings']['phases'])}")
+    return result
+
+def run_job(job, timer=None, cancel=None, job_id=None, video_info=None):
     """
     处理视频生成任务
     
@@ -659,6 +2549,10 @@ def handler(job):
     参考: https://huggingface.co/Phr00t/WAN2.2-14B-Rapid-AllInOne/discussions/100
     """
     job_input = job.get("input", {})
+    timer = timer or JobTimer(job.get("id"))
+    cancel = cancel or CancelToken()
+    if isinstance(job_input.get("images"), list):
+        return run_batch_job(job, job_input, timer, cancel)
 
     # 记录job_input，但排除base64数据以避免日志过长
     log_input = {k: v for k, v in job_input.items() if k not in ["image_base64", "end_image_base64"]}
@@ -668,28 +2562,32 @@ def handler(job):
         log_input["end_image_base64"] = f"<base64 data, length: {len(job_input['end_image_base64'])}>"
     logger.info(f"Received job input: {log_input}")
     task_id = f"task_{uuid.uuid4()}"
+    task_dir = workspaces.create(task_id)
+    cancel.add_cleanup(task_dir)
+    job_id = job_id or job.get("id") or task_id
+    output_mode = resolve_output_mode(job_input)
+    base64_limit = base64_output_limit(job_input)
 
     # 이미지 입력 처리 (image_path, image_url, image_base64 중 하나만 사용)
-    image_path = None
-    if "image_path" in job_input:
-        image_path = process_input(job_input["image_path"], task_id, "input_image.jpg", "path")
-    elif "image_url" in job_input:
-        image_path = process_input(job_input["image_url"], task_id, "input_image.jpg", "url")
-    elif "image_base64" in job_input:
-        image_path = process_input(job_input["image_base64"], task_id, "input_image.jpg", "base64")
-    else:
+    # 参考图、结束帧和（SteadyDancer 的）驱动视频并发下载/解码
+    input_specs = [("image", "input_image.jpg"), ("end_image", "end_image.jpg")]
+    if job_input.get("use_steadydancer", False):
+        input_specs.append(("video", "input_video.mp4"))
+    staged_inputs = stage_inputs(job_input, task_dir, input_specs)
+    timer.lap("input_staging")
+    cancel.check()
+    image_path = staged_inputs["image"]
+    if image_path is None:
         # 기본값 사용
         image_path = "/example_image.png"
         logger.info("기본 이미지 파일을 사용합니다: /example_image.png")
 
     # 엔드 이미지 입력 처리 (end_image_path, end_image_url, end_image_base64 중 하나만 사용)
-    end_image_path_local = None
-    if "end_image_path" in job_input:
-        end_image_path_local = process_input(job_input["end_image_path"], task_id, "end_image.jpg", "path")
-    elif "end_image_url" in job_input:
-        end_image_path_local = process_input(job_input["end_image_url"], task_id, "end_image.jpg", "url")
-    elif "end_image_base64" in job_input:
-        end_image_path_local = process_input(job_input["end_image_base64"], task_id, "end_image.jpg", "base64")
+    end_image_path_local = staged_inputs["end_image"]
+
+    # 提交前校验输入文件和计算量（可能按 auto_downscale 调整 width/height）
+    job_input = validate_job_inputs(job_input, image_path, staged_inputs.get("video"), video_info)
+    timer.lap("validation")
     
     # LoRA 설정 확인 - 배열로 받아서 처리
     lora_pairs = job_input.get("lora_pairs", [])
@@ -700,39 +2598,22 @@ def handler(job):
         logger.warning(f"LoRA 개수가 {len(lora_pairs)}개입니다. 최대 4개까지만 지원됩니다. 처음 4개만 사용합니다.")
         lora_pairs = lora_pairs[:4]
     
-    # 首先，确保 MEGA/AIO 模型文件在 checkpoints 目录中（如果存在）
-    # 这样 CheckpointLoaderSimple 就能找到模型
-    mega_model_name = "wan2.2-rapid-mega-aio-nsfw-v12.1.safetensors"
-    if os.path.exists(f"/ComfyUI/models/diffusion_models/{mega_model_name}"):
-        logger.info(f"检测到 MEGA/AIO 模型文件，确保其在 checkpoints 目录中")
-        if ensure_model_in_checkpoints(mega_model_name):
-            # 等待 ComfyUI 重新扫描模型目录（如果它支持动态扫描）
-            # 注意：ComfyUI 通常在启动时扫描，但我们可以等待一下
-            logger.info("等待 ComfyUI 识别新添加的模型文件...")
-            time.sleep(2)  # 等待 2 秒让 ComfyUI 有机会重新扫描
-    
-    # 获取可用模型列表，用于检测 MEGA/AIO 模型
-    available_models = get_available_models()
+    # 模型列表来自 worker 级别的模型索引（模型目录变化或 SIGHUP 后才会重新查询 ComfyUI）
+    model_registry.refresh_if_stale()
+    available_models = model_registry.available_models()
+    timer.lap("model_lookup")
     
     # 检测是否为 MEGA/AIO 模型（支持 I2V 和 T2V 的 all-in-one 模型）
-    is_mega_model = False
-    if available_models:
-        for model_name in available_models:
-            model_name_lower = model_name.lower()
-            if "mega" in model_name_lower or "aio" in model_name_lower or "all-in-one" in model_name_lower or "allinone" in model_name_lower:
-                is_mega_model = True
-                mega_model_name = model_name
-                logger.info(f"检测到 MEGA/AIO 模型: {model_name}, 将使用 Rapid-AIO-Mega workflow")
-                
-                # 再次确保模型文件在 checkpoints 目录中（用于 CheckpointLoaderSimple）
-                ensure_model_in_checkpoints(model_name)
-                break
+    mega_model_name = model_registry.find("mega_checkpoint")
+    is_mega_model = mega_model_name is not None
+    if is_mega_model:
+        logger.info(f"检测到 MEGA/AIO 模型: {mega_model_name}, 将使用 Rapid-AIO-Mega workflow")
     
     # 워크플로우 파일 선택
     # 检查是否使用 SteadyDancer workflow
     use_steadydancer = job_input.get("use_steadydancer", False)
     if use_steadydancer:
-        workflow_file = "/workflows/wanvideo_SteadyDancer_example_03.json"
+        workflow_file = STEADYDANCER_WORKFLOW
         logger.info(f"Using SteadyDancer workflow")
     elif is_mega_model:
         workflow_file = "/RapidAIO Mega (V2.5).json"
@@ -741,474 +2622,25 @@ def handler(job):
         workflow_file = "/new_Wan22_flf2v_api.json" if end_image_path_local else "/new_Wan22_api.json"
         logger.info(f"Using {'FLF2V' if end_image_path_local else 'single'} workflow with {lora_count} LoRA pairs")
     
-    workflow_data = load_workflow(workflow_file)
-    
-    # 提前获取 length 值，因为在转换 workflow 时可能会用到
+    # 提前获取 length 值，因为 logic 节点的值依赖它
     length = job_input.get("length", 81)
     
-    # 转换 workflow 格式：如果使用 nodes 数组格式，转换为节点 ID key 格式
-    # SteadyDancer workflow 和 MEGA workflow 都使用 nodes 数组格式
-    if "nodes" in workflow_data:
-        # RapidAIO Mega (V2.5).json 使用 nodes 数组格式，需要转换
-        prompt = {}
-        
-        # 预先计算 comfyui-logic 节点的值（避免依赖插件）
-        logic_node_values = {}
-        if is_mega_model:
-            # 节点592: Seconds/batch = length / 16
-            logic_node_values["592"] = int(length / 16.0)
-            # 节点593: Megapixel
-            logic_node_values["593"] = job_input.get("megapixel", 0.5)
-            # 节点585: Overlapping Frames
-            # MEGA 模型推荐使用 1 帧重叠，且 VHS_DuplicateImages 节点要求 multiply_by >= 1
-            logic_node_values["585"] = job_input.get("overlapping_frames", 1)
-            logger.info(f"预计算 logic 节点值: 592={logic_node_values['592']}, 593={logic_node_values['593']}, 585={logic_node_values['585']}")
-        
-        # 首先建立 link_id 到 [node_id, output_index] 的映射
-        # 同时建立 GetNode/SetNode 和 PrimitiveNode 的映射关系
-        links_map = {}
-        setnode_to_getnode_map = {}  # SetNode ID -> {name: value, ...}
-        getnode_to_setnode_map = {}  # GetNode ID -> SetNode ID
-        primitivenode_values = {}  # PrimitiveNode ID -> value (从 widgets_values 获取)
-        skipped_node_ids = set()  # 记录被跳过的节点 ID
-        
-        # 第一遍：收集 SetNode 的值和 GetNode 的映射关系
-        # 优化：分两次扫描，先扫描SetNode和PrimitiveNode，再扫描GetNode建立映射
-        # 第一次扫描：收集SetNode和PrimitiveNode
-        for node in workflow_data["nodes"]:
-            node_id = str(node["id"])
-            node_type = node.get("type", "")
-            
-            if node_type == "SetNode":
-                # SetNode 存储值：从 inputs 获取值，从 title 或 widgets_values 获取名称
-                setnode_name = node.get("title", "").replace("Set_", "")
-                if not setnode_name and node.get("widgets_values"):
-                    setnode_name = node["widgets_values"][0] if isinstance(node["widgets_values"], list) else ""
-                
-                # 从 inputs 获取实际值（如果有链接）
-                setnode_value = None
-                if "inputs" in node and isinstance(node["inputs"], list):
-                    for input_item in node["inputs"]:
-                        if isinstance(input_item, dict) and "link" in input_item and input_item["link"] is not None:
-                            # SetNode 有输入链接，需要从源节点获取值
-                            setnode_value = node_id  # 标记为需要从源节点获取
-                            break
-                
-                if setnode_name:
-                    if node_id not in setnode_to_getnode_map:
-                        setnode_to_getnode_map[node_id] = {}
-                    setnode_to_getnode_map[node_id][setnode_name] = setnode_value
-                    logger.info(f"记录 SetNode {node_id} 存储的值: {setnode_name}")
-            
-            elif node_type == "PrimitiveNode":
-                # PrimitiveNode 存储原始值：从 widgets_values 获取值
-                if node.get("widgets_values") and isinstance(node["widgets_values"], list) and len(node["widgets_values"]) > 0:
-                    primitivenode_values[node_id] = node["widgets_values"][0]
-                    logger.info(f"记录 PrimitiveNode {node_id} 的值: {node['widgets_values'][0]}")
-        
-        # 第二次扫描：建立GetNode到SetNode的映射
-        for node in workflow_data["nodes"]:
-            node_id = str(node["id"])
-            node_type = node.get("type", "")
-            
-            if node_type == "GetNode":
-                # GetNode 获取值：从 widgets_values 获取名称
-                getnode_name = node.get("title", "").replace("Get_", "")
-                if not getnode_name and node.get("widgets_values"):
-                    getnode_name = node["widgets_values"][0] if isinstance(node["widgets_values"], list) else ""
-                
-                # 查找对应的 SetNode（通过名称匹配）
-                if getnode_name:
-                    for setnode_id, setnode_values in setnode_to_getnode_map.items():
-                        if getnode_name in setnode_values:
-                            getnode_to_setnode_map[node_id] = setnode_id
-                            logger.info(f"GetNode {node_id} ({getnode_name}) 映射到 SetNode {setnode_id}")
-                            break
-                    # 如果未找到对应的SetNode，记录警告
-                    if node_id not in getnode_to_setnode_map:
-                        logger.warning(f"GetNode {node_id} ({getnode_name}) 未找到对应的 SetNode，可能导致链接解析失败")
-        
-        # 建立 links_map，处理 GetNode/SetNode 的链接
-        if "links" in workflow_data:
-            for link in workflow_data["links"]:
-                # link 格式: [link_id, source_node_id, source_output_index, target_node_id, target_input_index, type]
-                if len(link) >= 6:
-                    link_id = link[0]
-                    source_node_id = str(link[1])
-                    source_output_index = link[2]
-                    target_node_id = str(link[3])
-                    target_input_index = link[4]
-                    
-                    # 如果源节点是 PrimitiveNode，值会直接传递，不需要链接
-                    if source_node_id in primitivenode_values:
-                        # PrimitiveNode 的值会在处理节点输入时直接使用，这里标记为特殊值
-                        links_map[link_id] = ["__PRIMITIVE__", primitivenode_values[source_node_id]]
-                        logger.info(f"链接 {link_id}: PrimitiveNode {source_node_id} 的值 = {primitivenode_values[source_node_id]}")
-                    # 如果源节点是 SetNode，找到 SetNode 的输入链接
-                    elif source_node_id in setnode_to_getnode_map:
-                        # SetNode 的输出链接，需要找到 SetNode 的输入源
-                        for setnode in workflow_data["nodes"]:
-                            if str(setnode["id"]) == source_node_id and "inputs" in setnode:
-                                for input_item in setnode.get("inputs", []):
-                                    if isinstance(input_item, dict) and "link" in input_item and input_item["link"] is not None:
-                                        # 找到 SetNode 的源链接
-                                        setnode_link_id = input_item["link"]
-                                        # 查找这个链接的源节点
-                                        for link_item in workflow_data.get("links", []):
-                                            if len(link_item) >= 6 and link_item[0] == setnode_link_id:
-                                                actual_source_id = str(link_item[1])
-                                                actual_source_output = link_item[2]
-                                                links_map[link_id] = [actual_source_id, actual_source_output]
-                                                logger.info(f"链接 {link_id}: SetNode {source_node_id} -> 实际源节点 {actual_source_id}")
-                                                break
-                                        break
-                                break
-                    # 如果源节点是 GetNode，找到对应的 SetNode 的源
-                    elif source_node_id in getnode_to_setnode_map:
-                        setnode_id = getnode_to_setnode_map[source_node_id]
-                        # 查找 SetNode 的输入链接
-                        for setnode in workflow_data["nodes"]:
-                            if str(setnode["id"]) == setnode_id and "inputs" in setnode:
-                                for input_item in setnode.get("inputs", []):
-                                    if isinstance(input_item, dict) and "link" in input_item and input_item["link"] is not None:
-                                        # 找到 SetNode 的源链接
-                                        setnode_link_id = input_item["link"]
-                                        # 查找这个链接的源节点
-                                        for link_item in workflow_data.get("links", []):
-                                            if len(link_item) >= 6 and link_item[0] == setnode_link_id:
-                                                actual_source_id = str(link_item[1])
-                                                actual_source_output = link_item[2]
-                                                links_map[link_id] = [actual_source_id, actual_source_output]
-                                                logger.info(f"链接 {link_id}: GetNode {source_node_id} -> SetNode {setnode_id} -> 实际源节点 {actual_source_id}")
-                                                break
-                                        break
-                                break
-                    else:
-                        # 正常链接
-                        links_map[link_id] = [source_node_id, source_output_index]
-        
-        # 第二遍：转换节点，跳过不需要的节点
-        for node in workflow_data["nodes"]:
-            node_id = str(node["id"])
-            
-            # 跳过 comfyui-logic 节点（592, 593, 585），直接内联它们的值
-            if node_id in logic_node_values:
-                logger.info(f"跳过 logic 节点 {node_id}，将直接内联其值")
-                skipped_node_ids.add(node_id)
-                continue
-            
-            # 跳过 Note 和 MarkdownNote 节点（注释节点，ComfyUI API 不支持）
-            node_type = node.get("type", "")
-            if node_type == "Note" or node_type == "MarkdownNote" or (isinstance(node_type, str) and (node_type.startswith("Note") or node_type.startswith("Markdown"))):
-                logger.info(f"跳过 {node_type} 节点 {node_id}（注释节点，不参与执行）")
-                skipped_node_ids.add(node_id)
-                continue
-            
-            # 跳过 GetNode 和 SetNode 节点（comfyui-logic 插件节点，可能未安装）
-            # 这些节点仅用于 workflow 内部值传递，实际执行时会通过链接直接传递值
-            if node_type == "GetNode" or node_type == "SetNode":
-                logger.info(f"跳过 {node_type} 节点 {node_id}（逻辑节点，不参与执行）")
-                skipped_node_ids.add(node_id)
-                continue
-            
-            # 跳过 PrimitiveNode 节点（comfyui-logic 插件节点，可能未安装）
-            # PrimitiveNode 用于定义原始值（数字、字符串等），值会通过链接传递到目标节点
-            # 在 SteadyDancer workflow 中，节点 123 (cfg) 和 124 (seed) 是 PrimitiveNode
-            # 它们的值已经在节点配置时直接设置到目标节点的 inputs 中，所以可以安全跳过
-            if node_type == "PrimitiveNode":
-                logger.info(f"跳过 {node_type} 节点 {node_id}（原始值节点，值已通过链接传递）")
-                skipped_node_ids.add(node_id)
-                continue
-            
-            # 创建符合 ComfyUI API 格式的节点对象
-            converted_node = {}
-            # 复制所有字段
-            for key, value in node.items():
-                if key != "id":  # 排除 id 字段
-                    if key == "inputs":
-                        # 转换 inputs 数组为 inputs 对象
-                        converted_inputs = {}
-                        # 获取节点的 widgets_values（如果存在）
-                        widgets_values = node.get("widgets_values", [])
-                        
-                        # widgets_values 可能是列表或字典
-                        # 如果是字典（如 VHS_VideoCombine），需要按 input 名称匹配
-                        # 如果是列表，按顺序匹配有 widget 的 inputs
-                        widgets_values_is_dict = isinstance(widgets_values, dict)
-                        
-                        if not widgets_values_is_dict:
-                            # 确保是列表
-                            if not isinstance(widgets_values, list):
-                                widgets_values = []
-                        
-                        # widgets_values 按 inputs 顺序包含所有有 widget 的输入值（不管是否有 link）
-                        # 需要按 inputs 顺序遍历，但只对有 widget 的输入从 widgets_values 获取值
-                        widget_index = 0
-                        if isinstance(value, list):
-                            for input_index, input_item in enumerate(value):
-                                if isinstance(input_item, dict) and "name" in input_item:
-                                    input_name = input_item["name"]
-                                    has_widget = "widget" in input_item
-                                    has_link = "link" in input_item and input_item["link"] is not None
-                                    
-                                    if has_link:
-                                        # CRITICAL: 对于 SteadyDancer workflow 的节点 77，阻止 width 和 height 的链接解析
-                                        # 这些值必须使用调整后的尺寸，而不是从节点 91 获取的原始视频尺寸
-                                        if use_steadydancer and node_id == "77" and input_name in ["width", "height"]:
-                                            # 跳过链接解析，使用占位符值，稍后会在计算调整后的尺寸后覆盖
-                                            # 使用一个特殊标记，以便后续识别和覆盖
-                                            converted_inputs[input_name] = "__STEADYDANCER_ADJUSTED__"
-                                            logger.info(f"节点{node_id}.{input_name}: 跳过链接解析（SteadyDancer workflow，标记为待调整）")
-                                            # 跳过 widget 索引递增
-                                            if not widgets_values_is_dict and has_widget and widget_index < len(widgets_values):
-                                                widget_index += 1
-                                            continue
-                                        
-                                        # 如果有 link，转换为 [node_id, output_index] 格式
-                                        link_id = input_item["link"]
-                                        if link_id in links_map:
-                                            source_node_id, source_output_index = links_map[link_id]
-                                            # 如果源节点是 PrimitiveNode，直接使用值
-                                            if source_node_id == "__PRIMITIVE__":
-                                                converted_inputs[input_name] = source_output_index  # source_output_index 存储的是实际值
-                                                logger.info(f"节点{node_id}.{input_name}: 使用 PrimitiveNode 的值 = {source_output_index}")
-                                            # 如果源节点被跳过（GetNode/SetNode/Note等），尝试找到实际源节点
-                                            elif source_node_id in skipped_node_ids:
-                                                # 如果源节点是 SetNode，查找 SetNode 的输入链接
-                                                if source_node_id in setnode_to_getnode_map:
-                                                    # SetNode 的输出，需要找到 SetNode 的输入源
-                                                    for setnode in workflow_data["nodes"]:
-                                                        if str(setnode["id"]) == source_node_id and "inputs" in setnode:
-                                                            for setnode_input in setnode.get("inputs", []):
-                                                                if isinstance(setnode_input, dict) and "link" in setnode_input and setnode_input["link"] is not None:
-                                                                    setnode_link_id = setnode_input["link"]
-                                                                    if setnode_link_id in links_map:
-                                                                        actual_source_id, actual_source_output = links_map[setnode_link_id]
-                                                                        if actual_source_id not in skipped_node_ids:
-                                                                            converted_inputs[input_name] = [actual_source_id, actual_source_output]
-                                                                            logger.info(f"节点{node_id}.{input_name}: 通过 SetNode {source_node_id} -> 实际源节点 {actual_source_id}")
-                                                                            break
-                                                                    break
-                                                            break
-                                                    if input_name not in converted_inputs:
-                                                        logger.warning(f"节点{node_id}.{input_name}: 无法解析 SetNode {source_node_id} 的链接，跳过")
-                                                # 如果源节点是 GetNode，查找对应的 SetNode 的源
-                                                elif source_node_id in getnode_to_setnode_map:
-                                                    setnode_id = getnode_to_setnode_map[source_node_id]
-                                                    # 查找 SetNode 的输入链接
-                                                    for setnode in workflow_data["nodes"]:
-                                                        if str(setnode["id"]) == setnode_id and "inputs" in setnode:
-                                                            for setnode_input in setnode.get("inputs", []):
-                                                                if isinstance(setnode_input, dict) and "link" in setnode_input and setnode_input["link"] is not None:
-                                                                    setnode_link_id = setnode_input["link"]
-                                                                    if setnode_link_id in links_map:
-                                                                        actual_source_id, actual_source_output = links_map[setnode_link_id]
-                                                                        if actual_source_id not in skipped_node_ids:
-                                                                            converted_inputs[input_name] = [actual_source_id, actual_source_output]
-                                                                            logger.info(f"节点{node_id}.{input_name}: 通过 GetNode {source_node_id} -> SetNode {setnode_id} -> 实际源节点 {actual_source_id}")
-                                                                            break
-                                                                    break
-                                                            break
-                                                    if input_name not in converted_inputs:
-                                                        logger.warning(f"节点{node_id}.{input_name}: 无法解析 GetNode {source_node_id} 的链接，尝试直接查找SetNode")
-                                                        # 如果GetNode映射失败，尝试直接查找对应的SetNode
-                                                        # 通过GetNode的widgets_values获取名称
-                                                        getnode_name = None
-                                                        for getnode in workflow_data["nodes"]:
-                                                            if str(getnode["id"]) == source_node_id:
-                                                                getnode_name = getnode.get("title", "").replace("Get_", "")
-                                                                if not getnode_name and getnode.get("widgets_values"):
-                                                                    getnode_name = getnode["widgets_values"][0] if isinstance(getnode["widgets_values"], list) else ""
-                                                                break
-                                                        # 查找对应的SetNode
-                                                        if getnode_name:
-                                                            for setnode in workflow_data["nodes"]:
-                                                                setnode_name = setnode.get("title", "").replace("Set_", "")
-                                                                if not setnode_name and setnode.get("widgets_values"):
-                                                                    setnode_name = setnode["widgets_values"][0] if isinstance(setnode["widgets_values"], list) else ""
-                                                                if setnode_name == getnode_name:
-                                                                    # 找到SetNode，查找其输入链接
-                                                                    if "inputs" in setnode and isinstance(setnode["inputs"], list):
-                                                                        for setnode_input in setnode["inputs"]:
-                                                                            if isinstance(setnode_input, dict) and "link" in setnode_input and setnode_input["link"] is not None:
-                                                                                setnode_link_id = setnode_input["link"]
-                                                                                if setnode_link_id in links_map:
-                                                                                    actual_source_id, actual_source_output = links_map[setnode_link_id]
-                                                                                    if actual_source_id not in skipped_node_ids:
-                                                                                        converted_inputs[input_name] = [actual_source_id, actual_source_output]
-                                                                                        logger.info(f"节点{node_id}.{input_name}: 通过直接查找SetNode -> 实际源节点 {actual_source_id}")
-                                                                                        break
-                                                                    break
-                                                else:
-                                                    logger.warning(f"节点{node_id}.{input_name}: 源节点 {source_node_id} 被跳过且无法解析，跳过此输入")
-                                            # 如果源节点是 logic 节点，直接使用计算的值
-                                            elif source_node_id in logic_node_values:
-                                                converted_inputs[input_name] = logic_node_values[source_node_id]
-                                                logger.info(f"节点{node_id}.{input_name}: 内联 logic 节点{source_node_id}的值 = {logic_node_values[source_node_id]}")
-                                            else:
-                                                # 检查源节点是否存在（不在prompt中或已被跳过）
-                                                if source_node_id not in prompt and source_node_id not in skipped_node_ids:
-                                                    logger.warning(f"节点{node_id}.{input_name}: 源节点 {source_node_id} 不存在，跳过此输入")
-                                                    # 不设置此输入，让ComfyUI使用默认值或报错
-                                                else:
-                                                    converted_inputs[input_name] = [source_node_id, source_output_index]
-                                        else:
-                                            # 如果找不到 link，保持原值或设为 None
-                                            logger.warning(f"节点{node_id}.{input_name}: 链接 {link_id} 在 links_map 中不存在")
-                                            converted_inputs[input_name] = None
-                                        # 如果有 widget，需要跳过 widgets_values 中的对应值（仅当是列表时）
-                                        if not widgets_values_is_dict and has_widget and widget_index < len(widgets_values):
-                                            widget_index += 1
-                                    else:
-                                        # 如果没有 link，尝试从 value 字段或 widgets_values 获取值
-                                        if "value" in input_item:
-                                            converted_inputs[input_name] = input_item["value"]
-                                        elif has_widget:
-                                            # 从 widgets_values 获取值
-                                            widget_value = None
-                                            if widgets_values_is_dict:
-                                                # 字典模式：按名称匹配
-                                                widget_value = widgets_values.get(input_name)
-                                            elif widget_index < len(widgets_values):
-                                                # 列表模式：按顺序匹配
-                                                widget_value = widgets_values[widget_index]
-                                                widget_index += 1
-                                            
-                                            # 跳过 null 值（可能是可选输入）
-                                            if widget_value is not None:
-                                                converted_inputs[input_name] = widget_value
-                                        # 如果没有值，不设置（可能是可选输入）
-                        converted_node["inputs"] = converted_inputs
-                    else:
-                        converted_node[key] = value
-            # 将 type 字段转换为 class_type（ComfyUI API 需要）
-            if "type" in converted_node:
-                node_type = converted_node["type"]
-                # 检查节点类型是否包含管道符（命名空间），如 "MathExpression|pysssss"
-                if "|" in node_type:
-                    # 如果包含管道符，直接使用
-                    converted_node["class_type"] = node_type
-                else:
-                    # 如果不包含管道符，检查是否有properties中的cnr_id
-                    properties = converted_node.get("properties", {})
-                    cnr_id = properties.get("cnr_id")
-                    if cnr_id:
-                        # 尝试使用 "节点类型|插件ID" 格式
-                        # 但ComfyUI API通常只需要节点类型名称，不需要插件ID
-                        converted_node["class_type"] = node_type
-                    else:
-                        converted_node["class_type"] = node_type
-                # 保留 type 字段（某些情况下可能需要）
-            # 确保节点有 class_type 字段（ComfyUI API 必需）
-            if "class_type" not in converted_node:
-                if "type" in converted_node:
-                    converted_node["class_type"] = converted_node["type"]
-                else:
-                    logger.warning(f"节点 {node_id} 缺少 type 和 class_type 字段")
-            prompt[node_id] = converted_node
-        logger.info("已转换 nodes 数组格式为节点 ID key 格式")
-        
-        # 后处理：验证关键节点的必需输入是否已设置，并尝试修复
-        # 这有助于早期发现链接解析问题
-        critical_nodes = {
-            "28": {"vae": "WANVAE", "samples": "LATENT"},  # WanVideoDecode
-            "77": {"image": "IMAGE", "width": "INT", "height": "INT"},  # ImageResizeKJv2
-            "79": {"image_1": "IMAGE"},  # ImageConcatMulti
-            "131": {"images": "IMAGE"},  # PreviewImage
-        }
-        
-        # 尝试修复缺失的链接
-        for node_id, required_inputs in critical_nodes.items():
-            if node_id in prompt:
-                if "inputs" not in prompt[node_id]:
-                    logger.warning(f"⚠️ 关键节点 {node_id} 缺少 inputs 对象")
-                    prompt[node_id]["inputs"] = {}
-                
-                for input_name, input_type in required_inputs.items():
-                    if input_name not in prompt[node_id]["inputs"] or prompt[node_id]["inputs"][input_name] is None:
-                        logger.warning(f"⚠️ 关键节点 {node_id} 缺少必需输入 {input_name} ({input_type})，尝试修复")
-                        
-                        # 从原始workflow中查找此节点的输入链接
-                        for orig_node in workflow_data["nodes"]:
-                            if str(orig_node["id"]) == node_id:
-                                if "inputs" in orig_node and isinstance(orig_node["inputs"], list):
-                                    for input_item in orig_node["inputs"]:
-                                        if isinstance(input_item, dict) and input_item.get("name") == input_name:
-                                            if "link" in input_item and input_item["link"] is not None:
-                                                link_id = input_item["link"]
-                                                logger.info(f"  节点{node_id}.{input_name} 的链接ID: {link_id}")
-                                                
-                                                # 查找这个链接的源节点
-                                                if "links" in workflow_data:
-                                                    for link in workflow_data["links"]:
-                                                        if len(link) >= 6 and link[0] == link_id:
-                                                            source_node_id = str(link[1])
-                                                            source_output_index = link[2]
-                                                            logger.info(f"  链接{link_id}: 源节点 {source_node_id}, 输出索引 {source_output_index}")
-                                                            
-                                                            # 检查源节点类型
-                                                            source_node_type = None
-                                                            source_node_name = None
-                                                            for src_node in workflow_data["nodes"]:
-                                                                if str(src_node["id"]) == source_node_id:
-                                                                    source_node_type = src_node.get("type")
-                                                                    source_node_name = src_node.get("title", "")
-                                                                    break
-                                                            
-                                                            logger.info(f"  源节点类型: {source_node_type}, 名称: {source_node_name}")
-                                                            
-                                                            # 如果源节点是GetNode，查找对应的SetNode
-                                                            if source_node_type == "GetNode":
-                                                                getnode_name = source_node_name.replace("Get_", "")
-                                                                if not getnode_name:
-                                                                    for src_node in workflow_data["nodes"]:
-                                                                        if str(src_node["id"]) == source_node_id:
-                                                                            if src_node.get("widgets_values"):
-                                                                                getnode_name = src_node["widgets_values"][0] if isinstance(src_node["widgets_values"], list) else ""
-                                                                            break
-                                                                
-                                                                logger.info(f"  GetNode名称: {getnode_name}")
-                                                                
-                                                                # 查找对应的SetNode
-                                                                for setnode in workflow_data["nodes"]:
-                                                                    if setnode.get("type") == "SetNode":
-                                                                        setnode_name = setnode.get("title", "").replace("Set_", "")
-                                                                        if not setnode_name and setnode.get("widgets_values"):
-                                                                            setnode_name = setnode["widgets_values"][0] if isinstance(setnode["widgets_values"], list) else ""
-                                                                        
-                                                                        if setnode_name == getnode_name:
-                                                                            # 找到SetNode，查找其输入链接
-                                                                            logger.info(f"  找到SetNode {setnode['id']}: {setnode_name}")
-                                                                            if "inputs" in setnode and isinstance(setnode["inputs"], list):
-                                                                                for setnode_input in setnode["inputs"]:
-                                                                                    if isinstance(setnode_input, dict) and "link" in setnode_input:
-                                                                                        setnode_link_id = setnode_input["link"]
-                                                                                        logger.info(f"  SetNode的输入链接ID: {setnode_link_id}")
-                                                                                        # 查找SetNode的源节点
-                                                                                        for link2 in workflow_data["links"]:
-                                                                                            if len(link2) >= 6 and link2[0] == setnode_link_id:
-                                                                                                actual_source_id = str(link2[1])
-                                                                                                actual_output_index = link2[2]
-                                                                                                logger.info(f"  SetNode的源节点: {actual_source_id}, 输出索引: {actual_output_index}")
-                                                                                                
-                                                                                                # 设置链接
-                                                                                                if actual_source_id not in skipped_node_ids:
-                                                                                                    prompt[node_id]["inputs"][input_name] = [actual_source_id, actual_output_index]
-                                                                                                    logger.info(f"  ✅ 修复成功: 节点{node_id}.{input_name} = [{actual_source_id}, {actual_output_index}]")
-                                                                                                break
-                                                                                        break
-                                                                            break
-                                                            else:
-                                                                # 源节点不是GetNode，直接使用
-                                                                if source_node_id not in skipped_node_ids:
-                                                                    prompt[node_id]["inputs"][input_name] = [source_node_id, source_output_index]
-                                                                    logger.info(f"  ✅ 修复成功: 节点{node_id}.{input_name} = [{source_node_id}, {source_output_index}]")
-                                                            break
-                                            break
-                                break
-    else:
-        # new_Wan22_api.json 使用节点 ID key 格式
-        prompt = workflow_data
+    # 预先计算 comfyui-logic 节点的值（避免依赖插件），转换时直接内联到引用它们的输入
+    logic_node_values = {}
+    if is_mega_model:
+        # 节点592: Seconds/batch = length / 16
+        logic_node_values["592"] = int(length / 16.0)
+        # 节点593: Megapixel
+        logic_node_values["593"] = job_input.get("megapixel", 0.5)
+        # 节点585: Overlapping Frames
+        # MEGA 模型推荐使用 1 帧重叠，且 VHS_DuplicateImages 节点要求 multiply_by >= 1
+        logic_node_values["585"] = job_input.get("overlapping_frames", 1)
+        logger.info(f"预计算 logic 节点值: 592={logic_node_values['592']}, 593={logic_node_values['593']}, 585={logic_node_values['585']}")
+    
+    # UI 格式（nodes 数组）的 workflow 只在首次使用或文件变化时转换为 API 格式，
+    # 每个任务拿到模板的副本后只修改自己的参数
+    compiled_workflow = get_compiled_workflow(workflow_file, use_steadydancer, logic_node_values.keys())
+    prompt = instantiate_workflow(compiled_workflow, logic_node_values)
     
     # 更新模型名称（仅对标准 workflow）
     if not is_mega_model and available_models:
@@ -1362,23 +2794,8 @@ def handler(job):
                 prompt["574"]["inputs"] = {}
             
             # 获取 CheckpointLoaderSimple 的实际可用模型列表
-            checkpoint_models = []
-            try:
-                url = f"http://{server_address}:8188/object_info"
-                with urllib_request.urlopen(url, timeout=5) as response:
-                    object_info = json.loads(response.read())
-                    if "CheckpointLoaderSimple" in object_info:
-                        loader_info = object_info["CheckpointLoaderSimple"]
-                        if "input" in loader_info and "required" in loader_info["input"]:
-                            if "ckpt_name" in loader_info["input"]["required"]:
-                                checkpoint_models = loader_info["input"]["required"]["ckpt_name"]
-                                if isinstance(checkpoint_models, list) and len(checkpoint_models) > 0:
-                                    if isinstance(checkpoint_models[0], list):
-                                        checkpoint_models = checkpoint_models[0]
-                                    checkpoint_models = [m for m in checkpoint_models if isinstance(m, str)]
-                        logger.info(f"CheckpointLoaderSimple 可用模型列表: {checkpoint_models}")
-            except Exception as e:
-                logger.warning(f"获取 CheckpointLoaderSimple 模型列表失败: {e}")
+            checkpoint_models = model_registry.options("CheckpointLoaderSimple", "ckpt_name")
+            logger.info(f"CheckpointLoaderSimple 可用模型列表: {checkpoint_models}")
             
             # 决定使用哪个模型名称
             if checkpoint_models:
@@ -1553,10 +2970,8 @@ def handler(job):
             logger.info(f"节点76 (LoadImage): {image_path}")
         
         # 节点 75: VHS_LoadVideo (输入视频)
-        video_path = job_input.get("video_path") or job_input.get("video_url") or job_input.get("video_base64")
-        if video_path:
-            video_path_local = process_input(video_path, task_id, "input_video.mp4", 
-                                            "path" if "video_path" in job_input else ("url" if "video_url" in job_input else "base64"))
+        video_path_local = staged_inputs.get("video")
+        if video_path_local:
             if "75" in prompt:
                 if "widgets_values" in prompt["75"]:
                     widgets = prompt["75"]["widgets_values"]
@@ -1567,7 +2982,13 @@ def handler(job):
                 if "inputs" not in prompt["75"]:
                     prompt["75"]["inputs"] = {}
                 prompt["75"]["inputs"]["video"] = video_path_local
-                logger.info(f"节点75 (VHS_LoadVideo): {video_path_local}")
+                # 可选：只加载驱动视频的一段（帧数上限 / 跳过开头帧数）
+                for key in ("frame_load_cap", "skip_first_frames"):
+                    if key in job_input:
+                        prompt["75"]["inputs"][key] = int(job_input[key])
+                        if isinstance(prompt["75"].get("widgets_values"), dict):
+                            prompt["75"]["widgets_values"][key] = int(job_input[key])
+                logger.info(f"节点75 (VHS_LoadVideo): {video_path_local}, frame_load_cap={prompt['75']['inputs'].get('frame_load_cap')}, skip_first_frames={prompt['75']['inputs'].get('skip_first_frames')}")
         else:
             logger.warning("⚠️ 未提供输入视频，SteadyDancer workflow 需要输入视频用于姿态检测")
         
@@ -1694,86 +3115,10 @@ def handler(job):
         
         # 节点 129: OnnxDetectionModelLoader (姿态检测模型)
         if "129" in prompt:
-            # 获取可用模型列表
-            try:
-                url = f"http://{server_address}:8188/object_info"
-                with urllib_request.urlopen(url, timeout=5) as response:
-                    object_info = json.loads(response.read())
-                    if "OnnxDetectionModelLoader" in object_info:
-                        loader_info = object_info["OnnxDetectionModelLoader"]
-                        available_vitpose = []
-                        available_yolo = []
-                        
-                        if "input" in loader_info and "required" in loader_info["input"]:
-                            if "vitpose_model" in loader_info["input"]["required"]:
-                                available_vitpose = loader_info["input"]["required"]["vitpose_model"]
-                                if isinstance(available_vitpose, list) and len(available_vitpose) > 0:
-                                    if isinstance(available_vitpose[0], list):
-                                        available_vitpose = available_vitpose[0]
-                                    available_vitpose = [m for m in available_vitpose if isinstance(m, str)]
-                            if "yolo_model" in loader_info["input"]["required"]:
-                                available_yolo = loader_info["input"]["required"]["yolo_model"]
-                                if isinstance(available_yolo, list) and len(available_yolo) > 0:
-                                    if isinstance(available_yolo[0], list):
-                                        available_yolo = available_yolo[0]
-                                    available_yolo = [m for m in available_yolo if isinstance(m, str)]
-                        
-                        logger.info(f"OnnxDetectionModelLoader 可用模型: vitpose={available_vitpose}, yolo={available_yolo}")
-                        
-                        # 如果列表为空，尝试从文件系统扫描
-                        if not available_vitpose or not available_yolo:
-                            detection_dirs = [
-                                ("/ComfyUI/models/detection", "detection"),
-                                ("/ComfyUI/models/onnx", "onnx")
-                            ]
-                            for detection_dir, prefix in detection_dirs:
-                                if os.path.exists(detection_dir):
-                                    for file in os.listdir(detection_dir):
-                                        if file.endswith('.onnx'):
-                                            file_path = os.path.join(detection_dir, file)
-                                            if os.path.isfile(file_path):
-                                                # 尝试多种路径格式
-                                                path_formats = [
-                                                    f"{prefix}/{file}",  # 带前缀的路径
-                                                    file,  # 仅文件名
-                                                ]
-                                                for relative_path in path_formats:
-                                                    if 'vitpose' in file.lower() and relative_path not in available_vitpose:
-                                                        available_vitpose.append(relative_path)
-                                                    if 'yolo' in file.lower() and relative_path not in available_yolo:
-                                                        available_yolo.append(relative_path)
-                            if available_vitpose or available_yolo:
-                                logger.info(f"从文件系统扫描到的模型: vitpose={available_vitpose}, yolo={available_yolo}")
-            except Exception as e:
-                logger.warning(f"获取 OnnxDetectionModelLoader 模型列表失败: {e}")
-                available_vitpose = []
-                available_yolo = []
-                # 尝试从文件系统扫描作为后备
-                try:
-                    detection_dirs = [
-                        ("/ComfyUI/models/detection", "detection"),
-                        ("/ComfyUI/models/onnx", "onnx")
-                    ]
-                    for detection_dir, prefix in detection_dirs:
-                        if os.path.exists(detection_dir):
-                            for file in os.listdir(detection_dir):
-                                if file.endswith('.onnx'):
-                                    file_path = os.path.join(detection_dir, file)
-                                    if os.path.isfile(file_path):
-                                        # 尝试多种路径格式
-                                        path_formats = [
-                                            f"{prefix}/{file}",  # 带前缀的路径
-                                            file,  # 仅文件名
-                                        ]
-                                        for relative_path in path_formats:
-                                            if 'vitpose' in file.lower() and relative_path not in available_vitpose:
-                                                available_vitpose.append(relative_path)
-                                            if 'yolo' in file.lower() and relative_path not in available_yolo:
-                                                available_yolo.append(relative_path)
-                    if available_vitpose or available_yolo:
-                        logger.info(f"从文件系统扫描到的模型（后备）: vitpose={available_vitpose}, yolo={available_yolo}")
-                except Exception as scan_error:
-                    logger.warning(f"文件系统扫描失败: {scan_error}")
+            # 获取可用模型列表（模型索引中已包含文件系统扫描的补充结果）
+            available_vitpose = model_registry.options("OnnxDetectionModelLoader", "vitpose_model")
+            available_yolo = model_registry.options("OnnxDetectionModelLoader", "yolo_model")
+            logger.info(f"OnnxDetectionModelLoader 可用模型: vitpose={available_vitpose}, yolo={available_yolo}")
             
             # 尝试不同的路径格式（按优先级排序）
             vitpose_candidates = [
@@ -2871,251 +4216,277 @@ def handler(job):
     
     logger.info("=" * 60)
     
-    ws_url = f"ws://{server_address}:8188/ws?clientId={client_id}"
-    logger.info(f"Connecting to WebSocket: {ws_url}")
-    
-    # 먼저 HTTP 연결이 가능한지 확인
-    http_url = f"http://{server_address}:8188/"
-    logger.info(f"Checking HTTP connection to: {http_url}")
-    
-    # HTTP 연결 확인 (최대 1분)
-    max_http_attempts = 180
-    for http_attempt in range(max_http_attempts):
-        try:
-            response = urllib_request.urlopen(http_url, timeout=5)
-            logger.info(f"HTTP 연결 성공 (시도 {http_attempt+1})")
-            break
-        except Exception as e:
-            logger.warning(f"HTTP 연결 실패 (시도 {http_attempt+1}/{max_http_attempts}): {e}")
-            if http_attempt == max_http_attempts - 1:
-                raise Exception("ComfyUI 서버에 연결할 수 없습니다. 서버가 실행 중인지 확인하세요.")
-            time.sleep(1)
-    
-    ws = websocket.WebSocket()
-    # 웹소켓 연결 시도 (최대 3분)
-    max_attempts = int(180/5)  # 3분 (1초에 한 번씩 시도)
-    for attempt in range(max_attempts):
+    timer.lap("workflow_build")
+    cancel.check()
+
+    segment_mode = use_steadydancer and staged_inputs.get("video") and job_input.get("segment_mode", prompt_count > 1)
+
+    # 相同任务（队列重试、重复提交）直接返回缓存结果
+    result_fingerprint = None
+    if result_cache.enabled and not job_input.get("no_cache", False):
+        fingerprint_payload = prompt
+        if segment_mode:
+            # 分段任务按拼接后的完整视频缓存，命中时直接返回完整视频（不再逐段通知）
+            fingerprint_payload = {
+                "prompt": prompt,
+                "segments": prompt_lines or [positive_prompt],
+                "segment_continuity": job_input.get("segment_continuity", "reference"),
+                "length": job_input.get("length", 81),
+            }
+        result_fingerprint = compute_result_fingerprint(fingerprint_payload, staged_inputs.values())
+        cached_result = get_cached_result(result_fingerprint, job_id, output_mode, base64_limit)
+        timer.lap("result_cache")
+        if cached_result:
+            return cached_result
+
+    # SteadyDancer 多提示词：每个提示词作为独立片段提交，完成一段交付一段
+    if segment_mode:
         try:
-            ws.connect(ws_url)
-            logger.info(f"웹소켓 연결 성공 (시도 {attempt+1})")
-            break
+            return run_segmented_job(
+                prompt, prompt_lines or [positive_prompt], job, job_input, task_dir, job_id, output_mode, timer, cancel,
+                staged_inputs.get("video"), result_fingerprint,
+            )
+        except JobCancelled:
+            raise
         except Exception as e:
-            logger.warning(f"웹소켓 연결 실패 (시도 {attempt+1}/{max_attempts}): {e}")
-            if attempt == max_attempts - 1:
-                raise Exception("웹소켓 연결 시간 초과 (3분)")
-            time.sleep(5)
+            logger.error(f"Segmented generation failed: {e}")
+            return error_result(e)
+
+    # 复用进程内的长连接；首次任务（或连接断开后）才会做就绪探测和重连
     try:
-        videos, execution_history = get_videos(ws, prompt, is_mega_model or use_steadydancer)
-        ws.close()
+        (videos, _), oom_fallback = run_with_oom_fallback(
+            prompt,
+            lambda attempt: get_videos(attempt, is_mega_model or use_steadydancer, job, task_dir, timer, cancel=cancel),
+            resolve_oom_ladder(job_input),
+        )
+        if oom_fallback:
+            # 降级后的结果与请求的参数不一致，不写入结果缓存
+            result_fingerprint = None
 
-        # 调试：打印所有返回的视频节点
-        logger.info(f"📹 get_videos 返回的节点: {list(videos.keys())}")
-        for node_id in videos:
-            video_count = len(videos[node_id]) if videos[node_id] else 0
-            logger.info(f"  节点 {node_id}: {video_count} 个视频")
-        
-        # 检查执行历史中关键节点的详细信息
-        if execution_history:
-            logger.info(f"📋 执行历史存在，检查 outputs...")
-            if 'outputs' in execution_history:
-                all_output_nodes = list(execution_history['outputs'].keys())
-                logger.info(f"📋 执行历史中的输出节点 ({len(all_output_nodes)} 个): {all_output_nodes}")
-                
-                # 检查关键节点链：28 -> 79 -> 115 -> 83
-                key_nodes = ["28", "79", "115", "83"]
-                logger.info("=" * 60)
-                logger.info("关键节点执行状态检查:")
-                for node_id in key_nodes:
-                    if node_id in execution_history['outputs']:
-                        node_output = execution_history['outputs'][node_id]
-                        output_keys = list(node_output.keys())
-                        logger.info(f"✅ 节点 {node_id} 已执行，输出字段: {output_keys}")
-                        
-                        # 如果是图像节点，检查是否有 images 输出
-                        if 'images' in node_output:
-                            images = node_output['images']
-                            if isinstance(images, list):
-                                logger.info(f"   图像数量: {len(images)}")
-                            else:
-                                logger.info(f"   图像输出: {type(images).__name__}")
-                    else:
-                        logger.error(f"❌ 节点 {node_id} 未执行或不在输出中！")
-                        # 分析为什么这个节点没有执行
-                        if node_id == "83":
-                            logger.error("   → 节点 83 未执行，检查前置节点...")
-                            if "115" not in execution_history['outputs']:
-                                logger.error("     → 节点 115 未执行，导致节点 83 无法执行")
-                                if "28" not in execution_history['outputs']:
-                                    logger.error("       → 节点 28 未执行，导致节点 115 无法执行")
-                                if "79" not in execution_history['outputs']:
-                                    logger.error("       → 节点 79 未执行，导致节点 115 无法执行")
-                        elif node_id == "115":
-                            logger.error("   → 节点 115 未执行，检查前置节点...")
-                            if "28" not in execution_history['outputs']:
-                                logger.error("     → 节点 28 未执行")
-                            if "79" not in execution_history['outputs']:
-                                logger.error("     → 节点 79 未执行")
-                logger.info("=" * 60)
-                
-                # 详细检查节点 83
-                if "83" in execution_history['outputs']:
-                    node83_output = execution_history['outputs']["83"]
-                    logger.info(f"📊 节点 83 的输出信息: {list(node83_output.keys())}")
-                    if 'videos' in node83_output:
-                        videos_list = node83_output['videos']
-                        logger.info(f"📹 节点 83 的 videos 列表长度: {len(videos_list)}")
-                        for i, video in enumerate(videos_list):
-                            video_path = video.get('fullpath', video.get('filename', 'N/A'))
-                            video_type = video.get('type', 'unknown')
-                            save_output = video.get('save_output', 'unknown')
-                            subfolder = video.get('subfolder', '')
-                            logger.info(f"   视频 {i}: {video_path}")
-                            logger.info(f"     type: {video_type}, save_output: {save_output}, subfolder: {subfolder}")
-                            if video_path and isinstance(video_path, str):
-                                if os.path.exists(video_path):
-                                    file_size = os.path.getsize(video_path)
-                                    logger.info(f"     ✅ 文件存在，大小: {file_size} 字节")
-                                else:
-                                    logger.warning(f"     ❌ 文件不存在: {video_path}")
-                                    # 尝试查找可能的路径
-                                    possible_paths = [
-                                        f"/ComfyUI/output/{video_path}",
-                                        f"/ComfyUI/output/{subfolder}/{video_path}" if subfolder else None,
-                                        video_path.replace("temp", "output") if "temp" in video_path else None,
-                                    ]
-                                    for possible_path in possible_paths:
-                                        if possible_path and os.path.exists(possible_path):
-                                            logger.info(f"     ✅ 找到文件在备用路径: {possible_path}")
-                            else:
-                                logger.warning(f"     ❌ 视频路径无效: {video_path} (类型: {type(video_path).__name__})")
-                    else:
-                        logger.error("❌ 节点 83 的输出中没有 'videos' 字段")
-                        logger.error(f"   节点 83 的输出字段: {list(node83_output.keys())}")
-                        # 检查是否有 images 输出（可能节点 83 执行了但没有生成视频）
-                        if 'images' in node83_output:
-                            logger.warning("   ⚠️ 节点 83 有 images 输出但没有 videos，可能 save_output=False 或格式错误")
-                else:
-                    logger.error("❌ 节点 83 不在执行历史的输出中！")
-                    logger.error("   可能原因（按执行顺序分析）：")
-                    
-                    # 分析节点链依赖关系
-                    node_dependencies = {
-                        "83": ["115"],
-                        "115": ["28", "79"],
-                        "28": ["118", "38"],
-                        "118": ["119"],
-                        "119": ["71", "78"],
-                        "71": ["63", "72", "82"]
-                    }
-                    
-                    # 递归分析节点失败原因
-                    def analyze_node_failure(node_id, depth=0):
-                        indent = "     " * depth
-                        if node_id not in execution_history.get('outputs', {}):
-                            # 检查是否有该节点的错误信息
-                            node_errors = execution_history.get('_node_errors', {})
-                            if node_id in node_errors:
-                                error_info = node_errors[node_id]
-                                error_type = error_info.get('type', '')
-                                error_msg = error_info.get('error', '')
-                                exception_msg = error_info.get('exception_message', '')
-                                
-                                logger.error(f"{indent}→ 节点 {node_id} 未执行 ❌ 执行失败")
-                                logger.error(f"{indent}   错误类型: {error_type}")
-                                
-                                # 显示关键错误信息
-                                if exception_msg:
-                                    # 截取关键部分（避免过长）
-                                    short_msg = exception_msg[:150] + "..." if len(exception_msg) > 150 else exception_msg
-                                    logger.error(f"{indent}   错误详情: {short_msg}")
-                                elif error_msg:
-                                    short_msg = str(error_msg)[:150] + "..." if len(str(error_msg)) > 150 else str(error_msg)
-                                    logger.error(f"{indent}   错误信息: {short_msg}")
-                                
-                                # 如果是参数冲突错误，给出特殊提示
-                                if 'got multiple values for keyword argument' in str(exception_msg):
-                                    keyword_arg = 'is_uncond' if 'is_uncond' in str(exception_msg) else 'unknown'
-                                    logger.error(f"{indent}   ⚠️ 这是版本兼容性问题！'{keyword_arg}' 参数冲突")
-                                    logger.error(f"{indent}   解决方案: 更新 workflow JSON 或固定 ComfyUI/WanVideoWrapper 版本")
-                            else:
-                                logger.error(f"{indent}→ 节点 {node_id} 未执行（可能因前置节点失败）")
-                            
-                            # 继续分析依赖节点
-                            if node_id in node_dependencies:
-                                for dep in node_dependencies[node_id]:
-                                    analyze_node_failure(dep, depth + 1)
-                    
-                    analyze_node_failure("83")
-                    
-                    logger.error("")
-                    logger.error("   建议解决方案：")
-                    logger.error("   1. 检查 workflow JSON 文件是否与当前模型版本兼容")
-                    logger.error("   2. 确认所有必需的模型文件已正确加载")
-                    logger.error("   3. 查看上方的错误日志，定位具体失败的节点")
-                    logger.error("   4. 如果是参数冲突错误，尝试更新 ComfyUI 和相关插件")
-            else:
-                logger.error("❌ 执行历史中没有 'outputs' 字段！")
-                logger.error(f"   执行历史的字段: {list(execution_history.keys())}")
-                if 'error' in execution_history:
-                    logger.error(f"   执行错误: {execution_history['error']}")
-        else:
-            logger.error("❌ 执行历史为空！")
+        logger.info(f"📹 生成视频的节点: { {node_id: len(paths) for node_id, paths in videos.items() if paths} }")
 
         # SteadyDancer workflow: 只返回节点 83 的最终视频，如果没有则报错，绝不返回节点 117
         if use_steadydancer:
             # 只检查节点 83 的视频（最终生成的跳舞视频）
             if "83" in videos and videos["83"]:
                 logger.info("✅ 返回节点 83 的最终生成视频（跳舞视频）")
-                return {"video": videos["83"][0]}
+                result = deliver_and_cache_video(videos["83"][0], job_id, output_mode, result_fingerprint, base64_limit)
+                timer.lap("output_delivery")
+                if oom_fallback:
+                    result["oom_fallback"] = oom_fallback
+                return result
             
             # 节点 83 没有视频，直接返回错误（不返回任何其他节点的视频）
             logger.error("❌ 节点 83 没有视频输出！")
             logger.error(f"可用的节点: {list(videos.keys())}")
             
-            # 检查是否有节点 117 的视频（用于错误提示）
+            # 节点 83 之前的节点失败时 get_videos 已抛出带错误码的 JobError，这里多为 workflow 连接/配置问题
             if "117" in videos and videos["117"]:
-                logger.error("❌ 检测到节点 117（姿态视频），但节点 83（最终视频）未生成")
-                error_msg = (
-                    "视频生成失败：只生成了姿态检测视频（节点 117），没有生成最终的跳舞视频（节点 83）。\n\n"
-                    "可能原因：\n"
-                    "1. 节点 83 的 images 输入连接错误（缺少前置节点输出）\n"
-                    "2. 工作流执行过程中节点 83 未执行（检查前置节点 115、28、79 是否正常执行）\n"
-                    "3. 节点 83 的 save_output 参数未正确设置\n\n"
-                    "建议解决方案：\n"
-                    "• 检查 workflow JSON 文件的节点连接配置\n"
-                    "• 查看上方详细的节点执行状态日志\n"
-                    "• 确认所有必需的模型文件已正确加载"
-                )
-                return {"error": error_msg}
+                error_msg = "视频生成失败：只生成了姿态检测视频（节点 117），没有生成最终的跳舞视频（节点 83），请检查 workflow 中节点 83 的连接和 save_output 设置"
             else:
-                logger.error("❌ 节点 83 和节点 117 都没有视频输出")
-                error_msg = (
-                    "视频生成失败：节点 83（最终视频）和节点 117（姿态视频）都没有生成视频。\n\n"
-                    "可能原因：\n"
-                    "1. 工作流执行失败（检查是否有 TypeError 或参数冲突错误）\n"
-                    "2. 输入图片或视频格式不正确\n"
-                    "3. Workflow 配置文件与当前模型版本不兼容\n"
-                    "4. GPU 内存不足导致执行中断\n\n"
-                    "建议解决方案：\n"
-                    "• 查看上方的详细错误日志，特别是 TypeError 或参数冲突错误\n"
-                    "• 确认输入的图片和视频文件格式正确（支持 jpg/png/mp4）\n"
-                    "• 如果是参数冲突错误，尝试更新 ComfyUI 和 ComfyUI-WanVideoWrapper\n"
-                    "• 检查 GPU 内存是否充足"
-                )
-                return {"error": error_msg}
+                error_msg = "视频生成失败：节点 83（最终视频）没有输出，请检查 workflow 配置是否与当前 ComfyUI/WanVideoWrapper 版本兼容"
+            return JobError("VERSION_MISMATCH", error_msg, "83").as_result()
         
         # 对于其他 workflow，返回第一个找到的视频
         for node_id in videos:
             if videos[node_id]:
                 logger.info(f"返回节点 {node_id} 的视频")
-                return {"video": videos[node_id][0]}
+                result = deliver_and_cache_video(videos[node_id][0], job_id, output_mode, result_fingerprint, base64_limit)
+                timer.lap("output_delivery")
+                if oom_fallback:
+                    result["oom_fallback"] = oom_fallback
+                return result
         
-        return {"error": "비디오를를 찾을 수 없습니다."}
+        return {"error": "비디오를를 찾을 수 없습니다.", "error_code": "UNKNOWN", "retryable": False}
+    except JobCancelled:
+        raise
+    except Exception as e:
+        logger.error(f"Video generation failed: {e}")
+        return error_result(e)
+
+# 健康检查/指标 HTTP 端口，0 表示不启动
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "8081"))
+
+def check_readiness():
+    """返回 (是否就绪, 各项检查结果)"""
+    checks = {
+        "models_loaded": model_registry.loaded,
+        "websocket_connected": comfy.websocket_connected(),
+    }
+    return all(checks.values()), checks
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render_metrics():
+    """生成 Prometheus 文本格式的指标"""
+    lines = []
+    declared = set()
+
+    def metric(name, value, help_text, metric_type="gauge", labels=None):
+        if name not in declared:
+            declared.add(name)
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+        label_text = "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels.items()) + "}" if labels else ""
+        lines.append(f"{name}{label_text} {value}")
+
+    ready, checks = check_readiness()
+    metric("steadydancer_ready", int(ready), "Worker readiness (models loaded and WebSocket connected)")
+    for check, ok in checks.items():
+        metric("steadydancer_readiness_check", int(ok), "Individual readiness checks", labels={"check": check})
+    metric("steadydancer_jobs_in_flight", worker_metrics.in_flight, "Jobs currently being processed")
+    for status, count in sorted(worker_metrics.jobs_total.items()):
+        metric("steadydancer_jobs_total", count, "Finished jobs by status", "counter", {"status": status})
+    for error_type, count in sorted(worker_metrics.errors_total.items()):
+        metric("steadydancer_job_errors_total", count, "Failed jobs by error type", "counter", {"type": error_type})
+    for phase, seconds in sorted(worker_metrics.last_job.items()):
+        metric("steadydancer_last_job_seconds", seconds, "Latency breakdown of the last job", labels={"phase": phase})
+    for node_id, seconds in worker_metrics.last_nodes:
+        metric("steadydancer_last_job_node_seconds", seconds, "Slowest ComfyUI nodes of the last job", labels={"node": node_id})
+    for phase, seconds in sorted(warmup_report.get("phases", {}).items()):
+        metric("steadydancer_warmup_seconds", seconds, "Warm-up phase durations", labels={"phase": phase})
+
+    try:
+        queue_info = comfy.get_json("/queue", timeout=2)
+        metric("comfyui_queue_running", len(queue_info.get("queue_running", [])), "Prompts currently executing in ComfyUI")
+        metric("comfyui_queue_pending", len(queue_info.get("queue_pending", [])), "Prompts waiting in the ComfyUI queue")
     except Exception as e:
-        ws.close()
-        error_message = str(e)
-        logger.error(f"Video generation failed: {error_message}")
-        return {"error": error_message}
+        logger.debug(f"获取 /queue 失败: {e}")
+    try:
+        system_stats = comfy.get_json("/system_stats", timeout=2)
+        for device in system_stats.get("devices", []):
+            labels = {"device": device.get("name", "unknown")}
+            for field in ("vram_total", "vram_free", "torch_vram_total", "torch_vram_free"):
+                if field in device:
+                    metric(f"comfyui_{field}_bytes", device[field], f"ComfyUI /system_stats {field}", labels=labels)
+    except Exception as e:
+        logger.debug(f"获取 /system_stats 失败: {e}")
+    return "\n".join(lines) + "\n"
+
+class HealthRequestHandler(BaseHTTPRequestHandler):
+    """/health/live、/health/ready、/metrics"""
+
+    def do_GET(self):
+        if self.path == "/health/live":
+            self._send(200, "application/json", json.dumps({"status": "alive"}))
+        elif self.path == "/health/ready":
+            ready, checks = check_readiness()
+            self._send(200 if ready else 503, "application/json", json.dumps({"ready": ready, "checks": checks}))
+        elif self.path == "/metrics":
+            self._send(200, "text/plain; version=0.0.4", render_metrics())
+        else:
+            self._send(404, "text/plain", "not found")
+
+    def _send(self, status, content_type, body):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"health: {format % args}")
+
+def start_health_server(port=HEALTH_PORT):
+    """在后台线程启动健康检查/指标 HTTP 服务"""
+    if port <= 0:
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", port), HealthRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="health-server", daemon=True).start()
+    logger.info(f"🩺 健康检查服务已启动: http://0.0.0.0:{port}/health/ready, /metrics")
+    return server
+
+# 同一 worker 上同时处理的任务数。始终使用异步入口（RunPod 的取消只能通过协程传递到 CancelToken）；
+# >1 时各任务在线程中并发运行，共用一个 WebSocket，下一个任务的输入下载/输出编码与当前任务的 GPU 执行重叠
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "1"))
+
+async def async_handler(job):
+    """
+    handler 的异步版本，供 RunPod 并发调度使用
+
+    RunPod 取消任务时协程收到 CancelledError：通知工作线程中断 ComfyUI 执行并清理，
+    协程本身立即返回，worker 可以马上接下一个任务。
+    """
+    cancel = CancelToken()
+    try:
+        return await asyncio.to_thread(handler, job, cancel)
+    except asyncio.CancelledError:
+        logger.warning(f"⛔ RunPod 取消了任务 {job.get('id')}")
+        cancel.cancel()
+        raise
+
+def concurrency_modifier(current_concurrency):
+    return MAX_CONCURRENCY
+
+# 预热：worker 开始接任务前用一个极小的 SteadyDancer 任务走一遍完整流程，
+# 让模型加载（DiT、umt5、clip_vision、vitpose/yolo）和 CUDA kernel 调优在接流量前完成
+WARMUP_ENABLED = os.getenv("WARMUP", "1") == "1"
+WARMUP_IMAGE = os.getenv("WARMUP_IMAGE", "/data/images/00001.png")
+WARMUP_VIDEO = os.getenv("WARMUP_VIDEO", "/data/videos/00002/video.mp4")
+# 最近一次预热的结果（各阶段耗时），便于排查冷启动
+warmup_report = {}
+
+def warmup(run_priming=True):
+    """预编译 workflow、构建模型索引，并（可选）跑一次低分辨率少步数的预热生成"""
+    phases = {}
+    started = time.time()
+    precompile_workflows()
+    phases["compile_workflows"] = round(time.time() - started, 2)
+
+    started = time.time()
+    model_registry.refresh()
+    phases["model_registry"] = round(time.time() - started, 2)
+
+    ok = True
+    priming_timings = {}
+    if run_priming:
+        if os.path.exists(WARMUP_IMAGE) and os.path.exists(WARMUP_VIDEO):
+            logger.info("🔥 开始预热生成...")
+            warmup_job = {
+                "id": f"warmup-{uuid.uuid4().hex[:8]}",
+                "warmup": True,
+                "input": {
+                    "use_steadydancer": True,
+                    "image_path": WARMUP_IMAGE,
+                    "video_path": WARMUP_VIDEO,
+                    "prompt": "a person dancing",
+                    "width": 256,
+                    "height": 448,
+                    "length": 17,
+                    "frame_load_cap": 17,
+                    "steps": 2,
+                    "output_mode": "base64",
+                    "no_cache": True,
+                },
+            }
+            started = time.time()
+            try:
+                result = handler(warmup_job)
+                priming_timings = result.get("timings", {})
+                ok = "error" not in result
+                if not ok:
+                    logger.warning(f"⚠️ 预热生成失败（不影响接收任务）: {result['error'][:500]}")
+            except Exception as e:
+                ok = False
+                logger.warning(f"⚠️ 预热生成异常（不影响接收任务）: {e}")
+            phases["priming_generation"] = round(time.time() - started, 2)
+        else:
+            logger.warning(f"⚠️ 预热素材不存在，跳过预热生成: {WARMUP_IMAGE}, {WARMUP_VIDEO}")
+
+    warmup_report.clear()
+    warmup_report.update(ok=ok, phases=phases, priming_timings=priming_timings, finished=time.time())
+    logger.info(f"🔥 预热完成: {json.dumps(warmup_report['phases'])}")
+    return warmup_report
 
 if __name__ == "__main__":
-    runpod.serverless.start({"handler": handler})
+    start_health_server()
+    workspaces.purge_stale()
+    warmup(run_priming=WARMUP_ENABLED)
+    comfy.start()
+    # kill -HUP <pid> 让下一个任务开始前重新构建模型索引
+    signal.signal(signal.SIGHUP, model_registry.mark_dirty)
+    logger.info(f"以异步模式启动，最大并发任务数: {MAX_CONCURRENCY}")
+    runpod.serverless.start({"handler": async_handler, "concurrency_modifier": concurrency_modifier})
@@ -0,0 +1,365 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+"""
+Long-lived SteadyDancer service.
+
+Loads WanI2VDancer (T5, CLIP, VAE and DiT) once and serves generate requests from a
+local queue, so model loading is paid once per process instead of once per video.
+
+Requests are JSON objects with the same fields as the generate_dancer.py arguments:
+    {"image": ..., "cond_pos_folder": ..., "cond_neg_folder": ..., "prompt": ...,
+     "frame_num": 81, "sample_steps": 40, "sample_guide_scale": 5.0, "base_seed": 42,
+     "save_file": "out.mp4"}
+Only image, cond_pos_folder and cond_neg_folder are required.
+
+They can be submitted over HTTP:
+    POST /jobs         -> {"id": ...}
+    GET  /jobs/<id>    -> {"id": ..., "status": "queued|running|done|failed", "save_file": ..., "error": ...}
+    GET  /health       -> {"status": "ok", "queued": n}
+or dropped as <name>.json files into --watch_dir. Dropped requests are moved to
+<watch_dir>/done or <watch_dir>/failed with a <name>.result.json next to them.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+import warnings
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+warnings.filterwarnings('ignore')
+
+import wan
+from wan.configs import MAX_AREA_CONFIGS, SUPPORTED_SIZES, WAN_CONFIGS
+from wan.utils.utils import cache_video, str2bool
+
+from generate_dancer import _init_logging, load_dancer_inputs
+
+# per-request fields and their defaults
+REQUEST_DEFAULTS = {
+    "prompt": "",
+    "n_prompt": "",
+    "frame_num": 81,
+    "sample_solver": "unipc",
+    "sample_steps": 40,
+    "sample_shift": None,
+    "sample_guide_scale": 5.0,
+    "condition_guide_scale": 1.5,
+    "base_seed": -1,
+    "save_file": None,
+}
+REQUIRED_FIELDS = ("image", "cond_pos_folder", "cond_neg_folder")
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Serve SteadyDancer video generation from a long-lived process")
+    parser.add_argument(
+        "--task",
+        type=str,
+        default="i2v-14B",
+        choices=[task for task in WAN_CONFIGS if "i2v" in task],
+        help="The task to run.")
+    parser.add_argument(
+        "--size",
+        type=str,
+        default="1024*576",
+        help="The area (width*height) of the generated video.")
+    parser.add_argument(
+        "--ckpt_dir",
+        type=str,
+        required=True,
+        help="The path to the checkpoint directory.")
+    parser.add_argument(
+        "--offload_model",
+        type=str2bool,
+        default=True,
+        help="Whether to offload the models to CPU between uses, reducing GPU memory usage.")
+    parser.add_argument(
+        "--memory_policy",
+        type=str,
+        default="offload",
+        choices=["offload", "resident_gpu"],
+        help="Where the sampling loop keeps its tensors when --offload_model is set, see generate_dancer.py.")
+    parser.add_argument(
+        "--batched_cfg",
+        action="store_true",
+        default=False,
+        help="Whether to run the cfg passes of each sampling step as one batched forward.")
+    parser.add_argument(
+        "--t5_cpu",
+        action="store_true",
+        default=False,
+        help="Whether to place T5 model on CPU.")
+    parser.add_argument(
+        "--t5_cache_dir",
+        type=str,
+        default=None,
+        help="A directory persisting T5 prompt embeddings, so repeated prompts skip the text encoder across runs.")
+    parser.add_argument(
+        "--st_cond_cfg",
+        type=float,
+        default=0.1,
+        help="Begin cfg with cond_neg_folder.")
+    parser.add_argument(
+        "--end_cond_cfg",
+        type=float,
+        default=0.4,
+        help="End cfg with cond_neg_folder.")
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="The address the HTTP queue listens on.")
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8090,
+        help="The port the HTTP queue listens on, 0 to disable HTTP.")
+    parser.add_argument(
+        "--watch_dir",
+        type=str,
+        default=None,
+        help="A directory polled for dropped <name>.json requests.")
+    parser.add_argument(
+        "--poll_interval",
+        type=float,
+        default=2.0,
+        help="Seconds between scans of --watch_dir.")
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default="outputs",
+        help="Where generated videos are saved when a request has no save_file.")
+    args = parser.parse_args()
+
+    assert args.size in SUPPORTED_SIZES[args.task], \
+        f"Unsupport size {args.size} for task {args.task}, supported sizes are: {', '.join(SUPPORTED_SIZES[args.task])}"
+    assert args.port or args.watch_dir, "Please enable at least one of --port and --watch_dir."
+    return args
+
+
+class DancerService:
+    """
+    Owns the pipeline and a FIFO job queue processed by a single worker thread.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.cfg = WAN_CONFIGS[args.task]
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+
+        logging.info("Creating WanI2VDancer pipeline.")
+        started = time.time()
+        self.pipeline = wan.WanI2VDancer(
+            config=self.cfg,
+            checkpoint_dir=args.ckpt_dir,
+            device_id=0,
+            rank=0,
+            t5_cpu=args.t5_cpu,
+            t5_cache_dir=args.t5_cache_dir,
+            st_cond_cfg=args.st_cond_cfg, end_cond_cfg=args.end_cond_cfg,
+        )
+        logging.info(f"Pipeline loaded in {time.time() - started:.1f}s.")
+
+    def submit(self, request, on_done=None):
+        missing = [field for field in REQUIRED_FIELDS if not request.get(field)]
+        if missing:
+            raise ValueError(f"Missing required fields: {', '.join(missing)}")
+        unknown = set(request) - set(REQUEST_DEFAULTS) - set(REQUIRED_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        job_id = uuid.uuid4().hex
+        job = dict(REQUEST_DEFAULTS, **request)
+        with self.lock:
+            self.jobs[job_id] = {"id": job_id, "status": "queued", "submitted": time.time()}
+        self.queue.put((job_id, job, on_done))
+        return job_id
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def _update(self, job_id, **fields):
+        with self.lock:
+            self.jobs[job_id].update(fields)
+            return dict(self.jobs[job_id])
+
+    def run_forever(self):
+        while True:
+            job_id, job, on_done = self.queue.get()
+            self._update(job_id, status="running", started=time.time())
+            try:
+                save_file = self._generate(job)
+                state = self._update(job_id, status="done", save_file=save_file, finished=time.time())
+            except Exception as e:
+                logging.exception(f"Job {job_id} failed.")
+                state = self._update(job_id, status="failed", error=str(e), finished=time.time())
+            logging.info(f"Job {job_id} {state['status']} in {state['finished'] - state['started']:.1f}s.")
+            if on_done is not None:
+                try:
+                    on_done(state)
+                except Exception:
+                    logging.exception(f"Callback of job {job_id} failed.")
+
+    def _generate(self, job):
+        args = self.args
+        img, img_x, img_c, condition_pos, condition_neg = load_dancer_inputs(
+            job["image"], job["cond_pos_folder"], job["cond_neg_folder"], job["frame_num"])
+
+        sample_shift = job["sample_shift"]
+        if sample_shift is None:
+            sample_shift = 3.0 if args.size in ["832*480", "480*832"] else 5.0
+        base_seed = job["base_seed"] if job["base_seed"] >= 0 else random.randint(0, sys.maxsize)
+
+        video = self.pipeline.generate(
+            job["prompt"],
+            img,
+            img_x=img_x,
+            img_c=img_c,
+            condition=condition_pos,
+            condition_null=condition_neg,
+            max_area=MAX_AREA_CONFIGS[args.size],
+            frame_num=job["frame_num"],
+            shift=sample_shift,
+            sample_solver=job["sample_solver"],
+            sampling_steps=job["sample_steps"],
+            guide_scale=job["sample_guide_scale"],
+            condition_guide_scale=job["condition_guide_scale"],
+            n_prompt=job["n_prompt"],
+            seed=base_seed,
+            offload_model=args.offload_model,
+            memory_policy=args.memory_policy,
+            batched_cfg=args.batched_cfg)
+
+        save_file = job["save_file"]
+        if save_file is None:
+            formatted_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+            save_file = os.path.join(args.output_dir, f"{args.task}_{args.size.replace('*', 'x')}_{base_seed}_{formatted_time}.mp4")
+        os.makedirs(os.path.dirname(os.path.abspath(save_file)), exist_ok=True)
+        logging.info(f"Saving generated video to {save_file}")
+        cache_video(
+            tensor=video[None],
+            save_file=save_file,
+            fps=self.cfg.sample_fps,
+            nrow=1,
+            normalize=True,
+            value_range=(-1, 1))
+        return save_file
+
+
+def _make_handler(service):
+
+    class JobRequestHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, code, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path.rstrip("/") != "/jobs":
+                return self._send_json(404, {"error": "not found"})
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(request, dict):
+                    raise ValueError("Request body must be a JSON object")
+                job_id = service.submit(request)
+            except ValueError as e:
+                return self._send_json(400, {"error": str(e)})
+            self._send_json(202, {"id": job_id})
+
+        def do_GET(self):
+            path = self.path.rstrip("/")
+            if path == "/health":
+                return self._send_json(200, {"status": "ok", "queued": service.queue.qsize()})
+            if path.startswith("/jobs/"):
+                state = service.status(path[len("/jobs/"):])
+                if state is None:
+                    return self._send_json(404, {"error": "unknown job"})
+                return self._send_json(200, state)
+            self._send_json(404, {"error": "not found"})
+
+        def log_message(self, format, *args):
+            logging.debug("%s - %s", self.address_string(), format % args)
+
+    return JobRequestHandler
+
+
+def watch_directory(service, watch_dir, poll_interval):
+    """
+    Poll watch_dir for <name>.json requests; each file is claimed by moving it to processing/.
+    """
+    processing_dir = os.path.join(watch_dir, "processing")
+    for sub_dir in ("processing", "done", "failed"):
+        os.makedirs(os.path.join(watch_dir, sub_dir), exist_ok=True)
+
+    def finish(name):
+
+        def on_done(state):
+            target_dir = os.path.join(watch_dir, "done" if state["status"] == "done" else "failed")
+            os.replace(os.path.join(processing_dir, name), os.path.join(target_dir, name))
+            with open(os.path.join(target_dir, name[:-len(".json")] + ".result.json"), "w") as f:
+                json.dump(state, f, indent=2)
+
+        return on_done
+
+    while True:
+        for name in sorted(os.listdir(watch_dir)):
+            if not name.endswith(".json"):
+                continue
+            source = os.path.join(watch_dir, name)
+            if os.path.exists(os.path.join(processing_dir, name)):
+                # a request with the same name is still running, keep both
+                name = f"{name[:-len('.json')]}_{uuid.uuid4().hex[:8]}.json"
+            claimed = os.path.join(processing_dir, name)
+            try:
+                os.rename(source, claimed)
+            except OSError:
+                continue
+            try:
+                with open(claimed) as f:
+                    request = json.load(f)
+                if not isinstance(request, dict):
+                    raise ValueError("Request file must contain a JSON object")
+                job_id = service.submit(request, on_done=finish(name))
+                logging.info(f"Queued {name} as job {job_id}.")
+            except ValueError as e:
+                logging.error(f"Rejected {name}: {e}")
+                finish(name)({"status": "failed", "error": str(e)})
+        time.sleep(poll_interval)
+
+
+def serve(args):
+    _init_logging(0)
+    logging.info(f"Service args: {args}")
+    service = DancerService(args)
+
+    if args.watch_dir:
+        threading.Thread(
+            target=watch_directory,
+            args=(service, args.watch_dir, args.poll_interval),
+            daemon=True).start()
+        logging.info(f"Watching {args.watch_dir} for dropped requests.")
+    if args.port:
+        server = ThreadingHTTPServer((args.host, args.port), _make_handler(service))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"Listening on http://{args.host}:{args.port}")
+
+    service.run_forever()
+
+
+if __name__ == "__main__":
+    serve(_parse_args())
@@ -43,6 +43,9 @@ class WanI2VDancer:
         t5_cpu=False,
         init_on_cpu=True,
         st_cond_cfg=0.1, end_cond_cfg=0.5,
+        t5_cache_size=32,
+        t5_cache_dir=None,
+        clip_cache_size=8,
     ):
         r"""
         Initializes the image-to-video generation model components.
@@ -66,6 +69,12 @@ class WanI2VDancer:
                 Whether to place T5 model on CPU. Only works without t5_fsdp.
             init_on_cpu (`bool`, *optional*, defaults to True):
                 Enable initializing Transformer Model on CPU. Only works without FSDP or USP.
+            t5_cache_size (`int`, *optional*, defaults to 32):
+                Number of prompt contexts kept in memory so repeated prompts skip the T5 encoder, 0 to disable.
+            t5_cache_dir (`str`, *optional*, defaults to None):
+                Directory persisting the prompt contexts across processes. Only works without t5_fsdp.
+            clip_cache_size (`int`, *optional*, defaults to 8):
+                Number of reference image features kept in memory so repeated images skip CLIP, 0 to disable.
         """
         self.device = torch.device(f"cuda:{device_id}")
         self.config = config
@@ -84,6 +93,8 @@ class WanI2VDancer:
             checkpoint_path=os.path.join(checkpoint_dir, config.t5_checkpoint),
             tokenizer_path=os.path.join(checkpoint_dir, config.t5_tokenizer),
             shard_fn=shard_fn if t5_fsdp else None,
+            cache_size=t5_cache_size,
+            cache_dir=None if t5_fsdp else t5_cache_dir,
         )
 
         self.vae_stride = config.vae_stride
@@ -97,7 +108,8 @@ class WanI2VDancer:
             device=self.device,
             checkpoint_path=os.path.join(checkpoint_dir,
                                          config.clip_checkpoint),
-            tokenizer_path=os.path.join(checkpoint_dir, config.clip_tokenizer))
+            tokenizer_path=os.path.join(checkpoint_dir, config.clip_tokenizer),
+            cache_size=clip_cache_size)
 
         logging.info(f"Creating WanModel from {checkpoint_dir}")
         self.model = WanModel.from_pretrained(checkpoint_dir)
@@ -149,7 +161,9 @@ class WanI2VDancer:
                  condition_guide_scale=2.0,
                  n_prompt="",
                  seed=-1,
-                 offload_model=True):
+                 offload_model=True,
+                 memory_policy='offload',
+                 batched_cfg=False):
         r"""
         Generates video frames from input image and text prompt using diffusion process.
 
@@ -179,6 +193,15 @@ class WanI2VDancer:
                 Random seed for noise generation. If -1, use random seed
             offload_model (`bool`, *optional*, defaults to True):
                 If True, offloads models to CPU during generation to save VRAM
+            memory_policy (`str`, *optional*, defaults to 'offload'):
+                Where the denoising loop keeps its tensors when `offload_model` is True.
+                'offload' moves every prediction and the latent to CPU and empties the CUDA cache after each forward.
+                'resident_gpu' keeps latents, predictions and scheduler state on GPU for the whole loop,
+                and only offloads the models after sampling.
+            batched_cfg (`bool`, *optional*, defaults to False):
+                If True, runs the conditional and unconditional passes of each step as one batched
+                forward instead of two or three separate ones. Faster, but needs more VRAM.
+                Not supported with USP.
 
         Returns:
             torch.Tensor:
@@ -188,6 +211,12 @@ class WanI2VDancer:
                 - H: Frame height (from max_area)
                 - W: Frame width from max_area)
         """
+        if memory_policy not in ('offload', 'resident_gpu'):
+            raise ValueError(f"Unsupported memory_policy: {memory_policy}")
+        # per-step offloading inside the sampling loop
+        step_offload = offload_model and memory_policy == 'offload'
+        step_device = torch.device('cpu') if step_offload else self.device
+
         img = TF.to_tensor(img).sub_(0.5).div_(0.5).to(self.device)
         img_x = TF.to_tensor(img_x).sub_(0.5).div_(0.5).to(self.device)
         img_c = TF.to_tensor(img_c).sub_(0.5).div_(0.5).to(self.device)
@@ -235,10 +264,12 @@ class WanI2VDancer:
 
         # preprocess
         if not self.t5_cpu:
-            self.text_encoder.model.to(self.device)
+            t5_cached = self.text_encoder.is_cached([input_prompt, n_prompt])
+            if not t5_cached:
+                self.text_encoder.model.to(self.device)
             context = self.text_encoder([input_prompt], self.device)
             context_null = self.text_encoder([n_prompt], self.device)
-            if offload_model:
+            if offload_model and not t5_cached:
                 self.text_encoder.model.cpu()
         else:
             context = self.text_encoder([input_prompt], torch.device('cpu'))
@@ -246,11 +277,14 @@ class WanI2VDancer:
             context = [t.to(self.device) for t in context]
             context_null = [t.to(self.device) for t in context_null]
 
-        self.clip.model.to(self.device)
+        clip_cached = self.clip.is_cached([img_x[:, None, :, :]]) and \
+            self.clip.is_cached([img_c[:, None, :, :]])
+        if not clip_cached:
+            self.clip.model.to(self.device)
         # clip_context = self.clip.visual([img[:, None, :, :]])
         clip_context_x = self.clip.visual([img_x[:, None, :, :]])
         clip_context_c = self.clip.visual([img_c[:, None, :, :]])
-        if offload_model:
+        if offload_model and not clip_cached:
             self.clip.model.cpu()
 
         y = self.vae.encode([
@@ -360,6 +394,26 @@ class WanI2VDancer:
                 'ref_x': ref_x,
             }
 
+            # batched cfg: cond / null context / null condition stacked along the batch dim
+            def stack_args(*args):
+                return {
+                    'context': [arg['context'][0] for arg in args],
+                    'clip_fea_c': clip_context_c,
+                    'clip_fea_x': clip_context_x,
+                    'seq_len': max_seq_len,
+                    'y': [y] * len(args),
+                    'condition': [arg['condition'] for arg in args],
+                    'ref_c': ref_c,
+                    'ref_x': ref_x,
+                }
+
+            if batched_cfg and self.use_usp:
+                logging.warning("batched_cfg is not supported with USP, falling back to sequential cfg.")
+                batched_cfg = False
+            if batched_cfg:
+                arg_cfg = stack_args(arg_c, arg_null_context)
+                arg_cfg_cond = stack_args(arg_c, arg_null_context, arg_null_condition)
+
             if offload_model:
                 torch.cuda.empty_cache()
 
@@ -369,25 +423,40 @@ class WanI2VDancer:
                 timestep = [t]
 
                 timestep = torch.stack(timestep).to(self.device)
-
-                noise_pred_cond = self.model(
-                    latent_model_input, t=timestep, **arg_c)[0].to(
-                        torch.device('cpu') if offload_model else self.device)
-                if offload_model:
-                    torch.cuda.empty_cache()
-                noise_pred_uncond_context = self.model(
-                    latent_model_input, t=timestep, **arg_null_context)[0].to(
-                        torch.device('cpu') if offload_model else self.device)
-                if offload_model:
-                    torch.cuda.empty_cache()
-
-                if idx / len(timesteps) > self.st_cond_cfg and idx / len(timesteps) < self.end_cond_cfg:
-                    noise_pred_uncond_condition = self.model(
-                        latent_model_input, t=timestep, **arg_null_condition)[0].to(
-                            torch.device('cpu') if offload_model else self.device)
-                    if offload_model:
+                use_cond_cfg = idx / len(timesteps) > self.st_cond_cfg and idx / len(timesteps) < self.end_cond_cfg
+
+                if batched_cfg:
+                    arg_batch = arg_cfg_cond if use_cond_cfg else arg_cfg
+                    batch_size = len(arg_batch['context'])
+                    noise_preds = [
+                        u.to(step_device) for u in self.model(
+                            latent_model_input * batch_size,
+                            t=timestep.repeat(batch_size),
+                            **arg_batch)
+                    ]
+                    if step_offload:
                         torch.cuda.empty_cache()
+                    noise_pred_cond, noise_pred_uncond_context = noise_preds[:2]
+                    if use_cond_cfg:
+                        noise_pred_uncond_condition = noise_preds[2]
+                    del noise_preds
+                else:
+                    noise_pred_cond = self.model(
+                        latent_model_input, t=timestep, **arg_c)[0].to(step_device)
+                    if step_offload:
+                        torch.cuda.empty_cache()
+                    noise_pred_uncond_context = self.model(
+                        latent_model_input, t=timestep, **arg_null_context)[0].to(step_device)
+                    if step_offload:
+                        torch.cuda.empty_cache()
+
+                    if use_cond_cfg:
+                        noise_pred_uncond_condition = self.model(
+                            latent_model_input, t=timestep, **arg_null_condition)[0].to(step_device)
+                        if step_offload:
+                            torch.cuda.empty_cache()
 
+                if use_cond_cfg:
                     cond_context = noise_pred_cond - noise_pred_uncond_context
                     cond_condition = noise_pred_cond - noise_pred_uncond_condition                    
                     noise_pred = noise_pred_uncond_context + guide_scale * cond_context + condition_guide_scale * cond_condition
@@ -395,8 +464,7 @@ class WanI2VDancer:
                     cond_context = noise_pred_cond - noise_pred_uncond_context
                     noise_pred = noise_pred_uncond_context + guide_scale * cond_context
 
-                latent = latent.to(
-                    torch.device('cpu') if offload_model else self.device)
+                latent = latent.to(step_device)
 
                 temp_x0 = sample_scheduler.step(
                     noise_pred.unsqueeze(0),
@@ -1,7 +1,9 @@
 # Modified from ``https://github.com/openai/CLIP'' and ``https://github.com/mlfoundations/open_clip''
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import hashlib
 import logging
 import math
+from collections import OrderedDict
 
 import torch
 import torch.nn as nn
@@ -500,7 +502,8 @@ def clip_xlm_roberta_vit_h_14(
 
 class CLIPModel:
 
-    def __init__(self, dtype, device, checkpoint_path, tokenizer_path):
+    def __init__(self, dtype, device, checkpoint_path, tokenizer_path,
+                 cache_size=0):
         self.dtype = dtype
         self.device = device
         self.checkpoint_path = checkpoint_path
@@ -524,7 +527,32 @@ class CLIPModel:
             seq_len=self.model.max_text_len - 2,
             clean='whitespace')
 
+        # init visual feature cache, LRU keyed by the content of the input videos
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def _cache_key(self, videos):
+        h = hashlib.sha256()
+        for u in videos:
+            u = u.detach().float().cpu().contiguous()
+            h.update(str(tuple(u.shape)).encode())
+            h.update(u.numpy().tobytes())
+        return h.hexdigest()
+
+    def is_cached(self, videos):
+        r"""
+        Whether the visual features of videos can be served from the cache without running the model.
+        """
+        return self.cache_size > 0 and self._cache_key(videos) in self._cache
+
     def visual(self, videos):
+        key = None
+        if self.cache_size > 0:
+            key = self._cache_key(videos)
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key].to(videos[0].device)
+
         # preprocess
         size = (self.model.image_size,) * 2
         videos = torch.cat([
@@ -539,4 +567,8 @@ class CLIPModel:
         # forward
         with torch.cuda.amp.autocast(dtype=self.dtype):
             out = self.model.visual(videos, use_31_block=True)
-            return out
+        if key is not None:
+            self._cache[key] = out.to('cpu', copy=True)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return out
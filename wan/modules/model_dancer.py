@@ -542,6 +542,8 @@ class WanModel(ModelMixin, ConfigMixin):
                 List of text embeddings each with shape [L, C]
             seq_len (`int`):
                 Maximum sequence length for positional encoding
+            condition (Tensor or List[Tensor], *optional*):
+                Pose condition latents with shape [C_c, F, H, W], either shared by all samples or one per sample
             clip_fea (Tensor, *optional*):
                 CLIP image features for image-to-video mode
             y (List[Tensor], *optional*):
@@ -558,28 +560,25 @@ class WanModel(ModelMixin, ConfigMixin):
         if self.freqs.device != device:
             self.freqs = self.freqs.to(device)
 
-        x_noise_clone = torch.stack(x)
+        x_noise = x
+        if not isinstance(condition, (list, tuple)):
+            condition = [condition] * len(x)
 
         if y is not None:
             x = [torch.cat([u, v], dim=0) for u, v in zip(x, y)]
 
-        # Temporal Motion Coherence Module.
-        condition_temporal = [self.condition_embedding_temporal(c.unsqueeze(0)) for c in [condition]]
-        
-        # Spatial Structure Adaptive Extractor.
-        with amp.autocast(dtype=torch.bfloat16, device_type="cuda"):
-            condition = condition[None]
-            bs, _, time_steps, _, _ = condition.shape
-            condition_reshape = rearrange(condition, 'b c t h w -> (b t) c h w')
-            condition_spatial = self.condition_embedding_spatial(condition_reshape)
-            condition_spatial = rearrange(condition_spatial, '(b t) c h w -> b c t h w', t=time_steps, b=bs)
-
-        # Hierarchical Aggregation (1): condition, temporal condition, spatial condition
-        condition_fused = condition + condition_temporal[0] + condition_spatial
-
-        # Frame-wise Attention Alignment Unit.
-        with amp.autocast(dtype=torch.bfloat16, device_type="cuda"):
-            condition_aligned = self.condition_embedding_align(condition_fused, x_noise_clone)
+        # Pose condition branch, run per sample: the alignment attention mixes along the
+        # flattened batch-time axis, so samples must not share a call. Samples with the
+        # same condition and noisy latent (e.g. cond / null-text CFG passes) reuse the result.
+        condition_cache = {}
+        condition_fused, condition_aligned = [], []
+        for u, c in zip(x_noise, condition):
+            key = (id(u), id(c))
+            if key not in condition_cache:
+                condition_cache[key] = self._embed_condition(c, u)
+            fused, aligned = condition_cache[key]
+            condition_fused.append(fused)
+            condition_aligned.append(aligned)
 
         real_seq = x[0].shape[1]
         
@@ -587,12 +586,10 @@ class WanModel(ModelMixin, ConfigMixin):
         x = [self.patch_embedding_fuse(torch.cat([u[None], c[None], a[None]], 1)) for u, c, a in
              zip(x, condition_fused, condition_aligned)]
         
-        # Condition Augmentation: x_cond, ref_x, ref_c
-        ref_x = [ref_x]
-        ref_c = [ref_c]
-        ref_x = [self.patch_embedding(r.unsqueeze(0)) for r in ref_x]
-        ref_c = [self.patch_embedding_ref_c(r[:16].unsqueeze(0)) for r in ref_c]
-        x = [torch.cat([r, u, v], dim=2) for r, u, v in zip(x, ref_x, ref_c)]
+        # Condition Augmentation: x_cond, ref_x, ref_c (shared by all samples)
+        ref_x = self.patch_embedding(ref_x.unsqueeze(0))
+        ref_c = self.patch_embedding_ref_c(ref_c[:16].unsqueeze(0))
+        x = [torch.cat([u, ref_x, ref_c], dim=2) for u in x]
 
         grid_sizes = torch.stack(
             [torch.tensor(u.shape[2:], dtype=torch.long) for u in x])
@@ -627,6 +624,8 @@ class WanModel(ModelMixin, ConfigMixin):
             context_clip_c = self.img_emb(clip_fea_c)  # bs x 257 x dim
         if clip_fea_x is not None:
             context_clip = context_clip_x if context_clip_c is None else context_clip_x + context_clip_c    # Condition Augmentation
+            if context_clip.size(0) != context.size(0):
+                context_clip = context_clip.expand(context.size(0), -1, -1)
             context = torch.concat([context_clip, context], dim=1)
 
         # arguments
@@ -649,6 +648,41 @@ class WanModel(ModelMixin, ConfigMixin):
         # return [u.float() for u in x]
         return [u[:, :real_seq, ...] for u in x]
 
+    def _embed_condition(self, condition, x_noise):
+        r"""
+        Embed one pose condition with the Synergistic Pose Modulation Modules.
+
+        Args:
+            condition (Tensor):
+                Pose condition latent with shape [C_c, F, H, W]
+            x_noise (Tensor):
+                Noisy video latent with shape [C_in, F, H, W]
+
+        Returns:
+            Tuple[Tensor, Tensor]:
+                Fused and aligned condition, each with shape [C_c, F, H, W]
+        """
+        condition = condition[None]
+
+        # Temporal Motion Coherence Module.
+        condition_temporal = self.condition_embedding_temporal(condition)
+
+        # Spatial Structure Adaptive Extractor.
+        with amp.autocast(dtype=torch.bfloat16, device_type="cuda"):
+            bs, _, time_steps, _, _ = condition.shape
+            condition_reshape = rearrange(condition, 'b c t h w -> (b t) c h w')
+            condition_spatial = self.condition_embedding_spatial(condition_reshape)
+            condition_spatial = rearrange(condition_spatial, '(b t) c h w -> b c t h w', t=time_steps, b=bs)
+
+        # Hierarchical Aggregation (1): condition, temporal condition, spatial condition
+        condition_fused = condition + condition_temporal + condition_spatial
+
+        # Frame-wise Attention Alignment Unit.
+        with amp.autocast(dtype=torch.bfloat16, device_type="cuda"):
+            condition_aligned = self.condition_embedding_align(condition_fused, x_noise[None])
+
+        return condition_fused[0], condition_aligned[0]
+
     def unpatchify(self, x, grid_sizes):
         r"""
         Reconstruct video tensors from patch embeddings.
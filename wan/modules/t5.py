@@ -1,7 +1,10 @@
 # Modified from transformers.models.t5.modeling_t5
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import hashlib
 import logging
 import math
+import os
+from collections import OrderedDict
 
 import torch
 import torch.nn as nn
@@ -479,6 +482,8 @@ class T5EncoderModel:
         checkpoint_path=None,
         tokenizer_path=None,
         shard_fn=None,
+        cache_size=0,
+        cache_dir=None,
     ):
         self.text_len = text_len
         self.dtype = dtype
@@ -503,11 +508,77 @@ class T5EncoderModel:
         self.tokenizer = HuggingfaceTokenizer(
             name=tokenizer_path, seq_len=text_len, clean='whitespace')
 
-    def __call__(self, texts, device):
+        # init context cache, LRU in memory and optionally persisted to cache_dir
+        self.cache_size = cache_size
+        self.cache_dir = cache_dir
+        self._cache = OrderedDict()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_key(self, ids):
+        h = hashlib.sha256()
+        h.update(f'{os.path.basename(str(self.checkpoint_path))}:{self.dtype}'.encode())
+        h.update(ids.to(torch.int64).cpu().numpy().tobytes())
+        return h.hexdigest()
+
+    def _cache_get(self, key):
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, f'{key}.pt')
+            if os.path.exists(path):
+                try:
+                    context = torch.load(path, map_location='cpu')
+                except Exception as e:
+                    logging.warning(f'ignoring unreadable t5 cache entry {path}: {e}')
+                    return None
+                self._cache_put(key, context, persist=False)
+                return context
+        return None
+
+    def _cache_put(self, key, context, persist=True):
+        if self.cache_size > 0:
+            self._cache[key] = context
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        if persist and self.cache_dir:
+            path = os.path.join(self.cache_dir, f'{key}.pt')
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            torch.save(context, tmp_path)
+            os.replace(tmp_path, path)
+
+    def _tokenize(self, texts):
         ids, mask = self.tokenizer(
             texts, return_mask=True, add_special_tokens=True)
-        ids = ids.to(device)
-        mask = mask.to(device)
         seq_lens = mask.gt(0).sum(dim=1).long()
-        context = self.model(ids, mask)
-        return [u[:v] for u, v in zip(context, seq_lens)]
+        keys = None
+        if self.cache_size > 0 or self.cache_dir:
+            keys = [self._cache_key(u[:v]) for u, v in zip(ids, seq_lens)]
+        return ids, mask, seq_lens, keys
+
+    def is_cached(self, texts):
+        r"""
+        Whether all texts can be served from the cache without running the encoder.
+        """
+        _, _, _, keys = self._tokenize(texts)
+        return keys is not None and all(
+            self._cache_get(key) is not None for key in keys)
+
+    def __call__(self, texts, device):
+        ids, mask, seq_lens, keys = self._tokenize(texts)
+        if keys is None:
+            ids = ids.to(device)
+            mask = mask.to(device)
+            context = self.model(ids, mask)
+            return [u[:v] for u, v in zip(context, seq_lens)]
+
+        outputs = [self._cache_get(key) for key in keys]
+        misses = [i for i, u in enumerate(outputs) if u is None]
+        if misses:
+            context = self.model(ids[misses].to(device), mask[misses].to(device))
+            for i, u in zip(misses, context):
+                outputs[i] = u[:seq_lens[i]].to('cpu', copy=True)
+                self._cache_put(keys[i], outputs[i])
+        return [u.to(device) for u in outputs]